@@ -0,0 +1,100 @@
+import logging
+import threading
+
+from db import PoolAgotadoError, liberar_conexion, obtener_conexion
+
+# Purga de equipos dados de baja.
+#
+# DELETE /equipos/{id} solo marca equipos.deleted_at: el equipo sale del
+# catálogo, pero sus préstamos y su historial lo siguen referenciando y
+# resolviendo el nombre. Cada ciclo elimina definitivamente, en lotes de
+# `lote` equipos y cada lote en su propia transacción, los equipos dados de
+# baja hace más de `retencion_dias` junto con todo lo que los referencia:
+# reservas, préstamos (y sus recordatorios) e historial, también el archivado
+# (el historial archivado sigue en las exportaciones .csv.gz). Los lotes se
+# toman con FOR UPDATE SKIP LOCKED, así varios workers de la API pueden
+# ejecutar la purga a la vez.
+
+logger = logging.getLogger("inventario.api.bajas")
+
+
+def purgar_equipos(conn, retencion_dias, lote):
+    cur = conn.cursor()
+    # Todo en una sentencia: las claves foráneas se comprueban al final, cuando
+    # ya no queda nada que referencie a los equipos purgados
+    cur.execute("""
+        WITH purgables AS (
+            SELECT e.id
+            FROM equipos e
+            WHERE e.deleted_at < CURRENT_TIMESTAMP - %s * interval '1 day'
+            ORDER BY e.deleted_at, e.id
+            LIMIT %s
+            FOR UPDATE OF e SKIP LOCKED
+        ), reservas_borradas AS (
+            DELETE FROM reservas r USING purgables p WHERE r.equipo_id = p.id
+        ), prestamos_borrados AS (
+            -- Un equipo con un préstamo activo no se puede dar de baja: todos están cerrados
+            DELETE FROM prestamos pr USING purgables p WHERE pr.equipo_id = p.id
+        ), historial_borrado AS (
+            DELETE FROM historial_equipos h USING purgables p WHERE h.equipo_id = p.id
+        ), archivo_borrado AS (
+            DELETE FROM archivo.historial_equipos h USING purgables p WHERE h.equipo_id = p.id
+        )
+        DELETE FROM equipos e
+        USING purgables p
+        WHERE e.id = p.id
+        RETURNING e.id
+    """, (retencion_dias, lote))
+    ids = [fila["id"] for fila in cur.fetchall()]
+    if ids:
+        # Las filas por equipo de las estadísticas quedaron en cero al borrar
+        # los préstamos (trigger de la sentencia anterior)
+        cur.execute("DELETE FROM estadisticas_prestamos_equipo WHERE equipo_id = ANY(%s)", (ids,))
+    return ids
+
+
+class PlanificadorBajas:
+    def __init__(self, intervalo, retencion_dias, lote):
+        self.intervalo = intervalo
+        self.retencion_dias = retencion_dias
+        self.lote = lote
+        self._detener = threading.Event()
+        self._hilo = threading.Thread(target=self._ejecutar, name="bajas", daemon=True)
+
+    def iniciar(self):
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self._hilo.join(timeout=30)
+
+    def _ejecutar(self):
+        while not self._detener.is_set():
+            try:
+                self.ejecutar_ciclo()
+            except PoolAgotadoError as e:
+                logger.warning("purga de equipos omitida", extra={"motivo": str(e)})
+            except Exception:
+                logger.exception("error en la purga de equipos")
+            self._detener.wait(self.intervalo)
+
+    def _en_transaccion(self, funcion, *args):
+        conn = obtener_conexion()
+        try:
+            resultado = funcion(conn, *args)
+            conn.commit()
+            return resultado
+        finally:
+            liberar_conexion(conn)
+
+    def ejecutar_ciclo(self):
+        purgados = []
+        while not self._detener.is_set():
+            ids = self._en_transaccion(purgar_equipos, self.retencion_dias, self.lote)
+            purgados.extend(ids)
+            if len(ids) < self.lote:
+                break
+
+        if purgados:
+            logger.info("purga de equipos", extra={"purgados": len(purgados)})
+        return purgados
@@ -0,0 +1,150 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from observabilidad import CACHE_ERRORES, CACHE_INVALIDACIONES, CACHE_LECTURAS, totales
+
+try:
+    import redis
+except ImportError:  # El backend compartido es opcional
+    redis = None
+
+# Caché de lectura para el catálogo de equipos.
+#
+# Las entradas se agrupan en espacios de nombres ("equipos", "equipo:5", ...).
+# Cada espacio tiene un número de generación que forma parte de la clave, así
+# que invalidar un espacio es un solo incremento: las entradas de generaciones
+# anteriores dejan de ser alcanzables y salen por LRU o por TTL.
+
+
+class BackendMemoria:
+    # LRU acotado con expiración por TTL, local a cada proceso
+    def __init__(self, maximo, ttl):
+        self.maximo = maximo
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self._generaciones = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                return None
+            expira, valor = entrada
+            if expira < time.monotonic():
+                del self._datos[clave]
+                return None
+            self._datos.move_to_end(clave)
+            return valor
+
+    def guardar(self, clave, valor):
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + self.ttl, valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.maximo:
+                self._datos.popitem(last=False)
+
+    def generacion(self, espacio):
+        with self._lock:
+            return self._generaciones.get(espacio, 0)
+
+    def incrementar_generacion(self, espacio):
+        with self._lock:
+            self._generaciones[espacio] = self._generaciones.get(espacio, 0) + 1
+
+    def tamano(self):
+        with self._lock:
+            return len(self._datos)
+
+
+class BackendRedis:
+    # Backend compartido entre workers: las generaciones viven en Redis, así
+    # una invalidación en un worker es visible para todos los demás
+    def __init__(self, url, ttl, prefijo="inventario:cache:"):
+        if redis is None:
+            raise RuntimeError("CACHE_REDIS_URL requiere el paquete 'redis'")
+        self.ttl = ttl
+        self.prefijo = prefijo
+        self._cliente = redis.Redis.from_url(url)
+
+    def obtener(self, clave):
+        dato = self._cliente.get(self.prefijo + clave)
+        return pickle.loads(dato) if dato is not None else None
+
+    def guardar(self, clave, valor):
+        self._cliente.set(self.prefijo + clave, pickle.dumps(valor), ex=max(1, int(self.ttl)))
+
+    def generacion(self, espacio):
+        return int(self._cliente.get(self.prefijo + "gen:" + espacio) or 0)
+
+    def incrementar_generacion(self, espacio):
+        self._cliente.incr(self.prefijo + "gen:" + espacio)
+
+    def tamano(self):
+        return None
+
+
+# Los contadores son métricas de Prometheus (observabilidad.py): con varios
+# workers, metricas() suma las de todos
+class Cache:
+    def __init__(self, backend):
+        self.backend = backend
+
+    # Devuelve el valor cacheado para (espacio, clave) o lo calcula con
+    # `calcular()` y lo guarda. Las excepciones de `calcular` no se cachean.
+    # Un fallo del backend nunca rompe la lectura: se consulta la base de datos.
+    def leer(self, espacio, clave, calcular):
+        try:
+            clave_completa = f"{espacio}:{self.backend.generacion(espacio)}:{clave}"
+            valor = self.backend.obtener(clave_completa)
+        except Exception:
+            CACHE_ERRORES.inc()
+            return calcular()
+
+        if valor is not None:
+            CACHE_LECTURAS.labels("acierto").inc()
+            return valor
+
+        CACHE_LECTURAS.labels("fallo").inc()
+        valor = calcular()
+        try:
+            self.backend.guardar(clave_completa, valor)
+        except Exception:
+            CACHE_ERRORES.inc()
+        return valor
+
+    def invalidar(self, *espacios):
+        for espacio in espacios:
+            try:
+                self.backend.incrementar_generacion(espacio)
+            except Exception:
+                CACHE_ERRORES.inc()
+            CACHE_INVALIDACIONES.inc()
+
+    def metricas(self):
+        lecturas = totales("api_cache_lecturas_total", "resultado")
+        aciertos = int(lecturas.get("acierto", 0))
+        fallos = int(lecturas.get("fallo", 0))
+        total = aciertos + fallos
+        return {
+            "backend": type(self.backend).__name__,
+            "aciertos": aciertos,
+            "fallos": fallos,
+            "tasa_aciertos": round(aciertos / total, 4) if total else 0.0,
+            "invalidaciones": int(totales("api_cache_invalidaciones_total").get(None, 0)),
+            "errores_backend": int(totales("api_cache_errores_backend_total").get(None, 0)),
+            # Solo las de este worker con el backend en memoria
+            "entradas": self.backend.tamano(),
+        }
+
+
+def crear_backend(ttl, maximo, redis_url=None, prefijo="inventario:cache:"):
+    if redis_url:
+        return BackendRedis(redis_url, ttl, prefijo)
+    return BackendMemoria(maximo, ttl)
+
+
+def crear_cache(ttl, maximo, redis_url=None):
+    return Cache(crear_backend(ttl, maximo, redis_url))
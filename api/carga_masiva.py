@@ -0,0 +1,99 @@
+import csv
+import io
+
+# Validación y carga de lotes de equipos. Las filas se validan todas antes de
+# tocar la base de datos y se reportan los errores por fila; las válidas se
+# cargan con COPY en una tabla temporal para insertarlas en una sola sentencia.
+
+ESTADOS_EQUIPO = ("disponible", "prestado")
+MAX_NOMBRE = 100
+
+
+def _texto(valor):
+    return "" if valor is None else str(valor).strip()
+
+
+def validar_equipo_nuevo(datos):
+    errores = []
+    if not isinstance(datos, dict):
+        return None, ["La fila debe ser un objeto con nombre, descripcion y estado"]
+
+    nombre = _texto(datos.get("nombre"))
+    descripcion = _texto(datos.get("descripcion"))
+    estado = _texto(datos.get("estado")) or "disponible"
+
+    if not nombre:
+        errores.append("El nombre es obligatorio")
+    elif len(nombre) > MAX_NOMBRE:
+        errores.append(f"El nombre supera los {MAX_NOMBRE} caracteres")
+    if estado not in ESTADOS_EQUIPO:
+        errores.append(f"Estado inválido: {estado}")
+
+    return (nombre, descripcion, estado), errores
+
+
+def validar_cambio_estado(datos):
+    errores = []
+    if not isinstance(datos, dict):
+        return None, ["La fila debe ser un objeto con id y estado"]
+
+    try:
+        equipo_id = int(datos.get("id"))
+    except (TypeError, ValueError):
+        equipo_id = None
+        errores.append("El id del equipo es obligatorio y debe ser entero")
+
+    estado = _texto(datos.get("estado"))
+    if estado not in ESTADOS_EQUIPO:
+        errores.append(f"Estado inválido: {estado}")
+
+    motivo = _texto(datos.get("motivo")) or None
+    return (equipo_id, estado, motivo), errores
+
+
+# Valida todas las filas y devuelve (filas_validas, errores) donde cada error
+# es {"fila": n, "errores": [...]} con n empezando en 1
+def validar_lote(filas, validar):
+    validas, errores = [], []
+    for numero, datos in enumerate(filas, start=1):
+        fila, errores_fila = validar(datos)
+        if errores_fila:
+            errores.append({"fila": numero, "errores": errores_fila})
+        else:
+            validas.append(fila)
+    return validas, errores
+
+
+# Errores por cada equipo que aparece más de una vez en un lote de cambios ya
+# validado (todas las filas válidas, así que su posición es la fila original)
+def filas_repetidas(cambios):
+    errores, vistos = [], {}
+    for numero, (equipo_id, _, _) in enumerate(cambios, start=1):
+        if equipo_id in vistos:
+            errores.append({"fila": numero, "errores": [f"Equipo {equipo_id} repetido (fila {vistos[equipo_id]})"]})
+        else:
+            vistos[equipo_id] = numero
+    return errores
+
+
+def leer_csv(contenido):
+    if isinstance(contenido, bytes):
+        contenido = contenido.decode("utf-8-sig")
+    return list(csv.DictReader(io.StringIO(contenido)))
+
+
+# Carga `filas` en `tabla` con COPY FROM STDIN. csv.writer escribe igual None
+# y "", y COPY lee ese campo vacío como NULL: las columnas de `no_nulas` lo
+# leen como "" (FORCE_NOT_NULL).
+def copiar_filas(cur, tabla, columnas, filas, no_nulas=()):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerows(filas)
+    buffer.seek(0)
+    opciones = "FORMAT csv"
+    if no_nulas:
+        opciones += f", FORCE_NOT_NULL ({', '.join(no_nulas)})"
+    cur.copy_expert(
+        f"COPY {tabla} ({', '.join(columnas)}) FROM STDIN WITH ({opciones})",
+        buffer,
+    )
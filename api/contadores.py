@@ -0,0 +1,51 @@
+import logging
+import threading
+
+from db import PoolAgotadoError, liberar_conexion, obtener_conexion
+
+# Compactación de los contadores que mantienen los triggers.
+#
+# Las escrituras no actualizan contadores compartidos: cada transacción deja
+# filas propias (cambios_tablas, y las diferencias de estadisticas_equipos y
+# estadisticas_vencimientos) que los lectores suman a la base. Cada
+# `intervalo` segundos compactar_contadores() (database/init.sql) las pasa a
+# la base, para que esas sumas sigan recorriendo pocas filas. Varios workers
+# pueden ejecutarla a la vez: solo uno compacta, los demás lo omiten.
+
+logger = logging.getLogger("inventario.api.contadores")
+
+
+def compactar_contadores(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT compactar_contadores()")
+
+
+class PlanificadorContadores:
+    def __init__(self, intervalo):
+        self.intervalo = intervalo
+        self._detener = threading.Event()
+        self._hilo = threading.Thread(target=self._ejecutar, name="contadores", daemon=True)
+
+    def iniciar(self):
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self._hilo.join(timeout=30)
+
+    def _ejecutar(self):
+        while not self._detener.wait(self.intervalo):
+            try:
+                self.ejecutar_ciclo()
+            except PoolAgotadoError as e:
+                logger.warning("compactación de contadores omitida", extra={"motivo": str(e)})
+            except Exception:
+                logger.exception("error en la compactación de contadores")
+
+    def ejecutar_ciclo(self):
+        conn = obtener_conexion()
+        try:
+            compactar_contadores(conn)
+            conn.commit()
+        finally:
+            liberar_conexion(conn)
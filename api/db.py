@@ -0,0 +1,221 @@
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor
+
+
+class PoolAgotadoError(Exception):
+    pass
+
+
+# Función llamada con (sql, duracion_segundos) tras cada consulta; la instala
+# la aplicación con observar_consultas() para sus métricas
+_observador = None
+
+
+def observar_consultas(funcion):
+    global _observador
+    _observador = funcion
+
+
+# Medición de los cursores de las conexiones del pool: mide cada consulta y
+# avisa al observador
+class MedicionConsultas:
+    def _medir(self, sql, operacion, *args):
+        inicio = time.perf_counter()
+        try:
+            return operacion(*args)
+        finally:
+            if _observador is not None:
+                _observador(sql, time.perf_counter() - inicio)
+
+    def execute(self, query, vars=None):
+        return self._medir(query, super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._medir(query, super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._medir(sql, super().copy_expert, sql, file, size)
+
+
+# Cursor por defecto: filas como diccionarios
+class CursorMedido(MedicionConsultas, RealDictCursor):
+    pass
+
+
+# Filas como tuplas, para los listados grandes que las envuelven en objetos
+# compactos (ver respuestas.py)
+class CursorTuplas(MedicionConsultas, psycopg2.extensions.cursor):
+    pass
+
+
+def cursor_tuplas(conn):
+    return conn.cursor(cursor_factory=CursorTuplas)
+
+
+# Conexión que recuerda de qué pool salió, para devolverla al mismo (la API
+# puede tener además un pool de la réplica de lectura, ver replicas.py)
+class ConexionPool(psycopg2.extensions.connection):
+    pool = None
+
+
+# Pool de conexiones compartido por todos los hilos de la API.
+# Las conexiones libres se reutilizan en orden LIFO y, si el pool está lleno,
+# quien pide una conexión espera hasta `timeout` segundos antes de fallar.
+class PoolConexiones:
+    def __init__(self, minimo, maximo, timeout, **parametros_conexion):
+        if minimo < 0 or maximo < 1 or minimo > maximo:
+            raise ValueError("Tamaño de pool inválido")
+        self.minimo = minimo
+        self.maximo = maximo
+        self.timeout = timeout
+        self._parametros = parametros_conexion
+        self._cond = threading.Condition()
+        self._libres = []
+        self._total = 0
+        self._en_uso = 0
+        self._esperando = 0
+        self._cerrado = False
+
+        # Estadísticas
+        self._adquisiciones = 0
+        self._timeouts = 0
+        self._espera_total = 0.0
+        self._espera_max = 0.0
+
+        for _ in range(minimo):
+            self._libres.append(self._conectar())
+            self._total += 1
+
+    def _conectar(self):
+        conn = psycopg2.connect(connection_factory=ConexionPool, cursor_factory=CursorMedido, **self._parametros)
+        conn.pool = self
+        return conn
+
+    def adquirir(self):
+        inicio = time.monotonic()
+        limite = inicio + self.timeout
+        conn = None
+        nueva = False
+
+        with self._cond:
+            self._esperando += 1
+            try:
+                while True:
+                    if self._cerrado:
+                        raise PoolAgotadoError("El pool de conexiones está cerrado")
+                    if self._libres:
+                        conn = self._libres.pop()
+                        break
+                    if self._total < self.maximo:
+                        # Reservar el hueco; la conexión se abre fuera del lock
+                        self._total += 1
+                        nueva = True
+                        break
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        self._timeouts += 1
+                        raise PoolAgotadoError(
+                            f"No hay conexiones libres tras esperar {self.timeout}s"
+                        )
+                    self._cond.wait(restante)
+            finally:
+                self._esperando -= 1
+
+        if nueva or conn.closed:
+            try:
+                conn = self._conectar()
+            except Exception:
+                with self._cond:
+                    self._total -= 1
+                    self._cond.notify()
+                raise
+
+        espera = time.monotonic() - inicio
+        with self._cond:
+            self._en_uso += 1
+            self._adquisiciones += 1
+            self._espera_total += espera
+            self._espera_max = max(self._espera_max, espera)
+        return conn
+
+    def liberar(self, conn):
+        # Descartar cualquier transacción que el handler haya dejado abierta
+        if not conn.closed:
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                conn.close()
+
+        with self._cond:
+            self._en_uso -= 1
+            if conn.closed or self._cerrado:
+                self._total -= 1
+                if not conn.closed:
+                    conn.close()
+            else:
+                self._libres.append(conn)
+            self._cond.notify()
+
+    def cerrar(self):
+        with self._cond:
+            self._cerrado = True
+            for conn in self._libres:
+                conn.close()
+            self._total -= len(self._libres)
+            self._libres = []
+            self._cond.notify_all()
+
+    def metricas(self):
+        with self._cond:
+            return {
+                "minimo": self.minimo,
+                "maximo": self.maximo,
+                "abiertas": self._total,
+                "libres": len(self._libres),
+                "en_uso": self._en_uso,
+                "esperando": self._esperando,
+                "adquisiciones": self._adquisiciones,
+                "timeouts": self._timeouts,
+                "espera_promedio_ms": round(self._espera_total / self._adquisiciones * 1000, 3)
+                if self._adquisiciones else 0.0,
+                "espera_max_ms": round(self._espera_max * 1000, 3),
+            }
+
+
+_pool = None
+
+
+def iniciar_pool(minimo, maximo, timeout, **parametros_conexion):
+    global _pool
+    _pool = PoolConexiones(minimo, maximo, timeout, **parametros_conexion)
+    return _pool
+
+
+def cerrar_pool():
+    global _pool
+    if _pool is not None:
+        _pool.cerrar()
+        _pool = None
+
+
+def obtener_conexion():
+    if _pool is None:
+        raise PoolAgotadoError("El pool de conexiones no está inicializado")
+    return _pool.adquirir()
+
+
+def liberar_conexion(conn):
+    pool = getattr(conn, "pool", None) or _pool
+    if pool is None:
+        conn.close()
+    else:
+        pool.liberar(conn)
+
+
+def metricas_pool():
+    return _pool.metricas() if _pool is not None else {}
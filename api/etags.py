@@ -0,0 +1,39 @@
+import hashlib
+
+# ETags para GET condicional. El ETag de una respuesta se deriva de la ruta,
+# los parámetros de la consulta y la versión de cada tabla que la respuesta
+# lee (versiones_tablas más las filas aún no compactadas de cambios_tablas,
+# mantenidas por triggers). Así se puede responder 304 con unas pocas
+# lecturas por índice, sin ejecutar la consulta real.
+
+
+def leer_versiones(conn, tablas):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT v.tabla, v.version + (SELECT count(*) FROM cambios_tablas c WHERE c.tabla = v.tabla) AS version
+        FROM versiones_tablas v
+        WHERE v.tabla = ANY(%s)
+    """, (list(tablas),))
+    versiones = {fila["tabla"]: fila["version"] for fila in cur.fetchall()}
+    return [(tabla, versiones.get(tabla, 0)) for tabla in sorted(tablas)]
+
+
+def calcular_etag(ruta, consulta, versiones):
+    base = f"{ruta}?{consulta}|" + ",".join(f"{t}={v}" for t, v in versiones)
+    return '"' + hashlib.sha1(base.encode()).hexdigest() + '"'
+
+
+# Compara contra la cabecera If-None-Match (lista separada por comas, admite
+# "*" y etiquetas débiles W/"...", que para If-None-Match se comparan igual)
+def coincide_etag(if_none_match, etag):
+    if not if_none_match:
+        return False
+    for candidata in if_none_match.split(","):
+        candidata = candidata.strip()
+        if candidata == "*":
+            return True
+        if candidata.startswith("W/"):
+            candidata = candidata[2:]
+        if candidata == etag:
+            return True
+    return False
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import select
+import threading
+
+import psycopg2
+
+# Difusión en vivo de los cambios de estado de equipos (Server-Sent Events).
+#
+# Los triggers de equipos publican cada cambio con NOTIFY en el canal
+# 'equipos_estado' (ver database/init.sql). Cada proceso de la API mantiene
+# una única conexión dedicada con LISTEN en un hilo aparte y reparte los
+# avisos a las colas de los clientes conectados en el event loop; así un
+# cambio hecho por cualquier worker llega a los clientes de todos, y los
+# clientes conectados no ocupan conexiones del pool.
+
+CANAL = "equipos_estado"
+
+# Tipos de evento enviados a los clientes
+EQUIPOS = "equipos"
+RESINCRONIZAR = "resincronizar"  # pudieron perderse avisos: recargar el estado completo
+
+logger = logging.getLogger("inventario.api.eventos")
+
+
+class DifusorEventos:
+    def __init__(self, parametros_conexion, maximo_pendientes=100):
+        self._parametros = parametros_conexion
+        self.maximo_pendientes = maximo_pendientes
+        self._suscriptores = set()
+        self._loop = None
+        self._detener = threading.Event()
+        self._hilo = threading.Thread(target=self._escuchar, name="eventos", daemon=True)
+
+    def iniciar(self, loop):
+        self._loop = loop
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self._hilo.join(timeout=5)
+        # None termina los streams abiertos
+        self._repartir(None)
+
+    # suscribir/cancelar se llaman desde el event loop, igual que _repartir,
+    # así el conjunto de suscriptores no necesita lock
+    def suscribir(self):
+        cola = asyncio.Queue(self.maximo_pendientes)
+        self._suscriptores.add(cola)
+        return cola
+
+    def cancelar(self, cola):
+        self._suscriptores.discard(cola)
+
+    def suscriptores(self):
+        return len(self._suscriptores)
+
+    def _publicar(self, evento):
+        self._loop.call_soon_threadsafe(self._repartir, evento)
+
+    def _repartir(self, evento):
+        for cola in self._suscriptores:
+            try:
+                cola.put_nowait(evento)
+            except asyncio.QueueFull:
+                # Cliente lento: se descartan sus avisos pendientes y se le
+                # pide recargar en lugar de acumular memoria sin límite
+                while not cola.empty():
+                    cola.get_nowait()
+                cola.put_nowait((RESINCRONIZAR, None) if evento is not None else None)
+
+    def _escuchar(self):
+        espera = 1
+        reconectando = False
+        while not self._detener.is_set():
+            try:
+                conn = psycopg2.connect(**self._parametros)
+            except psycopg2.Error as e:
+                logger.warning("no se pudo abrir la conexión de eventos", extra={"motivo": str(e)})
+                self._detener.wait(espera)
+                espera = min(espera * 2, 30)
+                continue
+
+            try:
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {CANAL}")
+                espera = 1
+                if reconectando:
+                    self._publicar((RESINCRONIZAR, None))
+                reconectando = True
+
+                while not self._detener.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._publicar((EQUIPOS, conn.notifies.pop(0).payload))
+            except (psycopg2.Error, OSError, ValueError) as e:
+                logger.warning("conexión de eventos perdida", extra={"motivo": str(e)})
+            finally:
+                conn.close()
@@ -0,0 +1,124 @@
+import csv
+import io
+import json
+import uuid
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+
+import psycopg2.extensions
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse
+
+# Exportación en streaming: las filas se leen con un cursor de servidor (con
+# nombre) en lotes de FILAS_POR_LOTE y se emiten en bloques de ~TAMANO_BLOQUE
+# bytes, así que la memoria usada no depende del tamaño de la tabla.
+
+FILAS_POR_LOTE = 2000
+TAMANO_BLOQUE = 64 * 1024
+
+TIPOS_CONTENIDO = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+def _valor_json(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return float(valor)
+    return str(valor)
+
+
+def _lineas_ndjson(columnas, filas):
+    for fila in filas:
+        yield json.dumps(dict(zip(columnas, fila)), default=_valor_json, ensure_ascii=False) + "\n"
+
+
+def _lineas_csv(columnas, filas):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(columnas)
+    for fila in filas:
+        escritor.writerow(fila)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Encabezado cuando no hay filas
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+# Genera el contenido exportado de `sql` en bloques de bytes. La conexión se
+# obtiene con `obtener` dentro del generador y se libera con `liberar` en su
+# finally: al terminar, si el cliente corta la descarga o si el generador se
+# descarta sin recorrerse. El primer elemento (b"") solo marca que la
+# consulta ya se ejecutó, ver iniciar_exportacion.
+def generar_exportacion(obtener, liberar, sql, params, formato, comprimir=False):
+    conn = obtener()
+    try:
+        cur = conn.cursor(
+            name=f"exportar_{uuid.uuid4().hex}",
+            cursor_factory=psycopg2.extensions.cursor,
+        )
+        cur.itersize = FILAS_POR_LOTE
+        cur.execute(sql, params)
+
+        # Con un cursor de servidor la descripción llega con el primer lote
+        primer_lote = cur.fetchmany(FILAS_POR_LOTE)
+        columnas = [c[0] for c in cur.description]
+        yield b""
+
+        def filas():
+            yield from primer_lote
+            yield from cur
+
+        lineas = _lineas_csv(columnas, filas()) if formato == "csv" else _lineas_ndjson(columnas, filas())
+        compresor = zlib.compressobj(6, zlib.DEFLATED, 31) if comprimir else None
+
+        partes, tamano = [], 0
+        for linea in lineas:
+            partes.append(linea)
+            tamano += len(linea)
+            if tamano >= TAMANO_BLOQUE:
+                bloque = "".join(partes).encode("utf-8")
+                partes, tamano = [], 0
+                if compresor:
+                    bloque = compresor.compress(bloque)
+                if bloque:
+                    yield bloque
+
+        bloque = "".join(partes).encode("utf-8")
+        if compresor:
+            bloque = compresor.compress(bloque) + compresor.flush()
+        if bloque:
+            yield bloque
+        cur.close()
+    finally:
+        liberar(conn)
+
+
+# Avanza la exportación hasta ejecutar la consulta antes de responder: sin
+# conexión libre o con un error de SQL se responde con el error (503, 500) y
+# no con una descarga cortada. Desde aquí la conexión es del generador.
+def iniciar_exportacion(*args, **kwargs):
+    contenido = generar_exportacion(*args, **kwargs)
+    next(contenido)
+    return contenido
+
+
+# StreamingResponse que cierra la exportación al terminar la respuesta. Si el
+# cliente se desconecta, Starlette cancela el envío sin cerrar el generador y
+# la conexión quedaría retenida hasta que el recolector lo libere; aquí se
+# cierra siempre (lo que ejecuta su finally y libera la conexión).
+class RespuestaExportacion(StreamingResponse):
+    def __init__(self, contenido, **kwargs):
+        super().__init__(contenido, **kwargs)
+        self.contenido = contenido
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await run_in_threadpool(self.contenido.close)
@@ -0,0 +1,57 @@
+import multiprocessing
+import os
+import shutil
+
+# Modo producción de la API: gunicorn como gestor de procesos con workers de
+# uvicorn.
+#
+#   gunicorn main:app -c gunicorn.conf.py
+#
+# Cada worker es un proceso con su propio event loop, su pool de conexiones
+# (hasta DB_POOL_MAX), su conexión LISTEN de eventos y sus planificadores en
+# segundo plano, que ya están preparados para ejecutarse en varios workers a
+# la vez. Lo que debe verse igual desde todos los workers se comparte: la
+# caché del catálogo en Redis (CACHE_REDIS_URL, ver docker-compose.prod.yml) y
+# las métricas de Prometheus en PROMETHEUS_MULTIPROC_DIR (abajo). Conexiones a PostgreSQL: API_WORKERS * (DB_POOL_MAX + 1) en la
+# primaria y, con réplica de lectura, hasta API_WORKERS * REPLICA_POOL_MAX en ella.
+#
+# Recarga sin cortar el servicio: `kill -HUP <pid del master>` (en docker,
+# `docker compose kill -s HUP api`) levanta workers nuevos con el código y la
+# configuración actuales y termina los viejos cuando acaban sus peticiones.
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "servidor.WorkerInventario"
+
+# Los workers de uvicorn son asíncronos: con uno por núcleo se aprovecha la
+# CPU sin multiplicar las conexiones a la base de datos
+workers = int(os.getenv("API_WORKERS") or multiprocessing.cpu_count())
+
+# Keep-alive más largo que el de la webapp, que reutiliza sus conexiones a la
+# API (API_POOL_SIZE): si la API cerrara primero, la webapp podría enviar una
+# petición por una conexión que el servidor ya está cerrando
+keepalive = int(os.getenv("API_KEEPALIVE", "75"))
+
+# Segundos que un worker tiene para terminar sus peticiones al apagarse o
+# recargarse (los streams de eventos se cortan antes, ver servidor.py)
+graceful_timeout = int(os.getenv("API_GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("API_WORKER_TIMEOUT", "60"))
+
+accesslog = os.getenv("API_ACCESSLOG")  # "-" para registrar los accesos en stdout
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+
+# Métricas de Prometheus de todos los workers: cada proceso escribe las suyas
+# en PROMETHEUS_MULTIPROC_DIR (heredado por los workers, que importan la
+# aplicación después del fork) y /metrics las agrega. El directorio se vacía
+# al arrancar el master y se descartan las de cada worker que termina.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_api")
+
+
+def on_starting(server):
+    directorio = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directorio, ignore_errors=True)
+    os.makedirs(directorio)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,11 +1,228 @@
-from fastapi import FastAPI, HTTPException
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
+import math
+import os
+import time
+
+from anyio import to_thread
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from starlette.routing import Match
+from psycopg2.errors import ExclusionViolation
 from pydantic import BaseModel
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
+from itertools import starmap
+from typing import List, Optional
+
+from db import (
+    PoolAgotadoError, cerrar_pool, cursor_tuplas, iniciar_pool, liberar_conexion,
+    metricas_pool, obtener_conexion, observar_consultas,
+)
+from cache import crear_backend, crear_cache
+from bajas import PlanificadorBajas
+from carga_masiva import (
+    copiar_filas, filas_repetidas, leer_csv, validar_cambio_estado, validar_equipo_nuevo, validar_lote,
+)
+from contadores import PlanificadorContadores
+from etags import calcular_etag, coincide_etag, leer_versiones
+from eventos import DifusorEventos
+from exportacion import TIPOS_CONTENIDO, RespuestaExportacion, iniciar_exportacion
+from observabilidad import (
+    EVENTOS_CLIENTES, LECTURAS_DESTINO, configurar_logging, iniciar_medicion, logger, observar_peticion,
+    registrar_consulta, registro_metricas,
+)
+from paginacion import consultar_pagina, dia, fecha
+from particiones import PlanificadorParticiones
+from recordatorios import crear_destino
+from replicas import EnrutadorLecturas
+from respuestas import (
+    CambioHistorial, Equipo, EquipoDisponible, EquipoEncontrado, Pagina, Prestamo, RespuestaJSON, responder,
+)
+from tokens import ACCESO, EVENTOS, REFRESCO, FirmadorTokens, TokenInvalido
+from seguridad import (
+    CacheVerificaciones, LimitadorTasa, generar_hash, necesita_rehash, verificar_password,
+)
+from vencimientos import PlanificadorVencimientos
+
+# Conexión a PostgreSQL (pool y conexión de eventos). El valor por defecto
+# solo sirve para el entorno de desarrollo de docker-compose.
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://admin:password123@db:5432/inventario_laboratorio")
+DB_PARAMETROS = dict(dsn=DATABASE_URL)
+
+# Configuración del pool de conexiones y del executor de consultas.
+# Los endpoints que tocan la base de datos son funciones síncronas: FastAPI las
+# ejecuta en su pool de hilos, que se acota aquí para no abrir más hilos de los
+# que el pool de conexiones puede atender.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+API_MAX_HILOS = int(os.getenv("API_MAX_HILOS", str(DB_POOL_MAX * 2)))
+
+# Caché del catálogo de equipos. Por defecto vive en memoria de cada worker
+# (coherente hasta CACHE_TTL segundos entre workers; los endpoints con ETag
+# nunca sirven un cuerpo anterior a su ETag, ver clave_versionada); con
+# CACHE_REDIS_URL, como en docker-compose.prod.yml, las entradas y las
+# invalidaciones se comparten entre todos los workers.
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_MAXIMO = int(os.getenv("CACHE_MAXIMO", "1024"))
+cache_catalogo = crear_cache(CACHE_TTL, CACHE_MAXIMO, os.getenv("CACHE_REDIS_URL"))
+
+# Réplica de lectura (opcional). Con DATABASE_REPLICA_URL los endpoints de
+# consulta pesados (préstamos, historial, exportaciones, estadísticas) leen de
+# ella mientras no vaya más de REPLICA_RETRASO_MAXIMO segundos por detrás de la
+# primaria (se mide cada REPLICA_INTERVALO segundos) y responda; si no, de la
+# primaria. Tras una escritura, el usuario lee de la primaria hasta que la
+# réplica la tiene: con CACHE_REDIS_URL esto vale entre workers, sin él solo
+# en el worker que atendió la escritura.
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+REPLICA_RETRASO_MAXIMO = float(os.getenv("REPLICA_RETRASO_MAXIMO", "5"))
+REPLICA_INTERVALO = float(os.getenv("REPLICA_INTERVALO", "1"))
+REPLICA_POOL_MAX = int(os.getenv("REPLICA_POOL_MAX", str(DB_POOL_MAX)))
+REPLICA_TIMEOUT_CONEXION = int(os.getenv("REPLICA_TIMEOUT_CONEXION", "2"))
+enrutador_lecturas = None
+if DATABASE_REPLICA_URL:
+    enrutador_lecturas = EnrutadorLecturas(
+        dict(dsn=DATABASE_REPLICA_URL, connect_timeout=REPLICA_TIMEOUT_CONEXION),
+        REPLICA_RETRASO_MAXIMO, REPLICA_INTERVALO,
+        crear_backend(REPLICA_RETRASO_MAXIMO + REPLICA_INTERVALO, CACHE_MAXIMO,
+                      os.getenv("CACHE_REDIS_URL"), prefijo="inventario:replica:"),
+        REPLICA_POOL_MAX, DB_POOL_TIMEOUT,
+    )
+
+# Máximo de filas aceptadas por las operaciones masivas
+BULK_MAX_FILAS = int(os.getenv("BULK_MAX_FILAS", "50000"))
+
+# Duración de un préstamo sin reserva y duración máxima de una reserva
+PRESTAMO_DIAS = int(os.getenv("PRESTAMO_DIAS", "7"))
+RESERVAS_MAX_DIAS = int(os.getenv("RESERVAS_MAX_DIAS", "30"))
+
+# Planificador de préstamos vencidos: cada VENCIMIENTOS_INTERVALO segundos
+# (0 lo desactiva) marca los vencidos y envía los recordatorios en lotes
+VENCIMIENTOS_INTERVALO = float(os.getenv("VENCIMIENTOS_INTERVALO", "300"))
+VENCIMIENTOS_LOTE = int(os.getenv("VENCIMIENTOS_LOTE", "500"))
+RECORDATORIOS_DESTINO = os.getenv("RECORDATORIOS_DESTINO", "archivo:/tmp/recordatorios.jsonl")
+RECORDATORIOS_REMITENTE = os.getenv("RECORDATORIOS_REMITENTE", "inventario@laboratorio.edu")
+RECORDATORIOS_MAX_INTENTOS = int(os.getenv("RECORDATORIOS_MAX_INTENTOS", "5"))
+
+# Particiones mensuales de historial_equipos: cada HISTORIAL_MANTENIMIENTO_INTERVALO
+# segundos (0 lo desactiva) se crean las de los próximos HISTORIAL_MESES_ADELANTE
+# meses y se archivan (y exportan a HISTORIAL_ARCHIVO_DIR) las que superan
+# HISTORIAL_RETENCION_MESES. Con HISTORIAL_ARCHIVO_MESES > 0 lo archivado más
+# antiguo se elimina de la base de datos una vez exportado.
+HISTORIAL_MANTENIMIENTO_INTERVALO = float(os.getenv("HISTORIAL_MANTENIMIENTO_INTERVALO", "21600"))
+HISTORIAL_MESES_ADELANTE = int(os.getenv("HISTORIAL_MESES_ADELANTE", "3"))
+HISTORIAL_RETENCION_MESES = int(os.getenv("HISTORIAL_RETENCION_MESES", "12"))
+HISTORIAL_ARCHIVO_DIR = os.getenv("HISTORIAL_ARCHIVO_DIR", "/tmp/archivo_historial")
+HISTORIAL_ARCHIVO_MESES = int(os.getenv("HISTORIAL_ARCHIVO_MESES", "0"))
+
+# Equipos dados de baja: cada EQUIPOS_PURGA_INTERVALO segundos (0 lo desactiva)
+# se eliminan en lotes de EQUIPOS_PURGA_LOTE los dados de baja hace más de
+# EQUIPOS_RETENCION_DIAS, con sus reservas, préstamos e historial
+EQUIPOS_PURGA_INTERVALO = float(os.getenv("EQUIPOS_PURGA_INTERVALO", "3600"))
+EQUIPOS_RETENCION_DIAS = int(os.getenv("EQUIPOS_RETENCION_DIAS", "365"))
+EQUIPOS_PURGA_LOTE = int(os.getenv("EQUIPOS_PURGA_LOTE", "500"))
+
+# Contadores de los triggers (versiones de tablas para los ETags y totales de
+# las estadísticas): cada CONTADORES_INTERVALO segundos se compactan las filas
+# que deja cada escritura. Con 0 no se compactan y esas lecturas se vuelven
+# cada vez más lentas.
+CONTADORES_INTERVALO = float(os.getenv("CONTADORES_INTERVALO", "30"))
+
+# Contraseñas: costo de scrypt (n, r, p) e hilos dedicados a calcularlo, fuera
+# del pool de hilos de la base de datos. Subir LOGIN_SCRYPT_N hace que las
+# contraseñas existentes se rehagan en el siguiente login de cada usuario.
+LOGIN_SCRYPT_N = int(os.getenv("LOGIN_SCRYPT_N", "16384"))
+LOGIN_SCRYPT_R = int(os.getenv("LOGIN_SCRYPT_R", "8"))
+LOGIN_SCRYPT_P = int(os.getenv("LOGIN_SCRYPT_P", "1"))
+LOGIN_HILOS = int(os.getenv("LOGIN_HILOS", str(min(4, os.cpu_count() or 1))))
+executor_hash = ThreadPoolExecutor(LOGIN_HILOS, thread_name_prefix="hash")
+cache_verificaciones = CacheVerificaciones(
+    int(os.getenv("LOGIN_CACHE_MAXIMO", "1024")), float(os.getenv("LOGIN_CACHE_TTL", "300")))
 
-app = FastAPI(title="Sistema de Inventario de Laboratorio - V4")
+# Límite de intentos de login por IP y por usuario (token bucket en memoria,
+# por worker). Con LOGIN_CONFIAR_PROXY la IP se toma de X-Forwarded-For, que
+# envía la webapp; solo debe activarse si la API no es accesible directamente.
+limitador_ip = LimitadorTasa(
+    int(os.getenv("LOGIN_RAFAGA_IP", "20")), float(os.getenv("LOGIN_POR_MINUTO_IP", "30")))
+limitador_usuario = LimitadorTasa(
+    int(os.getenv("LOGIN_RAFAGA_USUARIO", "5")), float(os.getenv("LOGIN_POR_MINUTO_USUARIO", "5")))
+LOGIN_CONFIAR_PROXY = os.getenv("LOGIN_CONFIAR_PROXY", "false").lower() in ("1", "true", "si")
+
+# Tokens de acceso (cortos) y de refresco. Todos los workers deben compartir
+# API_TOKEN_CLAVE; sin ella se usa una clave aleatoria que solo sirve con un
+# único proceso y se pierde al reiniciar.
+API_TOKEN_CLAVE = os.getenv("API_TOKEN_CLAVE")
+firmador_tokens = FirmadorTokens(
+    API_TOKEN_CLAVE.encode() if API_TOKEN_CLAVE else os.urandom(32),
+    int(os.getenv("API_TOKEN_ACCESO_TTL", "900")),
+    int(os.getenv("API_TOKEN_REFRESCO_TTL", str(7 * 24 * 3600))),
+    int(os.getenv("API_TOKEN_EVENTOS_TTL", "60")),
+)
+
+# Stream de cambios de disponibilidad (SSE). Cada worker usa una conexión con
+# LISTEN fuera del pool; EVENTOS_LATIDO es el intervalo de los comentarios que
+# mantienen viva la conexión a través de proxies y detectan clientes caídos.
+EVENTOS_LATIDO = float(os.getenv("EVENTOS_LATIDO", "15"))
+EVENTOS_MAXIMO_PENDIENTES = int(os.getenv("EVENTOS_MAXIMO_PENDIENTES", "100"))
+difusor_eventos = DifusorEventos(DB_PARAMETROS, EVENTOS_MAXIMO_PENDIENTES)
+
+@asynccontextmanager
+async def lifespan(app):
+    configurar_logging()
+    if not API_TOKEN_CLAVE:
+        logger.warning("API_TOKEN_CLAVE no configurada: los tokens solo son válidos en este proceso")
+    observar_consultas(registrar_consulta)
+    to_thread.current_default_thread_limiter().total_tokens = API_MAX_HILOS
+    iniciar_pool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, **DB_PARAMETROS)
+    if enrutador_lecturas is not None:
+        enrutador_lecturas.iniciar()
+    difusor_eventos.iniciar(asyncio.get_running_loop())
+    planificador = None
+    if VENCIMIENTOS_INTERVALO > 0:
+        planificador = PlanificadorVencimientos(
+            VENCIMIENTOS_INTERVALO, VENCIMIENTOS_LOTE,
+            crear_destino(RECORDATORIOS_DESTINO, RECORDATORIOS_REMITENTE),
+            RECORDATORIOS_MAX_INTENTOS,
+        )
+        planificador.iniciar()
+    mantenimiento_historial = None
+    if HISTORIAL_MANTENIMIENTO_INTERVALO > 0:
+        mantenimiento_historial = PlanificadorParticiones(
+            HISTORIAL_MANTENIMIENTO_INTERVALO, HISTORIAL_MESES_ADELANTE,
+            HISTORIAL_RETENCION_MESES, HISTORIAL_ARCHIVO_DIR, HISTORIAL_ARCHIVO_MESES,
+        )
+        mantenimiento_historial.iniciar()
+    purga_equipos = None
+    if EQUIPOS_PURGA_INTERVALO > 0:
+        purga_equipos = PlanificadorBajas(EQUIPOS_PURGA_INTERVALO, EQUIPOS_RETENCION_DIAS, EQUIPOS_PURGA_LOTE)
+        purga_equipos.iniciar()
+    compactacion_contadores = None
+    if CONTADORES_INTERVALO > 0:
+        compactacion_contadores = PlanificadorContadores(CONTADORES_INTERVALO)
+        compactacion_contadores.iniciar()
+    try:
+        yield
+    finally:
+        if planificador is not None:
+            planificador.detener()
+        if mantenimiento_historial is not None:
+            mantenimiento_historial.detener()
+        if purga_equipos is not None:
+            purga_equipos.detener()
+        if compactacion_contadores is not None:
+            compactacion_contadores.detener()
+        difusor_eventos.detener()
+        if enrutador_lecturas is not None:
+            enrutador_lecturas.detener()
+        executor_hash.shutdown(wait=False)
+        cerrar_pool()
+
+app = FastAPI(title="Sistema de Inventario de Laboratorio - V4", lifespan=lifespan,
+              default_response_class=RespuestaJSON)
 
 app.add_middleware(
     CORSMiddleware,
@@ -15,6 +232,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Plantilla de la ruta que atiende la petición ("/equipos/{equipo_id}"), para
+# que las métricas no tengan una serie por cada id
+def ruta_de(scope):
+    for ruta in app.router.routes:
+        coincide, _ = ruta.matches(scope)
+        if coincide == Match.FULL:
+            return ruta.path
+    return "sin_ruta"
+
+# Latencia, consultas SQL y tiempo en base de datos de cada petición
+@app.middleware("http")
+async def medir_peticion(request: Request, call_next):
+    medicion = iniciar_medicion()
+    inicio = time.perf_counter()
+    codigo = 500
+    try:
+        response = await call_next(request)
+        codigo = response.status_code
+        return response
+    finally:
+        observar_peticion(request.method, ruta_de(request.scope), codigo,
+                          time.perf_counter() - inicio, medicion)
+
+# Lectura de lo propio con réplica: la hora de cada escritura correcta de un
+# usuario autenticado se anota al responder (ya confirmada), y sus lecturas
+# siguientes van a la primaria hasta que la réplica la alcanza
+@app.middleware("http")
+async def registrar_escrituras(request: Request, call_next):
+    response = await call_next(request)
+    if (enrutador_lecturas is not None and request.method not in ("GET", "HEAD", "OPTIONS")
+            and response.status_code < 400):
+        usuario_id = getattr(request.state, "usuario_id", None)
+        if usuario_id is not None:
+            await run_in_threadpool(enrutador_lecturas.registrar_escritura, usuario_id)
+    return response
+
 # Modelos
 class LoginRequest(BaseModel):
     username: str
@@ -35,20 +288,47 @@ class PrestamoCreate(BaseModel):
     usuario_id: int
     motivo: str
 
+class PrestamoLoteCreate(BaseModel):
+    equipo_ids: List[int]
+    usuario_id: int
+    motivo: str
+
+class DevolucionLote(BaseModel):
+    prestamo_ids: List[int]
+
+class RefrescoRequest(BaseModel):
+    token_refresco: str
+
+class ReservaCreate(BaseModel):
+    equipo_ids: List[int]
+    usuario_id: int
+    desde: datetime
+    hasta: datetime
+    motivo: str = ""
+
 # Conexión a base de datos
 def get_db_connection():
     try:
-        conn = psycopg2.connect(
-            host="db",
-            database="inventario_laboratorio",
-            user="admin",
-            password="password123",
-            cursor_factory=RealDictCursor
-        )
-        return conn
+        return obtener_conexion()
+    except PoolAgotadoError as e:
+        raise HTTPException(status_code=503, detail=f"Base de datos ocupada: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error de conexión: {str(e)}")
 
+# Conexión de los endpoints con en_replica: de la réplica si leer_en_replica
+# la eligió para la petición, si no de la primaria. Si la réplica falla, el
+# resto de la petición sigue en la primaria (ETag y cuerpo del mismo servidor).
+def get_read_connection(request):
+    if getattr(request.state, "replica", False):
+        conn = enrutador_lecturas.obtener_conexion()
+        if conn is not None:
+            return conn
+        request.state.replica = False
+    return get_db_connection()
+
+def release_db_connection(conn):
+    liberar_conexion(conn)
+
 # Función para registrar en historial - NUEVA EN V4.0
 def registrar_historial(conn, equipo_id, estado_anterior, estado_nuevo, usuario_id, motivo):
     try:
@@ -57,74 +337,350 @@ def registrar_historial(conn, equipo_id, estado_anterior, estado_nuevo, usuario_
             INSERT INTO historial_equipos (equipo_id, estado_anterior, estado_nuevo, usuario_responsable, motivo)
             VALUES (%s, %s, %s, %s, %s)
         """, (equipo_id, estado_anterior, estado_nuevo, usuario_id, motivo))
-        print(f"✅ Historial registrado: {estado_anterior} -> {estado_nuevo} para equipo {equipo_id}")
-    except Exception as e:
-        print(f"❌ Error registrando historial: {str(e)}")
+        logger.debug("historial registrado", extra={
+            "equipo_id": equipo_id, "estado_anterior": estado_anterior, "estado_nuevo": estado_nuevo,
+        })
+    except Exception:
+        logger.exception("error registrando historial", extra={"equipo_id": equipo_id})
         # No lanzar excepción para no interrumpir la operación principal
 
+# Invalida las lecturas cacheadas del catálogo tras un cambio ya confirmado:
+# los listados y conteos siempre, y el detalle solo de los equipos afectados
+def invalidar_catalogo(*equipo_ids):
+    cache_catalogo.invalidar("equipos", *(f"equipo:{equipo_id}" for equipo_id in equipo_ids))
+
+# Ventana de una reserva o de una consulta de disponibilidad. Las fechas sin
+# zona horaria se interpretan en la del servidor de base de datos.
+def validar_periodo(desde, hasta):
+    if desde is None or hasta is None:
+        raise HTTPException(status_code=400, detail="Indica desde y hasta")
+    if (desde.tzinfo is None) != (hasta.tzinfo is None):
+        raise HTTPException(status_code=400, detail="desde y hasta deben indicar la zona horaria las dos o ninguna")
+    if desde >= hasta:
+        raise HTTPException(status_code=400, detail="desde debe ser anterior a hasta")
+
+# GET condicional: dependencia que calcula el ETag de la respuesta a partir de
+# la versión de las tablas que lee y corta con 304 si el cliente ya la tiene,
+# sin ejecutar la consulta del endpoint
+def con_etag(*tablas):
+    def verificar_etag(request: Request, response: Response):
+        conn = get_read_connection(request)
+        try:
+            versiones = leer_versiones(conn, tablas)
+        finally:
+            release_db_connection(conn)
+
+        etag = calcular_etag(request.url.path, request.url.query, versiones)
+        if coincide_etag(request.headers.get("if-none-match"), etag):
+            raise HTTPException(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+        request.state.versiones = versiones
+    return Depends(verificar_etag)
+
+# Clave de caché ligada a las versiones que leyó con_etag. La caché del
+# catálogo es por worker y la invalidación de otro worker no llega a esta, así
+# que sin las versiones en la clave se podría enviar un cuerpo viejo con el
+# ETag nuevo (y después responder 304 sobre ese cuerpo). Con ellas, el cuerpo
+# cacheado se calculó siempre después de leer esas versiones.
+def clave_versionada(request, clave):
+    versiones = getattr(request.state, "versiones", ())
+    return clave + "|" + ",".join(f"{tabla}={version}" for tabla, version in versiones)
+
+# Autorización central: el usuario y su rol salen del token de acceso firmado
+# (cabecera Authorization: Bearer), sin consultar la base de datos. En los
+# endpoints con ETag van antes de con_etag para no responder 304 sin permiso.
+async def usuario_actual(request: Request):
+    esquema, _, token = request.headers.get("authorization", "").partition(" ")
+    if esquema.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Falta el token de acceso",
+                            headers={"WWW-Authenticate": "Bearer"})
+    try:
+        datos = firmador_tokens.verificar(token, ACCESO)
+    except TokenInvalido as e:
+        raise HTTPException(status_code=401, detail=str(e), headers={"WWW-Authenticate": "Bearer"})
+    request.state.usuario_id = int(datos["sub"])
+    return {"id": int(datos["sub"]), "rol": datos["rol"]}
+
+async def requiere_admin(usuario: dict = Depends(usuario_actual)):
+    if usuario["rol"] != "admin":
+        raise HTTPException(status_code=403, detail="Se requieren permisos de administrador")
+    return usuario
+
+# Datos de un usuario (parámetro usuario_id de la ruta o de la consulta): solo
+# el propio usuario o un admin. Sin usuario_id, solo un admin.
+async def requiere_propio_o_admin(usuario_id: Optional[int] = None, usuario: dict = Depends(usuario_actual)):
+    if usuario["rol"] != "admin" and usuario_id != usuario["id"]:
+        raise HTTPException(status_code=403, detail="No tienes permisos para ver datos de otro usuario")
+    return usuario
+
+# Endpoints de solo lectura que pueden ir a la réplica: se decide una vez por
+# petición, antes de con_etag, y el endpoint lee con get_read_connection
+def leer_en_replica(request: Request, usuario: dict = Depends(usuario_actual)):
+    request.state.replica = False
+    if enrutador_lecturas is not None:
+        request.state.replica = enrutador_lecturas.usar_replica(usuario["id"])
+        LECTURAS_DESTINO.labels("replica" if request.state.replica else "primaria").inc()
+
+autenticado = Depends(usuario_actual)
+solo_admin = Depends(requiere_admin)
+propio_o_admin = Depends(requiere_propio_o_admin)
+en_replica = Depends(leer_en_replica)
+
+def emitir_tokens(usuario_id, rol):
+    return {
+        "token_acceso": firmador_tokens.emitir(usuario_id, rol, ACCESO),
+        "token_refresco": firmador_tokens.emitir(usuario_id, rol, REFRESCO),
+        "tipo_token": "bearer",
+        "expira_en": firmador_tokens.ttls[ACCESO],
+    }
+
 # ========== AUTENTICACIÓN ==========
 
-@app.post("/login")
-async def login(login_data: LoginRequest):
+# Hash contra el que se verifica cuando el usuario no existe, para que la
+# respuesta tarde lo mismo y no revele qué usuarios existen
+HASH_FICTICIO = generar_hash("usuario-inexistente", LOGIN_SCRYPT_N, LOGIN_SCRYPT_R, LOGIN_SCRYPT_P)
+
+def ip_cliente(request):
+    if LOGIN_CONFIAR_PROXY and request.headers.get("x-forwarded-for"):
+        return request.headers["x-forwarded-for"].split(",")[0].strip()
+    return request.client.host if request.client else "desconocida"
+
+def buscar_usuario_login(username):
     conn = get_db_connection()
     try:
         cur = conn.cursor()
         cur.execute(
-            "SELECT id, username, nombre_completo, tipo_usuario FROM usuarios WHERE username = %s AND password = %s AND activo = TRUE",
-            (login_data.username, login_data.password)
+            "SELECT id, username, nombre_completo, tipo_usuario, password FROM usuarios WHERE username = %s AND activo = TRUE",
+            (username,)
         )
-        user = cur.fetchone()
-
-        if user:
-            return {
-                "success": True,
-                "message": "Login exitoso",
-                "user": dict(user)
-            }
-        else:
-            raise HTTPException(status_code=401, detail="Usuario o contraseña incorrectos")
+        return cur.fetchone()
     finally:
-        conn.close()
-
-# ========== EQUIPOS ==========
+        release_db_connection(conn)
 
-@app.get("/equipos")
-async def get_equipos():
+def guardar_hash(usuario_id, anterior, nuevo):
     conn = get_db_connection()
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id, nombre, descripcion, estado, created_at FROM equipos ORDER BY id")
-        return cur.fetchall()
+        # Solo si nadie cambió la contraseña mientras se calculaba el hash
+        cur.execute(
+            "UPDATE usuarios SET password = %s WHERE id = %s AND password = %s",
+            (nuevo, usuario_id, anterior)
+        )
+        conn.commit()
     finally:
-        conn.close()
+        release_db_connection(conn)
 
-@app.get("/equipos/disponibles")
-async def get_equipos_disponibles():
-    conn = get_db_connection()
+# El login es asíncrono: el límite de intentos se resuelve en el event loop,
+# la consulta va al pool de hilos de la base de datos y el hash al executor
+# dedicado, así una ráfaga de logins no ocupa los hilos del resto de endpoints
+@app.post("/login")
+async def login(login_data: LoginRequest, request: Request):
+    for limitador, clave in ((limitador_ip, ip_cliente(request)),
+                             (limitador_usuario, login_data.username.lower())):
+        permitido, espera = limitador.consumir(clave)
+        if not permitido:
+            logger.warning("login limitado", extra={"clave": clave})
+            raise HTTPException(
+                status_code=429,
+                detail="Demasiados intentos de inicio de sesión, intenta más tarde",
+                headers={"Retry-After": str(math.ceil(espera))},
+            )
+
+    loop = asyncio.get_running_loop()
+    user = await run_in_threadpool(buscar_usuario_login, login_data.username)
+    almacenado = user["password"] if user else HASH_FICTICIO
+
+    valido = bool(user) and cache_verificaciones.contiene(login_data.username, login_data.password, almacenado)
+    if not valido:
+        valido = await loop.run_in_executor(executor_hash, verificar_password, login_data.password, almacenado)
+        valido = valido and bool(user)
+    if not valido:
+        raise HTTPException(status_code=401, detail="Usuario o contraseña incorrectos")
+
+    # Migración transparente: texto plano o parámetros viejos -> hash actual
+    if necesita_rehash(almacenado, LOGIN_SCRYPT_N, LOGIN_SCRYPT_R, LOGIN_SCRYPT_P):
+        nuevo = await loop.run_in_executor(
+            executor_hash, generar_hash, login_data.password, LOGIN_SCRYPT_N, LOGIN_SCRYPT_R, LOGIN_SCRYPT_P)
+        await run_in_threadpool(guardar_hash, user["id"], almacenado, nuevo)
+        almacenado = nuevo
+    cache_verificaciones.guardar(login_data.username, login_data.password, almacenado)
+
+    return {
+        "success": True,
+        "message": "Login exitoso",
+        "user": {clave: user[clave] for clave in ("id", "username", "nombre_completo", "tipo_usuario")},
+        **emitir_tokens(user["id"], user["tipo_usuario"]),
+    }
+
+# Nuevo par de tokens a partir de uno de refresco. Es el único punto donde se
+# vuelve a leer usuarios: un usuario desactivado o con otro rol lo nota aquí,
+# como mucho API_TOKEN_ACCESO_TTL segundos después del cambio.
+@app.post("/token/refrescar")
+def refrescar_token(datos: RefrescoRequest):
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT id, nombre, descripcion, estado FROM equipos WHERE estado = 'disponible' ORDER BY id")
-        return cur.fetchall()
-    finally:
-        conn.close()
+        refresco = firmador_tokens.verificar(datos.token_refresco, REFRESCO)
+    except TokenInvalido as e:
+        raise HTTPException(status_code=401, detail=str(e))
 
-@app.get("/equipos/{equipo_id}")
-async def get_equipo(equipo_id: int):
     conn = get_db_connection()
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id, nombre, descripcion, estado, created_at FROM equipos WHERE id = %s", (equipo_id,))
-        equipo = cur.fetchone()
-
-        if equipo:
-            return equipo
-        else:
-            raise HTTPException(status_code=404, detail="Equipo no encontrado")
+        cur.execute("SELECT id, tipo_usuario FROM usuarios WHERE id = %s AND activo = TRUE", (int(refresco["sub"]),))
+        user = cur.fetchone()
     finally:
-        conn.close()
+        release_db_connection(conn)
+
+    if not user:
+        raise HTTPException(status_code=401, detail="Usuario inactivo o inexistente")
+    return emitir_tokens(user["id"], user["tipo_usuario"])
+
+# ========== EQUIPOS ==========
+
+@app.get("/equipos", response_model=Pagina[Equipo], dependencies=[autenticado, con_etag("equipos")])
+def get_equipos(
+    request: Request,
+    response: Response,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    estado: Optional[str] = None,
+):
+    def consultar():
+        conn = get_db_connection()
+        try:
+            cur = cursor_tuplas(conn)
+            condiciones, params = ["deleted_at IS NULL"], []
+            if estado:
+                condiciones.append("estado = %s")
+                params.append(estado)
+
+            return consultar_pagina(
+                cur,
+                "SELECT id, nombre, descripcion, estado, created_at FROM equipos",
+                condiciones, params,
+                orden=[("id", "id", int)],
+                limite=limit, cursor=cursor, descendente=False, clase=Equipo,
+            )
+        finally:
+            release_db_connection(conn)
+
+    return responder(cache_catalogo.leer("equipos", clave_versionada(request, f"lista:{limit}:{cursor}:{estado}"), consultar), response)
+
+# Sin parámetros: equipos disponibles ahora. Con desde y hasta: equipos sin
+# reservas ni préstamos que se crucen con esa ventana. Además el equipo tiene
+# que estar disponible ahora o, si la ventana es futura, prestado con un
+# préstamo activo cuya ocupación en reservas (que la ventana no cruza) aún no
+# venció: un equipo en otro estado, prestado sin préstamo o con el préstamo
+# vencido no tiene fecha de vuelta y no cuenta como libre. Una sola consulta:
+# las ocupaciones de la ventana salen de un recorrido de idx_reservas_periodo.
+@app.get("/equipos/disponibles", response_model=List[EquipoDisponible],
+         dependencies=[autenticado, con_etag("equipos", "reservas")])
+def get_equipos_disponibles(request: Request, response: Response, desde: Optional[datetime] = None, hasta: Optional[datetime] = None):
+    if desde is not None or hasta is not None:
+        validar_periodo(desde, hasta)
+        conn = get_db_connection()
+        try:
+            cur = cursor_tuplas(conn)
+            cur.execute("""
+                SELECT e.id, e.nombre, e.descripcion, e.estado
+                FROM equipos e
+                WHERE e.deleted_at IS NULL
+                  AND (e.estado = 'disponible' OR (
+                      %(desde)s::timestamptz > CURRENT_TIMESTAMP AND e.estado = 'prestado'
+                      AND EXISTS (
+                          SELECT 1 FROM prestamos p
+                          JOIN reservas r ON r.prestamo_id = p.id AND r.estado = 'en_prestamo'
+                          WHERE p.equipo_id = e.id AND p.estado = 'activo'
+                            AND upper(r.periodo) > CURRENT_TIMESTAMP
+                      )
+                  ))
+                  AND NOT EXISTS (
+                      SELECT 1 FROM reservas r
+                      WHERE r.equipo_id = e.id AND r.estado IN ('activa', 'en_prestamo')
+                        AND r.periodo && tstzrange(%(desde)s, %(hasta)s)
+                  )
+                ORDER BY e.id
+            """, {"desde": desde, "hasta": hasta})
+            return responder(list(starmap(EquipoDisponible, cur.fetchall())), response)
+        finally:
+            release_db_connection(conn)
+
+    def consultar():
+        conn = get_db_connection()
+        try:
+            cur = cursor_tuplas(conn)
+            cur.execute("SELECT id, nombre, descripcion, estado FROM equipos WHERE estado = 'disponible' AND deleted_at IS NULL ORDER BY id")
+            return list(starmap(EquipoDisponible, cur.fetchall()))
+        finally:
+            release_db_connection(conn)
+
+    return responder(cache_catalogo.leer("equipos", clave_versionada(request, "disponibles"), consultar), response)
+
+# Búsqueda en nombre y descripción: texto completo (índice GIN sobre
+# equipos.busqueda) más coincidencia aproximada del nombre por trigramas para
+# los errores de tipeo. Ordenada por relevancia y paginada por (relevancia, id).
+@app.get("/equipos/buscar", response_model=Pagina[EquipoEncontrado], dependencies=[autenticado, con_etag("equipos")])
+def buscar_equipos(
+    request: Request,
+    response: Response,
+    q: str = Query(..., min_length=2, max_length=100),
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    estado: Optional[str] = None,
+):
+    q = " ".join(q.split())
+
+    def consultar():
+        conn = get_db_connection()
+        try:
+            cur = cursor_tuplas(conn)
+            condiciones, params = [], [q, q]
+            if estado:
+                condiciones.append("estado = %s")
+                params.append(estado)
 
-@app.post("/equipos")
-async def crear_equipo(equipo: EquipoCreate):
+            # La relevancia va como float8 para que el valor del cursor vuelva
+            # exacto a la comparación de la página siguiente
+            return consultar_pagina(
+                cur,
+                """SELECT * FROM (
+                       SELECT e.id, e.nombre, e.descripcion, e.estado, e.created_at,
+                              (ts_rank(e.busqueda, b.consulta) + word_similarity(b.texto, e.nombre))::float8 AS relevancia
+                       FROM equipos e,
+                            (SELECT websearch_to_tsquery('spanish', %s) AS consulta, %s::text AS texto) b
+                       WHERE e.deleted_at IS NULL AND (e.busqueda @@ b.consulta OR b.texto <%% e.nombre)
+                   ) AS resultados""",
+                condiciones, params,
+                orden=[("relevancia", "relevancia", float), ("id", "id", int)],
+                limite=limit, cursor=cursor, descendente=True, clase=EquipoEncontrado,
+            )
+        finally:
+            release_db_connection(conn)
+
+    return responder(cache_catalogo.leer(
+        "equipos", clave_versionada(request, f"buscar:{q.lower()}:{limit}:{cursor}:{estado}"), consultar,
+    ), response)
+
+@app.get("/equipos/{equipo_id}", response_model=Equipo, dependencies=[autenticado, con_etag("equipos")])
+def get_equipo(request: Request, response: Response, equipo_id: int):
+    def consultar():
+        conn = get_db_connection()
+        try:
+            cur = cursor_tuplas(conn)
+            cur.execute("SELECT id, nombre, descripcion, estado, created_at FROM equipos WHERE id = %s AND deleted_at IS NULL", (equipo_id,))
+            equipo = cur.fetchone()
+
+            if equipo:
+                return Equipo(*equipo)
+            else:
+                raise HTTPException(status_code=404, detail="Equipo no encontrado")
+        finally:
+            release_db_connection(conn)
+
+    return responder(cache_catalogo.leer(f"equipo:{equipo_id}", clave_versionada(request, "detalle"), consultar), response)
+
+@app.post("/equipos", dependencies=[solo_admin])
+def crear_equipo(equipo: EquipoCreate):
     conn = get_db_connection()
     try:
         cur = conn.cursor()
@@ -138,21 +694,165 @@ async def crear_equipo(equipo: EquipoCreate):
         registrar_historial(conn, equipo_id, 'nuevo', equipo.estado, None, f"Equipo creado: {equipo.nombre}")
 
         conn.commit()
+        invalidar_catalogo()
         return {"id": equipo_id, "message": "Equipo creado exitosamente"}
     except Exception as e:
         conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        conn.close()
+        release_db_connection(conn)
+
+# Importación masiva: JSON (lista de equipos) o CSV con columnas
+# nombre,descripcion,estado (cuerpo text/csv o archivo multipart "archivo").
+# Todo el lote se valida antes de escribir y se inserta en una transacción.
+@app.post("/equipos/bulk", dependencies=[solo_admin])
+async def crear_equipos_bulk(request: Request):
+    tipo = request.headers.get("content-type", "")
+    try:
+        if tipo.startswith("multipart/form-data"):
+            formulario = await request.form()
+            archivo = formulario.get("archivo")
+            if archivo is None or isinstance(archivo, str):
+                raise HTTPException(status_code=400, detail="Falta el archivo CSV 'archivo'")
+            filas = leer_csv(await archivo.read())
+        elif tipo.startswith("text/csv"):
+            filas = leer_csv(await request.body())
+        else:
+            filas = await request.json()
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Contenido inválido: {str(e)}")
+
+    if not isinstance(filas, list) or not filas:
+        raise HTTPException(status_code=400, detail="Se esperaba una lista de equipos no vacía")
+    if len(filas) > BULK_MAX_FILAS:
+        raise HTTPException(status_code=413, detail=f"Máximo {BULK_MAX_FILAS} equipos por lote")
 
-@app.put("/equipos/{equipo_id}")
-async def actualizar_equipo(equipo_id: int, equipo: EquipoUpdate):
+    equipos, errores = validar_lote(filas, validar_equipo_nuevo)
+    if errores:
+        raise HTTPException(status_code=422, detail={"message": "Lote rechazado", "errores": errores})
+
+    return await run_in_threadpool(insertar_equipos_bulk, equipos)
+
+def insertar_equipos_bulk(equipos):
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TEMP TABLE carga_equipos (
+                orden INTEGER, nombre VARCHAR(100), descripcion TEXT, estado VARCHAR(20)
+            ) ON COMMIT DROP
+        """)
+        # Descripción vacía como "", igual que POST /equipos
+        copiar_filas(cur, "carga_equipos", ("orden", "nombre", "descripcion", "estado"),
+                     ((i, *equipo) for i, equipo in enumerate(equipos)), no_nulas=("descripcion",))
+
+        # Equipos e historial en una sola sentencia
+        cur.execute("""
+            WITH nuevos AS (
+                INSERT INTO equipos (nombre, descripcion, estado)
+                SELECT nombre, descripcion, estado FROM carga_equipos ORDER BY orden
+                RETURNING id, nombre, estado
+            ), historial AS (
+                INSERT INTO historial_equipos (equipo_id, estado_anterior, estado_nuevo, usuario_responsable, motivo)
+                SELECT id, 'nuevo', estado, NULL, 'Equipo creado: ' || nombre FROM nuevos
+            )
+            SELECT id FROM nuevos ORDER BY id
+        """)
+        ids = [fila['id'] for fila in cur.fetchall()]
+
+        conn.commit()
+        invalidar_catalogo()
+        return {"creados": len(ids), "ids": ids, "message": "Equipos creados exitosamente"}
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        release_db_connection(conn)
+
+# Cambio de estado masivo: lista de {id, estado, motivo}. Los equipos se
+# bloquean en orden de id y el lote se aplica completo o no se aplica.
+@app.patch("/equipos/bulk", dependencies=[solo_admin])
+def actualizar_equipos_bulk(cambios: List[dict]):
+    if not cambios:
+        raise HTTPException(status_code=400, detail="Se esperaba una lista de cambios no vacía")
+    if len(cambios) > BULK_MAX_FILAS:
+        raise HTTPException(status_code=413, detail=f"Máximo {BULK_MAX_FILAS} cambios por lote")
+
+    filas, errores = validar_lote(cambios, validar_cambio_estado)
+    if not errores:
+        errores = filas_repetidas(filas)
+    if errores:
+        raise HTTPException(status_code=422, detail={"message": "Lote rechazado", "errores": errores})
+
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TEMP TABLE cambios_estado (
+                orden INTEGER, id INTEGER, estado VARCHAR(20), motivo TEXT
+            ) ON COMMIT DROP
+        """)
+        copiar_filas(cur, "cambios_estado", ("orden", "id", "estado", "motivo"),
+                     ((i, *fila) for i, fila in enumerate(filas, start=1)))
+
+        # Bloquear en orden determinista y detectar ids inexistentes
+        cur.execute("""
+            SELECT c.orden, c.id, e.id IS NOT NULL AS existe
+            FROM cambios_estado c
+            LEFT JOIN (
+                SELECT e.id FROM equipos e JOIN cambios_estado c ON c.id = e.id
+                WHERE e.deleted_at IS NULL
+                ORDER BY e.id FOR UPDATE OF e
+            ) e ON e.id = c.id
+        """)
+        faltantes = [
+            {"fila": fila['orden'], "errores": [f"Equipo {fila['id']} no encontrado"]}
+            for fila in cur.fetchall() if not fila['existe']
+        ]
+        if faltantes:
+            conn.rollback()
+            raise HTTPException(status_code=422, detail={"message": "Lote rechazado", "errores": faltantes})
+
+        cur.execute("""
+            WITH cambios AS (
+                SELECT e.id, e.estado AS estado_anterior, c.estado, c.motivo
+                FROM equipos e JOIN cambios_estado c ON c.id = e.id
+                WHERE e.estado IS DISTINCT FROM c.estado AND e.deleted_at IS NULL
+            ), actualizados AS (
+                UPDATE equipos e SET estado = c.estado
+                FROM cambios c WHERE e.id = c.id
+                RETURNING e.id
+            )
+            INSERT INTO historial_equipos (equipo_id, estado_anterior, estado_nuevo, usuario_responsable, motivo)
+            SELECT id, estado_anterior, estado, NULL, COALESCE(motivo, 'Cambio de estado masivo')
+            FROM cambios
+            RETURNING equipo_id
+        """)
+        actualizados = [fila['equipo_id'] for fila in cur.fetchall()]
+
+        conn.commit()
+        invalidar_catalogo(*actualizados)
+        return {
+            "actualizados": len(actualizados),
+            "sin_cambios": len(filas) - len(actualizados),
+            "message": "Estados actualizados exitosamente",
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        release_db_connection(conn)
+
+@app.put("/equipos/{equipo_id}", dependencies=[solo_admin])
+def actualizar_equipo(equipo_id: int, equipo: EquipoUpdate):
     conn = get_db_connection()
     try:
         cur = conn.cursor()
 
         # Verificar que el equipo existe y obtener estado actual
-        cur.execute("SELECT estado FROM equipos WHERE id = %s", (equipo_id,))
+        cur.execute("SELECT estado FROM equipos WHERE id = %s AND deleted_at IS NULL", (equipo_id,))
         equipo_actual = cur.fetchone()
         if not equipo_actual:
             raise HTTPException(status_code=404, detail="Equipo no encontrado")
@@ -170,204 +870,991 @@ async def actualizar_equipo(equipo_id: int, equipo: EquipoUpdate):
             registrar_historial(conn, equipo_id, estado_anterior, equipo.estado, None, "Equipo actualizado")
 
         conn.commit()
+        invalidar_catalogo(equipo_id)
         return {"message": "Equipo actualizado exitosamente"}
+    except HTTPException:
+        conn.rollback()
+        raise
     except Exception as e:
         conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        conn.close()
+        release_db_connection(conn)
 
-@app.delete("/equipos/{equipo_id}")
-async def eliminar_equipo(equipo_id: int):
+@app.delete("/equipos/{equipo_id}", dependencies=[solo_admin])
+def eliminar_equipo(equipo_id: int):
     conn = get_db_connection()
     try:
         cur = conn.cursor()
 
-        # Verificar que el equipo existe
-        cur.execute("SELECT id FROM equipos WHERE id = %s", (equipo_id,))
+        # Baja lógica: el equipo sale del catálogo, pero préstamos e historial
+        # lo siguen referenciando hasta que, pasados EQUIPOS_RETENCION_DIAS, la
+        # purga lo elimina junto con todo lo que lo referencia (ver bajas.py). Un
+        # equipo con un préstamo activo no se puede dar de baja. La condición
+        # sobre estado va en la propia fila: si un préstamo concurrente la
+        # bloquea y confirma, la re-evaluación tras el lock solo vuelve a leer
+        # esa fila, no la subconsulta sobre prestamos.
+        cur.execute("""
+            UPDATE equipos SET deleted_at = CURRENT_TIMESTAMP
+            WHERE id = %(equipo_id)s AND deleted_at IS NULL AND estado <> 'prestado'
+              AND NOT EXISTS (SELECT 1 FROM prestamos WHERE equipo_id = %(equipo_id)s AND estado = 'activo')
+            RETURNING id
+        """, {"equipo_id": equipo_id})
         if not cur.fetchone():
-            raise HTTPException(status_code=404, detail="Equipo no encontrado")
+            conn.rollback()
+            cur.execute("SELECT id FROM equipos WHERE id = %s AND deleted_at IS NULL", (equipo_id,))
+            if not cur.fetchone():
+                raise HTTPException(status_code=404, detail="Equipo no encontrado")
+            raise HTTPException(status_code=400, detail="El equipo tiene un préstamo activo")
 
-        # Registrar en historial antes de eliminar
+        cur.execute("UPDATE reservas SET estado = 'cancelada' WHERE equipo_id = %s AND estado = 'activa'", (equipo_id,))
         registrar_historial(conn, equipo_id, 'existente', 'eliminado', None, "Equipo eliminado del sistema")
-
-        # Eliminar equipo
-        cur.execute("DELETE FROM equipos WHERE id = %s", (equipo_id,))
         conn.commit()
+        invalidar_catalogo(equipo_id)
         return {"message": "Equipo eliminado exitosamente"}
+    except HTTPException:
+        conn.rollback()
+        raise
     except Exception as e:
         conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        conn.close()
+        release_db_connection(conn)
 
-@app.get("/equipos/disponibles/count")
-async def count_equipos_disponibles():
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) as total FROM equipos WHERE estado = 'disponible'")
-        result = cur.fetchone()
-        return {"equipos_disponibles": result['total']}
-    finally:
-        conn.close()
+@app.get("/equipos/disponibles/count", dependencies=[autenticado, con_etag("equipos")])
+def count_equipos_disponibles(request: Request):
+    def consultar():
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*) as total FROM equipos WHERE estado = 'disponible' AND deleted_at IS NULL")
+            result = cur.fetchone()
+            return {"equipos_disponibles": result['total']}
+        finally:
+            release_db_connection(conn)
+
+    return cache_catalogo.leer("equipos", clave_versionada(request, "disponibles:conteo"), consultar)
 # ========== PRÉSTAMOS ==========
 
-@app.get("/prestamos")
-async def get_prestamos():
-    conn = get_db_connection()
+@app.get("/prestamos", response_model=Pagina[Prestamo],
+         dependencies=[propio_o_admin, en_replica, con_etag("prestamos", "equipos", "usuarios")])
+def get_prestamos(
+    request: Request,
+    response: Response,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    estado: Optional[str] = None,
+    usuario_id: Optional[int] = None,
+    equipo_id: Optional[int] = None,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+):
+    conn = get_read_connection(request)
     try:
-        cur = conn.cursor()
-        cur.execute("""
+        cur = cursor_tuplas(conn)
+        condiciones, params = [], []
+        if estado:
+            condiciones.append("p.estado = %s")
+            params.append(estado)
+        if usuario_id is not None:
+            condiciones.append("p.usuario_id = %s")
+            params.append(usuario_id)
+        if equipo_id is not None:
+            condiciones.append("p.equipo_id = %s")
+            params.append(equipo_id)
+        if desde:
+            condiciones.append("p.fecha_prestamo >= %s")
+            params.append(desde)
+        if hasta:
+            condiciones.append("p.fecha_prestamo < %s")
+            params.append(hasta)
+
+        return responder(consultar_pagina(
+            cur,
+            """
             SELECT p.id, p.equipo_id, p.usuario_id, p.motivo_prestamo as motivo,
                    p.fecha_prestamo, p.fecha_devolucion_real as fecha_devolucion,
                    p.estado, e.nombre as equipo_nombre, u.nombre_completo as usuario_nombre
             FROM prestamos p
             JOIN equipos e ON p.equipo_id = e.id
             JOIN usuarios u ON p.usuario_id = u.id
-            ORDER BY p.fecha_prestamo DESC
-        """)
-        return cur.fetchall()
+            """,
+            condiciones, params,
+            orden=[("p.fecha_prestamo", "fecha_prestamo", fecha), ("p.id", "id", int)],
+            limite=limit, cursor=cursor, clase=Prestamo,
+        ), response)
     finally:
-        conn.close()
+        release_db_connection(conn)
 
-@app.get("/prestamos/usuario/{usuario_id}")
-async def get_prestamos_usuario(usuario_id: int):
-    conn = get_db_connection()
+# Préstamos activos cuya fecha de devolución ya pasó, del más atrasado al más
+# reciente (índice parcial idx_prestamos_vencimiento)
+@app.get("/prestamos/vencidos", dependencies=[propio_o_admin, en_replica])
+def get_prestamos_vencidos(
+    request: Request,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    usuario_id: Optional[int] = None,
+):
+    conn = get_read_connection(request)
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT p.id, p.equipo_id, p.motivo_prestamo as motivo,
-                   p.fecha_prestamo, p.fecha_devolucion_real as fecha_devolucion,
-                   p.estado, e.nombre as equipo_nombre
+        condiciones = ["p.estado = 'activo'", "p.fecha_devolucion_esperada < CURRENT_DATE"]
+        params = []
+        if usuario_id is not None:
+            condiciones.append("p.usuario_id = %s")
+            params.append(usuario_id)
+
+        return consultar_pagina(
+            cur,
+            """
+            SELECT p.id, p.equipo_id, p.usuario_id, p.fecha_prestamo, p.fecha_devolucion_esperada,
+                   CURRENT_DATE - p.fecha_devolucion_esperada AS dias_vencido,
+                   p.fecha_aviso_vencimiento, e.nombre as equipo_nombre,
+                   u.nombre_completo as usuario_nombre, u.email as usuario_email
             FROM prestamos p
             JOIN equipos e ON p.equipo_id = e.id
-            WHERE p.usuario_id = %s
-            ORDER BY p.fecha_prestamo DESC
-        """, (usuario_id,))
-        return cur.fetchall()
+            JOIN usuarios u ON p.usuario_id = u.id
+            """,
+            condiciones, params,
+            orden=[("p.fecha_devolucion_esperada", "fecha_devolucion_esperada", dia), ("p.id", "id", int)],
+            limite=limit, cursor=cursor, descendente=False,
+        )
     finally:
-        conn.close()
+        release_db_connection(conn)
+
+# Préstamos de un usuario: el mismo listado paginado de /prestamos, filtrado
+# por usuario_id
+@app.get("/prestamos/usuario/{usuario_id}", response_model=Pagina[Prestamo],
+         dependencies=[propio_o_admin, en_replica, con_etag("prestamos", "equipos", "usuarios")])
+def get_prestamos_usuario(
+    request: Request,
+    response: Response,
+    usuario_id: int,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    estado: Optional[str] = None,
+):
+    return get_prestamos(request, response, limit=limit, cursor=cursor, estado=estado, usuario_id=usuario_id,
+                         equipo_id=None, desde=None, hasta=None)
 
 @app.post("/prestamos")
-async def crear_prestamo(prestamo: PrestamoCreate):
+def crear_prestamo(prestamo: PrestamoCreate, usuario: dict = autenticado):
+    # Un usuario solo pide préstamos a su nombre; un admin puede registrarlos para otros
+    if usuario["rol"] != "admin" and prestamo.usuario_id != usuario["id"]:
+        raise HTTPException(status_code=403, detail="No puedes solicitar préstamos a nombre de otro usuario")
+
     conn = get_db_connection()
     try:
         cur = conn.cursor()
 
-        # Verificar equipo disponible
-        cur.execute("SELECT estado, nombre FROM equipos WHERE id = %s", (prestamo.equipo_id,))
-        equipo = cur.fetchone()
+        # Préstamo atómico en un solo viaje: el UPDATE condicional solo toma el
+        # equipo si sigue disponible y el usuario está activo. Dos préstamos
+        # concurrentes del mismo equipo se serializan en el lock de la fila y
+        # el segundo re-evalúa la condición después del commit del primero,
+        # así que solo uno gana. Préstamo e historial se insertan en la misma
+        # sentencia a partir de la fila actualizada.
+        #
+        # El préstamo ocupa el equipo en reservas: si el usuario tiene una
+        # reserva vigente del equipo, hasta el fin de esa reserva (que pasa a
+        # 'en_prestamo'); si no, PRESTAMO_DIAS días o hasta que empiece la
+        # próxima reserva. Una reserva de otro usuario vigente ahora hace
+        # fallar la inserción por la restricción de exclusión.
+        cur.execute("""
+            WITH reserva AS (
+                SELECT id, upper(periodo) AS fin FROM reservas
+                WHERE equipo_id = %(equipo_id)s AND usuario_id = %(usuario_id)s
+                  AND estado = 'activa' AND periodo @> CURRENT_TIMESTAMP
+            ), ocupacion AS (
+                SELECT tstzrange(CURRENT_TIMESTAMP, COALESCE(
+                    (SELECT fin FROM reserva),
+                    LEAST(
+                        CURRENT_TIMESTAMP + %(dias)s * interval '1 day',
+                        (SELECT min(lower(periodo)) FROM reservas
+                         WHERE equipo_id = %(equipo_id)s AND estado = 'activa'
+                           AND lower(periodo) > CURRENT_TIMESTAMP)
+                    )
+                )) AS periodo
+            ), equipo AS (
+                UPDATE equipos SET estado = 'prestado'
+                WHERE id = %(equipo_id)s AND estado = 'disponible' AND deleted_at IS NULL
+                  AND EXISTS (SELECT 1 FROM usuarios WHERE id = %(usuario_id)s AND activo = TRUE)
+                RETURNING id
+            ), nuevo AS (
+                INSERT INTO prestamos (equipo_id, usuario_id, fecha_devolucion_esperada, motivo_prestamo, estado)
+                SELECT e.id, %(usuario_id)s, upper(o.periodo)::date, %(motivo)s, 'activo'
+                FROM equipo e, ocupacion o
+                RETURNING id, equipo_id, fecha_devolucion_esperada
+            ), reserva_usada AS (
+                UPDATE reservas r SET estado = 'en_prestamo', prestamo_id = n.id, periodo = o.periodo
+                FROM nuevo n, ocupacion o
+                WHERE r.id = (SELECT id FROM reserva)
+            ), reserva_nueva AS (
+                INSERT INTO reservas (equipo_id, usuario_id, periodo, motivo, estado, prestamo_id)
+                SELECT n.equipo_id, %(usuario_id)s, o.periodo, %(motivo)s, 'en_prestamo', n.id
+                FROM nuevo n, ocupacion o
+                WHERE NOT EXISTS (SELECT 1 FROM reserva)
+            ), historial AS (
+                INSERT INTO historial_equipos (equipo_id, estado_anterior, estado_nuevo, usuario_responsable, motivo)
+                SELECT equipo_id, 'disponible', 'prestado', %(usuario_id)s, %(motivo_historial)s FROM nuevo
+            )
+            SELECT id, fecha_devolucion_esperada FROM nuevo
+        """, {
+            "equipo_id": prestamo.equipo_id,
+            "usuario_id": prestamo.usuario_id,
+            "dias": PRESTAMO_DIAS,
+            "motivo": prestamo.motivo,
+            "motivo_historial": f"Préstamo: {prestamo.motivo}",
+        })
+        nuevo = cur.fetchone()
 
-        if not equipo:
-            raise HTTPException(status_code=404, detail="Equipo no encontrado")
+        if not nuevo:
+            # Solo en el camino de error: averiguar por qué no se pudo prestar
+            conn.rollback()
+            cur.execute("SELECT estado FROM equipos WHERE id = %s AND deleted_at IS NULL", (prestamo.equipo_id,))
+            equipo = cur.fetchone()
+            if not equipo:
+                raise HTTPException(status_code=404, detail="Equipo no encontrado")
+            if equipo['estado'] != 'disponible':
+                raise HTTPException(status_code=400, detail="El equipo no está disponible")
+            raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
-        if equipo['estado'] != 'disponible':
-            raise HTTPException(status_code=400, detail="El equipo no está disponible")
+        conn.commit()
+        invalidar_catalogo(prestamo.equipo_id)
+        return {
+            "id": nuevo['id'],
+            "fecha_devolucion_esperada": nuevo['fecha_devolucion_esperada'],
+            "message": "Préstamo creado exitosamente",
+        }
 
-        # Verificar usuario existe
-        cur.execute("SELECT nombre_completo FROM usuarios WHERE id = %s AND activo = TRUE", (prestamo.usuario_id,))
-        usuario = cur.fetchone()
+    except HTTPException:
+        conn.rollback()
+        raise
+    except ExclusionViolation:
+        conn.rollback()
+        raise HTTPException(status_code=409, detail="El equipo está reservado por otro usuario en este momento")
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        release_db_connection(conn)
 
-        if not usuario:
-            raise HTTPException(status_code=404, detail="Usuario no encontrado")
+# Préstamo de un kit: varios equipos para el mismo usuario, todos o ninguno.
+# Los equipos se bloquean en orden de id (dos lotes que se cruzan no pueden
+# bloquearse mutuamente), y préstamos, reservas e historial se insertan en una
+# sola sentencia con la misma lógica de ocupación que POST /prestamos.
+@app.post("/prestamos/lote")
+def crear_prestamos_lote(lote: PrestamoLoteCreate, usuario: dict = autenticado):
+    if usuario["rol"] != "admin" and lote.usuario_id != usuario["id"]:
+        raise HTTPException(status_code=403, detail="No puedes solicitar préstamos a nombre de otro usuario")
+    equipo_ids = sorted(set(lote.equipo_ids))
+    if not equipo_ids:
+        raise HTTPException(status_code=400, detail="Se esperaba al menos un equipo")
+    if len(equipo_ids) > BULK_MAX_FILAS:
+        raise HTTPException(status_code=413, detail=f"Máximo {BULK_MAX_FILAS} equipos por lote")
 
-        # Crear préstamo
-        fecha_devolucion = date.today() + timedelta(days=7)
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
         cur.execute("""
-            INSERT INTO prestamos (equipo_id, usuario_id, fecha_devolucion_esperada, motivo_prestamo, estado)
-            VALUES (%s, %s, %s, %s, 'activo') RETURNING id
-        """, (prestamo.equipo_id, prestamo.usuario_id, fecha_devolucion, prestamo.motivo))
+            SELECT id, estado FROM equipos
+            WHERE id = ANY(%s) AND deleted_at IS NULL
+            ORDER BY id FOR UPDATE
+        """, (equipo_ids,))
+        estados = {fila['id']: fila['estado'] for fila in cur.fetchall()}
+        faltantes = [i for i in equipo_ids if i not in estados]
+        if faltantes:
+            raise HTTPException(status_code=404, detail={"message": "Equipos no encontrados", "equipos": faltantes})
+        ocupados = [i for i in equipo_ids if estados[i] != 'disponible']
+        if ocupados:
+            raise HTTPException(status_code=400, detail={"message": "Equipos no disponibles", "equipos": ocupados})
+        cur.execute("SELECT 1 FROM usuarios WHERE id = %s AND activo = TRUE", (lote.usuario_id,))
+        if not cur.fetchone():
+            raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
-        prestamo_id = cur.fetchone()['id']
+        try:
+            cur.execute("""
+                WITH reserva AS (
+                    SELECT equipo_id, id, upper(periodo) AS fin FROM reservas
+                    WHERE equipo_id = ANY(%(equipo_ids)s) AND usuario_id = %(usuario_id)s
+                      AND estado = 'activa' AND periodo @> CURRENT_TIMESTAMP
+                ), ocupacion AS (
+                    SELECT o.equipo_id, r.id AS reserva_id, tstzrange(CURRENT_TIMESTAMP, COALESCE(
+                        r.fin,
+                        LEAST(
+                            CURRENT_TIMESTAMP + %(dias)s * interval '1 day',
+                            (SELECT min(lower(periodo)) FROM reservas
+                             WHERE equipo_id = o.equipo_id AND estado = 'activa'
+                               AND lower(periodo) > CURRENT_TIMESTAMP)
+                        )
+                    )) AS periodo
+                    FROM unnest(%(equipo_ids)s::int[]) AS o(equipo_id)
+                    LEFT JOIN reserva r ON r.equipo_id = o.equipo_id
+                ), equipo AS (
+                    UPDATE equipos e SET estado = 'prestado'
+                    FROM ocupacion o WHERE e.id = o.equipo_id
+                ), nuevo AS (
+                    INSERT INTO prestamos (equipo_id, usuario_id, fecha_devolucion_esperada, motivo_prestamo, estado)
+                    SELECT equipo_id, %(usuario_id)s, upper(periodo)::date, %(motivo)s, 'activo'
+                    FROM ocupacion ORDER BY equipo_id
+                    RETURNING id, equipo_id, fecha_devolucion_esperada
+                ), reserva_usada AS (
+                    UPDATE reservas r SET estado = 'en_prestamo', prestamo_id = n.id, periodo = o.periodo
+                    FROM nuevo n JOIN ocupacion o ON o.equipo_id = n.equipo_id
+                    WHERE r.id = o.reserva_id
+                ), reserva_nueva AS (
+                    INSERT INTO reservas (equipo_id, usuario_id, periodo, motivo, estado, prestamo_id)
+                    SELECT n.equipo_id, %(usuario_id)s, o.periodo, %(motivo)s, 'en_prestamo', n.id
+                    FROM nuevo n JOIN ocupacion o ON o.equipo_id = n.equipo_id
+                    WHERE o.reserva_id IS NULL
+                ), historial AS (
+                    INSERT INTO historial_equipos (equipo_id, estado_anterior, estado_nuevo, usuario_responsable, motivo)
+                    SELECT equipo_id, 'disponible', 'prestado', %(usuario_id)s, %(motivo_historial)s FROM nuevo
+                )
+                SELECT id, equipo_id, fecha_devolucion_esperada FROM nuevo ORDER BY equipo_id
+            """, {
+                "equipo_ids": equipo_ids,
+                "usuario_id": lote.usuario_id,
+                "dias": PRESTAMO_DIAS,
+                "motivo": lote.motivo,
+                "motivo_historial": f"Préstamo: {lote.motivo}",
+            })
+        except ExclusionViolation:
+            # Solo en el camino de error: qué equipos están reservados por otro ahora
+            conn.rollback()
+            cur.execute("""
+                SELECT DISTINCT equipo_id FROM reservas
+                WHERE equipo_id = ANY(%s) AND usuario_id <> %s
+                  AND estado IN ('activa', 'en_prestamo') AND periodo @> CURRENT_TIMESTAMP
+                ORDER BY equipo_id
+            """, (equipo_ids, lote.usuario_id))
+            raise HTTPException(status_code=409, detail={
+                "message": "Hay equipos reservados por otro usuario en este momento",
+                "equipos": [fila['equipo_id'] for fila in cur.fetchall()],
+            })
+        prestamos = cur.fetchall()
 
-        # Cambiar estado del equipo
-        cur.execute("UPDATE equipos SET estado = 'prestado' WHERE id = %s", (prestamo.equipo_id,))
+        conn.commit()
+        invalidar_catalogo(*equipo_ids)
+        return {"prestamos": prestamos, "message": "Préstamos creados exitosamente"}
 
-        # Registrar en historial
-        registrar_historial(conn, prestamo.equipo_id, 'disponible', 'prestado', prestamo.usuario_id, f"Préstamo: {prestamo.motivo}")
+    except HTTPException:
+        conn.rollback()
+        raise
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        release_db_connection(conn)
+
+# Devolución de un kit: todos los préstamos o ninguno. Préstamos y equipos se
+# bloquean en orden de id antes de escribir, igual que en el préstamo por lote.
+# Declarada antes de /prestamos/{prestamo_id}/devolver para que "lote" no se
+# tome como id.
+@app.put("/prestamos/lote/devolver")
+def devolver_prestamos_lote(lote: DevolucionLote, usuario: dict = autenticado):
+    prestamo_ids = sorted(set(lote.prestamo_ids))
+    if not prestamo_ids:
+        raise HTTPException(status_code=400, detail="Se esperaba al menos un préstamo")
+    if len(prestamo_ids) > BULK_MAX_FILAS:
+        raise HTTPException(status_code=413, detail=f"Máximo {BULK_MAX_FILAS} préstamos por lote")
+
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT id, usuario_id FROM prestamos
+            WHERE id = ANY(%s) AND estado = 'activo'
+            ORDER BY id FOR UPDATE
+        """, (prestamo_ids,))
+        titulares = {fila['id']: fila['usuario_id'] for fila in cur.fetchall()}
+        faltantes = [i for i in prestamo_ids if i not in titulares]
+        if faltantes:
+            raise HTTPException(status_code=404, detail={"message": "Préstamos activos no encontrados", "prestamos": faltantes})
+        if usuario["rol"] != "admin":
+            ajenos = [i for i in prestamo_ids if titulares[i] != usuario["id"]]
+            if ajenos:
+                raise HTTPException(status_code=403, detail={"message": "No puedes devolver préstamos de otro usuario", "prestamos": ajenos})
+
+        cur.execute("""
+            SELECT e.id FROM equipos e
+            WHERE e.id IN (SELECT equipo_id FROM prestamos WHERE id = ANY(%s))
+            ORDER BY e.id FOR UPDATE
+        """, (prestamo_ids,))
+
+        cur.execute("""
+            WITH prestamo AS (
+                UPDATE prestamos
+                SET estado = 'devuelto', fecha_devolucion_real = CURRENT_TIMESTAMP
+                WHERE id = ANY(%(prestamo_ids)s)
+                RETURNING id, equipo_id, usuario_id
+            ), equipo AS (
+                UPDATE equipos e SET estado = 'disponible'
+                FROM prestamo p WHERE e.id = p.equipo_id
+            ), ocupacion AS (
+                UPDATE reservas r SET estado = 'finalizada', periodo = tstzrange(lower(r.periodo), CURRENT_TIMESTAMP)
+                FROM prestamo p
+                WHERE r.prestamo_id = p.id AND r.estado = 'en_prestamo'
+            ), historial AS (
+                INSERT INTO historial_equipos (equipo_id, estado_anterior, estado_nuevo, usuario_responsable, motivo)
+                SELECT equipo_id, 'prestado', 'disponible', usuario_id, 'Devolución de préstamo'
+                FROM prestamo ORDER BY id
+            )
+            SELECT equipo_id FROM prestamo
+        """, {"prestamo_ids": prestamo_ids})
+        equipo_ids = [fila['equipo_id'] for fila in cur.fetchall()]
 
         conn.commit()
-        return {"id": prestamo_id, "message": "Préstamo creado exitosamente"}
+        invalidar_catalogo(*equipo_ids)
+        return {"devueltos": len(equipo_ids), "message": "Devoluciones registradas exitosamente"}
 
+    except HTTPException:
+        conn.rollback()
+        raise
     except Exception as e:
         conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 @app.put("/prestamos/{prestamo_id}/devolver")
-async def devolver_equipo(prestamo_id: int):
+def devolver_equipo(prestamo_id: int, usuario: dict = autenticado):
     conn = get_db_connection()
     try:
         cur = conn.cursor()
 
-        # Obtener información del préstamo
-        cur.execute("SELECT equipo_id, usuario_id FROM prestamos WHERE id = %s AND estado = 'activo'", (prestamo_id,))
+        # Devolución atómica: solo un préstamo activo puede cerrarse, y una
+        # devolución concurrente del mismo préstamo no encuentra fila. Solo
+        # el titular del préstamo o un admin pueden devolverlo.
+        cur.execute("""
+            WITH prestamo AS (
+                UPDATE prestamos
+                SET estado = 'devuelto', fecha_devolucion_real = CURRENT_TIMESTAMP
+                WHERE id = %(prestamo_id)s AND estado = 'activo'
+                  AND (usuario_id = %(usuario_id)s OR %(es_admin)s)
+                RETURNING equipo_id, usuario_id
+            ), equipo AS (
+                UPDATE equipos e SET estado = 'disponible'
+                FROM prestamo p WHERE e.id = p.equipo_id
+            ), ocupacion AS (
+                -- El equipo queda libre desde ya para otras reservas
+                UPDATE reservas SET estado = 'finalizada', periodo = tstzrange(lower(periodo), CURRENT_TIMESTAMP)
+                WHERE prestamo_id = %(prestamo_id)s AND estado = 'en_prestamo'
+                  AND EXISTS (SELECT 1 FROM prestamo)
+            ), historial AS (
+                INSERT INTO historial_equipos (equipo_id, estado_anterior, estado_nuevo, usuario_responsable, motivo)
+                SELECT equipo_id, 'prestado', 'disponible', usuario_id, 'Devolución de préstamo' FROM prestamo
+            )
+            SELECT equipo_id FROM prestamo
+        """, {"prestamo_id": prestamo_id, "usuario_id": usuario["id"], "es_admin": usuario["rol"] == "admin"})
         prestamo = cur.fetchone()
 
         if not prestamo:
+            # Solo en el camino de error: préstamo inexistente/cerrado o ajeno
+            conn.rollback()
+            cur.execute("SELECT usuario_id FROM prestamos WHERE id = %s AND estado = 'activo'", (prestamo_id,))
+            if cur.fetchone():
+                raise HTTPException(status_code=403, detail="No puedes devolver el préstamo de otro usuario")
             raise HTTPException(status_code=404, detail="Préstamo activo no encontrado")
 
-        # Actualizar préstamo
-        cur.execute(
-            "UPDATE prestamos SET estado = 'devuelto', fecha_devolucion_real = CURRENT_TIMESTAMP WHERE id = %s",
-            (prestamo_id,)
-        )
+        conn.commit()
+        invalidar_catalogo(prestamo['equipo_id'])
+        return {"message": "Devolución registrada exitosamente"}
 
-        # Cambiar estado del equipo
-        cur.execute("UPDATE equipos SET estado = 'disponible' WHERE id = %s", (prestamo['equipo_id'],))
+    except HTTPException:
+        conn.rollback()
+        raise
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        release_db_connection(conn)
 
-        # Registrar en historial
-        registrar_historial(conn, prestamo['equipo_id'], 'prestado', 'disponible', prestamo['usuario_id'], "Devolución de préstamo")
+# ========== RESERVAS ==========
 
-        conn.commit()
-        return {"message": "Devolución registrada exitosamente"}
+# Reserva varios equipos para la misma ventana, todos o ninguno. Los choques
+# con otras reservas o préstamos los detecta la restricción de exclusión
+# reservas_sin_solapamiento al insertar: no hay que bloquear ni recorrer nada
+# antes, y dos reservas concurrentes que se solapan no pueden ganar ambas.
+@app.post("/reservas")
+def crear_reserva(reserva: ReservaCreate, usuario: dict = autenticado):
+    if usuario["rol"] != "admin" and reserva.usuario_id != usuario["id"]:
+        raise HTTPException(status_code=403, detail="No puedes reservar a nombre de otro usuario")
+    validar_periodo(reserva.desde, reserva.hasta)
+    if reserva.hasta - reserva.desde > timedelta(days=RESERVAS_MAX_DIAS):
+        raise HTTPException(status_code=400, detail=f"Una reserva no puede durar más de {RESERVAS_MAX_DIAS} días")
+    equipo_ids = sorted(set(reserva.equipo_ids))
+    if not equipo_ids:
+        raise HTTPException(status_code=400, detail="Se esperaba al menos un equipo")
+    if len(equipo_ids) > BULK_MAX_FILAS:
+        raise HTTPException(status_code=413, detail=f"Máximo {BULK_MAX_FILAS} equipos por reserva")
+
+    params = {
+        "equipo_ids": equipo_ids,
+        "usuario_id": reserva.usuario_id,
+        "desde": reserva.desde,
+        "hasta": reserva.hasta,
+        "motivo": reserva.motivo,
+    }
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+                INSERT INTO reservas (equipo_id, usuario_id, periodo, motivo)
+                SELECT e.id, %(usuario_id)s, tstzrange(%(desde)s, %(hasta)s), %(motivo)s
+                FROM equipos e
+                WHERE e.id = ANY(%(equipo_ids)s) AND e.deleted_at IS NULL
+                  AND %(hasta)s::timestamptz > CURRENT_TIMESTAMP
+                  AND EXISTS (SELECT 1 FROM usuarios WHERE id = %(usuario_id)s AND activo = TRUE)
+                ORDER BY e.id
+                RETURNING id, equipo_id
+            """, params)
+        except ExclusionViolation:
+            conn.rollback()
+            cur.execute("""
+                SELECT DISTINCT equipo_id FROM reservas
+                WHERE equipo_id = ANY(%(equipo_ids)s) AND estado IN ('activa', 'en_prestamo')
+                  AND periodo && tstzrange(%(desde)s, %(hasta)s)
+                ORDER BY equipo_id
+            """, params)
+            ocupados = [fila['equipo_id'] for fila in cur.fetchall()]
+            raise HTTPException(status_code=409, detail={
+                "message": "Hay equipos ocupados en ese período", "equipos": ocupados,
+            })
+        creadas = cur.fetchall()
 
+        if len(creadas) < len(equipo_ids):
+            # Solo en el camino de error: averiguar qué faltó
+            conn.rollback()
+            cur.execute("SELECT %s::timestamptz <= CURRENT_TIMESTAMP AS pasada", (reserva.hasta,))
+            if cur.fetchone()['pasada']:
+                raise HTTPException(status_code=400, detail="La reserva debe terminar en el futuro")
+            cur.execute("SELECT 1 FROM usuarios WHERE id = %s AND activo = TRUE", (reserva.usuario_id,))
+            if not cur.fetchone():
+                raise HTTPException(status_code=404, detail="Usuario no encontrado")
+            encontrados = {fila['equipo_id'] for fila in creadas}
+            raise HTTPException(status_code=404, detail={
+                "message": "Equipos no encontrados",
+                "equipos": [i for i in equipo_ids if i not in encontrados],
+            })
+
+        conn.commit()
+        invalidar_catalogo()
+        return {"ids": [fila['id'] for fila in creadas], "message": "Reserva creada exitosamente"}
+    except HTTPException:
+        conn.rollback()
+        raise
     except Exception as e:
         conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        conn.close()
+        release_db_connection(conn)
 
-# ========== HISTORIAL - NUEVO EN V4.0 ==========
+# Reservas de un usuario (o de todos, para un admin), de la más próxima a la
+# más lejana. Con desde/hasta, solo las que se cruzan con esa ventana.
+@app.get("/reservas", dependencies=[propio_o_admin, con_etag("reservas", "equipos")])
+def get_reservas(
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    usuario_id: Optional[int] = None,
+    equipo_id: Optional[int] = None,
+    estado: Optional[str] = None,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+):
+    condiciones, params = [], []
+    if usuario_id is not None:
+        condiciones.append("r.usuario_id = %s")
+        params.append(usuario_id)
+    if equipo_id is not None:
+        condiciones.append("r.equipo_id = %s")
+        params.append(equipo_id)
+    if estado:
+        condiciones.append("r.estado = %s")
+        params.append(estado)
+    if desde is not None or hasta is not None:
+        validar_periodo(desde, hasta)
+        condiciones.append("r.periodo && tstzrange(%s, %s)")
+        params.extend([desde, hasta])
 
-@app.get("/historial")
-async def get_historial(limit: int = 50):
     conn = get_db_connection()
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT h.id, h.equipo_id, h.estado_anterior, h.estado_nuevo, 
-                   h.usuario_responsable, h.motivo, h.fecha_cambio,
-                   e.nombre as equipo_nombre,
-                   u.nombre_completo as usuario_nombre
-            FROM historial_equipos h
-            JOIN equipos e ON h.equipo_id = e.id
-            LEFT JOIN usuarios u ON h.usuario_responsable = u.id
-            ORDER BY h.fecha_cambio DESC
-            LIMIT %s
-        """, (limit,))
-        return cur.fetchall()
+        return consultar_pagina(
+            cur,
+            """
+            SELECT r.id, r.equipo_id, r.usuario_id, lower(r.periodo) AS desde, upper(r.periodo) AS hasta,
+                   r.motivo, r.estado, r.prestamo_id, e.nombre as equipo_nombre
+            FROM reservas r
+            JOIN equipos e ON r.equipo_id = e.id
+            """,
+            condiciones, params,
+            orden=[("lower(r.periodo)", "desde", fecha), ("r.id", "id", int)],
+            limite=limit, cursor=cursor, descendente=False,
+        )
     finally:
-        conn.close()
+        release_db_connection(conn)
 
-@app.get("/historial/equipo/{equipo_id}")
-async def get_historial_equipo(equipo_id: int):
+@app.delete("/reservas/{reserva_id}")
+def cancelar_reserva(reserva_id: int, usuario: dict = autenticado):
     conn = get_db_connection()
     try:
         cur = conn.cursor()
         cur.execute("""
-            SELECT h.id, h.estado_anterior, h.estado_nuevo, 
+            UPDATE reservas SET estado = 'cancelada'
+            WHERE id = %(reserva_id)s AND estado = 'activa'
+              AND (usuario_id = %(usuario_id)s OR %(es_admin)s)
+            RETURNING id
+        """, {"reserva_id": reserva_id, "usuario_id": usuario["id"], "es_admin": usuario["rol"] == "admin"})
+        if not cur.fetchone():
+            conn.rollback()
+            cur.execute("SELECT usuario_id FROM reservas WHERE id = %s AND estado = 'activa'", (reserva_id,))
+            if cur.fetchone():
+                raise HTTPException(status_code=403, detail="No puedes cancelar la reserva de otro usuario")
+            raise HTTPException(status_code=404, detail="Reserva activa no encontrada")
+
+        conn.commit()
+        invalidar_catalogo()
+        return {"message": "Reserva cancelada exitosamente"}
+    except HTTPException:
+        conn.rollback()
+        raise
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        release_db_connection(conn)
+
+# ========== HISTORIAL - NUEVO EN V4.0 ==========
+
+# historial_equipos solo tiene los meses dentro de la retención; con
+# archivo=true las consultas leen también lo archivado (vista historial_completo)
+def tabla_historial(archivo):
+    return "historial_completo" if archivo else "historial_equipos"
+
+CONSULTA_HISTORIAL = """
+    SELECT h.id, h.equipo_id, h.estado_anterior, h.estado_nuevo,
+           h.usuario_responsable, h.motivo, h.fecha_cambio,
+           e.nombre as equipo_nombre,
+           u.nombre_completo as usuario_nombre
+    FROM {tabla} h
+    JOIN equipos e ON h.equipo_id = e.id
+    LEFT JOIN usuarios u ON h.usuario_responsable = u.id
+"""
+
+ORDEN_HISTORIAL = [("h.fecha_cambio", "fecha_cambio", fecha), ("h.id", "id", int)]
+
+def pagina_historial(request, response, condiciones, params, estado, desde, hasta, limit, cursor, archivo=False):
+    conn = get_read_connection(request)
+    try:
+        cur = cursor_tuplas(conn)
+        if estado:
+            condiciones.append("h.estado_nuevo = %s")
+            params.append(estado)
+        if desde:
+            condiciones.append("h.fecha_cambio >= %s")
+            params.append(desde)
+        if hasta:
+            condiciones.append("h.fecha_cambio < %s")
+            params.append(hasta)
+
+        return responder(consultar_pagina(
+            cur, CONSULTA_HISTORIAL.format(tabla=tabla_historial(archivo)), condiciones, params,
+            orden=ORDEN_HISTORIAL, limite=limit, cursor=cursor, clase=CambioHistorial,
+        ), response)
+    finally:
+        release_db_connection(conn)
+
+@app.get("/historial", response_model=Pagina[CambioHistorial],
+         dependencies=[solo_admin, en_replica, con_etag("historial_equipos", "equipos", "usuarios")])
+def get_historial(
+    request: Request,
+    response: Response,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    equipo_id: Optional[int] = None,
+    usuario_id: Optional[int] = None,
+    estado: Optional[str] = None,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    archivo: bool = False,
+):
+    condiciones, params = [], []
+    if equipo_id is not None:
+        condiciones.append("h.equipo_id = %s")
+        params.append(equipo_id)
+    if usuario_id is not None:
+        condiciones.append("h.usuario_responsable = %s")
+        params.append(usuario_id)
+    return pagina_historial(request, response, condiciones, params, estado, desde, hasta, limit, cursor, archivo)
+
+# Historial personal: cambios en los que el usuario fue el responsable
+# (sus préstamos y devoluciones), resuelto con idx_historial_usuario_fecha
+@app.get("/historial/usuario/{usuario_id}", response_model=Pagina[CambioHistorial],
+         dependencies=[propio_o_admin, en_replica, con_etag("historial_equipos", "equipos", "usuarios")])
+def get_historial_usuario(
+    request: Request,
+    response: Response,
+    usuario_id: int,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    estado: Optional[str] = None,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    archivo: bool = False,
+):
+    return pagina_historial(
+        request, response, ["h.usuario_responsable = %s"], [usuario_id],
+        estado, desde, hasta, limit, cursor, archivo,
+    )
+
+@app.get("/historial/equipo/{equipo_id}", response_model=List[CambioHistorial],
+         dependencies=[solo_admin, en_replica, con_etag("historial_equipos", "equipos", "usuarios")])
+def get_historial_equipo(request: Request, response: Response, equipo_id: int, archivo: bool = False):
+    conn = get_read_connection(request)
+    try:
+        cur = cursor_tuplas(conn)
+        cur.execute(f"""
+            SELECT h.id, h.equipo_id, h.estado_anterior, h.estado_nuevo,
                    h.usuario_responsable, h.motivo, h.fecha_cambio,
                    e.nombre as equipo_nombre,
                    u.nombre_completo as usuario_nombre
-            FROM historial_equipos h
+            FROM {tabla_historial(archivo)} h
             JOIN equipos e ON h.equipo_id = e.id
             LEFT JOIN usuarios u ON h.usuario_responsable = u.id
             WHERE h.equipo_id = %s
             ORDER BY h.fecha_cambio DESC
         """, (equipo_id,))
-        return cur.fetchall()
+        return responder(list(starmap(CambioHistorial, cur.fetchall())), response)
     finally:
-        conn.close()
+        release_db_connection(conn)
+
+# ========== EXPORTACIÓN ==========
+
+def respuesta_exportacion(request, nombre, sql, condiciones, params, formato, comprimir):
+    if condiciones:
+        sql = sql.replace("{filtro}", "WHERE " + " AND ".join(condiciones))
+    else:
+        sql = sql.replace("{filtro}", "")
+
+    contenido = iniciar_exportacion(
+        lambda: get_read_connection(request), release_db_connection, sql, params, formato, comprimir,
+    )
+
+    archivo = f"{nombre}_{date.today().isoformat()}.{formato}"
+    media_type = TIPOS_CONTENIDO[formato]
+    if comprimir:
+        archivo += ".gz"
+        media_type = "application/gzip"
+    return RespuestaExportacion(
+        contenido,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{archivo}"'},
+    )
+
+def filtro_fechas(columna, desde, hasta):
+    condiciones, params = [], []
+    if desde:
+        condiciones.append(f"{columna} >= %s")
+        params.append(desde)
+    if hasta:
+        condiciones.append(f"{columna} < %s")
+        params.append(hasta)
+    return condiciones, params
+
+@app.get("/exportar/historial", dependencies=[solo_admin, en_replica])
+def exportar_historial(
+    request: Request,
+    formato: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    gzip: bool = False,
+    archivo: bool = False,
+):
+    condiciones, params = filtro_fechas("h.fecha_cambio", desde, hasta)
+    return respuesta_exportacion(request, "historial_equipos", f"""
+        SELECT h.id, h.equipo_id, e.nombre as equipo_nombre,
+               h.estado_anterior, h.estado_nuevo,
+               h.usuario_responsable, u.nombre_completo as usuario_nombre,
+               h.motivo, h.fecha_cambio
+        FROM {tabla_historial(archivo)} h
+        LEFT JOIN equipos e ON h.equipo_id = e.id
+        LEFT JOIN usuarios u ON h.usuario_responsable = u.id
+        {{filtro}}
+        ORDER BY h.fecha_cambio, h.id
+    """, condiciones, params, formato, gzip)
+
+@app.get("/exportar/prestamos", dependencies=[solo_admin, en_replica])
+def exportar_prestamos(
+    request: Request,
+    formato: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    gzip: bool = False,
+):
+    condiciones, params = filtro_fechas("p.fecha_prestamo", desde, hasta)
+    return respuesta_exportacion(request, "prestamos", """
+        SELECT p.id, p.equipo_id, e.nombre as equipo_nombre,
+               p.usuario_id, u.nombre_completo as usuario_nombre,
+               p.fecha_prestamo, p.fecha_devolucion_esperada, p.fecha_devolucion_real,
+               p.motivo_prestamo, p.estado,
+               p.observaciones_prestamo, p.observaciones_devolucion
+        FROM prestamos p
+        LEFT JOIN equipos e ON p.equipo_id = e.id
+        LEFT JOIN usuarios u ON p.usuario_id = u.id
+        {filtro}
+        ORDER BY p.fecha_prestamo, p.id
+    """, condiciones, params, formato, gzip)
+
+# ========== ESTADÍSTICAS ==========
+
+# Tablero de utilización. Lee las tablas estadisticas_* que mantienen los
+# triggers de equipos y prestamos (ver database/init.sql): ninguna consulta
+# recorre prestamos ni historial_equipos. Los equipos dados de baja no
+# cuentan, igual que en el catálogo.
+@app.get("/estadisticas", dependencies=[solo_admin, en_replica])
+def get_estadisticas(request: Request, limite: int = Query(10, ge=1, le=100)):
+    conn = get_read_connection(request)
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT estado, sum(total)::bigint AS total
+            FROM estadisticas_equipos
+            GROUP BY estado
+            HAVING sum(total) <> 0
+            ORDER BY estado
+        """)
+        equipos_por_estado = {fila["estado"]: fila["total"] for fila in cur.fetchall()}
+
+        cur.execute("""
+            SELECT COALESCE(sum(activos), 0)::bigint AS activos,
+                   COALESCE(sum(activos) FILTER (WHERE fecha_devolucion_esperada < CURRENT_DATE), 0)::bigint AS vencidos
+            FROM estadisticas_vencimientos
+        """)
+        prestamos = cur.fetchone()
+
+        cur.execute("""
+            SELECT s.equipo_id, e.nombre, s.prestamos, s.devueltos,
+                   CASE WHEN s.devueltos > 0
+                        THEN round((s.segundos_prestado / s.devueltos / 3600)::numeric, 2)
+                   END AS duracion_promedio_horas
+            FROM estadisticas_prestamos_equipo s
+            JOIN equipos e ON e.id = s.equipo_id AND e.deleted_at IS NULL
+            WHERE s.prestamos > 0
+            ORDER BY s.prestamos DESC, s.equipo_id
+            LIMIT %s
+        """, (limite,))
+        mas_prestados = cur.fetchall()
+
+        return {
+            "equipos_por_estado": equipos_por_estado,
+            "total_equipos": sum(equipos_por_estado.values()),
+            "prestamos_activos": prestamos["activos"],
+            "prestamos_vencidos": prestamos["vencidos"],
+            "mas_prestados": mas_prestados,
+        }
+    finally:
+        release_db_connection(conn)
+
+@app.get("/estadisticas/equipos/{equipo_id}", dependencies=[solo_admin, en_replica])
+def get_estadisticas_equipo(request: Request, equipo_id: int):
+    conn = get_read_connection(request)
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT e.id AS equipo_id, e.nombre, e.estado,
+                   COALESCE(s.prestamos, 0) AS prestamos, COALESCE(s.devueltos, 0) AS devueltos,
+                   CASE WHEN s.devueltos > 0
+                        THEN round((s.segundos_prestado / s.devueltos / 3600)::numeric, 2)
+                   END AS duracion_promedio_horas
+            FROM equipos e
+            LEFT JOIN estadisticas_prestamos_equipo s ON s.equipo_id = e.id
+            WHERE e.id = %s AND e.deleted_at IS NULL
+        """, (equipo_id,))
+        estadisticas = cur.fetchone()
+
+        if not estadisticas:
+            raise HTTPException(status_code=404, detail="Equipo no encontrado")
+        return estadisticas
+    finally:
+        release_db_connection(conn)
+
+# ========== MONITOREO ==========
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(generate_latest(registro_metricas()), media_type=CONTENT_TYPE_LATEST)
+
+# El pool y la réplica son estado de cada worker: /metricas/pool y
+# /metricas/replica reportan los del worker que responde (indicado en
+# "worker"); /metrics y /metricas/cache agregan los de todos. /metrics es
+# para el scraper y solo se alcanza desde la red interna (en producción el
+# puerto de la API no se publica); los /metricas/* requieren administrador.
+@app.get("/metricas/pool", dependencies=[solo_admin])
+async def get_metricas_pool():
+    return {**metricas_pool(), "worker": os.getpid()}
+
+@app.get("/metricas/cache", dependencies=[solo_admin])
+async def get_metricas_cache():
+    return cache_catalogo.metricas()
+
+@app.get("/metricas/replica", dependencies=[solo_admin])
+async def get_metricas_replica():
+    if enrutador_lecturas is None:
+        return {}
+    return {**enrutador_lecturas.metricas(), "worker": os.getpid()}
+
+# ========== EVENTOS ==========
+
+# Cambios de estado de equipos en vivo (Server-Sent Events). Cada evento
+# "equipos" trae [{"id", "nombre", "estado"}, ...] (estado null si el equipo
+# se eliminó); "resincronizar" indica que pudieron perderse avisos y el
+# cliente debe recargar el estado completo.
+#
+# El navegador se conecta aquí directamente (el proxy de producción enruta esta
+# ruta a la API): un stream ocupa una tarea del event loop y no un hilo de la
+# webapp. EventSource no envía cabeceras, así que se autentica con un token de
+# eventos en la consulta (?token=), que la webapp pide a /eventos/token. Solo
+# se verifica al conectar: al vencer, el navegador pide otro para reconectar.
+async def usuario_eventos(request: Request, token: Optional[str] = None):
+    if token is None:
+        return await usuario_actual(request)
+    try:
+        datos = firmador_tokens.verificar(token, EVENTOS)
+    except TokenInvalido as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    return {"id": int(datos["sub"]), "rol": datos["rol"]}
+
+@app.post("/eventos/token")
+async def token_eventos(usuario: dict = autenticado):
+    return {
+        "token_eventos": firmador_tokens.emitir(usuario["id"], usuario["rol"], EVENTOS),
+        "expira_en": firmador_tokens.ttls[EVENTOS],
+    }
+
+@app.get("/eventos/equipos", dependencies=[Depends(usuario_eventos)])
+async def eventos_equipos():
+    cola = difusor_eventos.suscribir()
+
+    async def emitir():
+        EVENTOS_CLIENTES.inc()
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    evento = await asyncio.wait_for(cola.get(), EVENTOS_LATIDO)
+                except asyncio.TimeoutError:
+                    yield ": latido\n\n"
+                    continue
+                if evento is None:
+                    break
+                tipo, datos = evento
+                yield f"event: {tipo}\ndata: {datos or '{}'}\n\n"
+        finally:
+            difusor_eventos.cancelar(cola)
+            EVENTOS_CLIENTES.dec()
+
+    return StreamingResponse(emitir(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
@@ -0,0 +1,165 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+
+# Métricas y logging de la API.
+#
+# Cada petición HTTP lleva una Medicion en una variable de contexto; FastAPI
+# copia el contexto a los hilos donde corren los endpoints síncronos, así que
+# el cursor instrumentado de db.py suma ahí las consultas y el tiempo en base
+# de datos de la petición en curso. Las métricas se exponen en formato
+# Prometheus en /metrics. Con varios workers (gunicorn.conf.py define
+# PROMETHEUS_MULTIPROC_DIR) cada proceso escribe las suyas en ese directorio
+# y /metrics las agrega, responda el worker que responda.
+
+SQL_LENTA_MS = float(os.getenv("SQL_LENTA_MS", "200"))
+
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HTTP_DURACION = Histogram(
+    "api_peticion_duracion_segundos", "Latencia de las peticiones HTTP",
+    ["metodo", "ruta", "codigo"], buckets=BUCKETS_LATENCIA,
+)
+HTTP_CONSULTAS = Histogram(
+    "api_peticion_consultas_sql", "Consultas SQL ejecutadas por petición",
+    ["ruta"], buckets=(0, 1, 2, 3, 5, 10, 25, 50),
+)
+HTTP_TIEMPO_DB = Histogram(
+    "api_peticion_tiempo_db_segundos", "Tiempo en base de datos por petición",
+    ["ruta"], buckets=BUCKETS_LATENCIA,
+)
+SQL_DURACION = Histogram(
+    "api_sql_duracion_segundos", "Duración de cada consulta SQL", buckets=BUCKETS_LATENCIA,
+)
+SQL_LENTAS = Counter(
+    "api_sql_lentas_total", f"Consultas SQL que superan SQL_LENTA_MS ({SQL_LENTA_MS:g} ms)",
+)
+EVENTOS_CLIENTES = Gauge(
+    "api_eventos_clientes", "Clientes conectados al stream de eventos de equipos",
+    multiprocess_mode="livesum",
+)
+LECTURAS_DESTINO = Counter(
+    "api_lecturas_total", "Lecturas de los endpoints enrutables a la réplica, por servidor que las atendió",
+    ["destino"],
+)
+REPLICA_RETRASO = Gauge(
+    "api_replica_retraso_segundos", "Retraso de la réplica de lectura respecto de la primaria",
+    multiprocess_mode="livemax",
+)
+CACHE_LECTURAS = Counter(
+    "api_cache_lecturas_total", "Lecturas de la caché del catálogo (acierto o fallo)", ["resultado"],
+)
+CACHE_INVALIDACIONES = Counter(
+    "api_cache_invalidaciones_total", "Invalidaciones de espacios de la caché del catálogo",
+)
+CACHE_ERRORES = Counter(
+    "api_cache_errores_backend_total", "Errores del backend de la caché del catálogo",
+)
+
+logger = logging.getLogger("inventario.api")
+
+
+# Registro con las métricas de todos los workers, o las de este proceso si
+# no hay varios
+def registro_metricas():
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        return REGISTRY
+    registro = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registro)
+    return registro
+
+
+# Valor de un contador (sumado entre workers), por valor de `etiqueta`
+def totales(nombre, etiqueta=None):
+    valores = {}
+    for metrica in registro_metricas().collect():
+        for muestra in metrica.samples:
+            if muestra.name == nombre:
+                clave = muestra.labels.get(etiqueta) if etiqueta else None
+                valores[clave] = valores.get(clave, 0) + muestra.value
+    return valores
+
+
+class Medicion:
+    def __init__(self):
+        self.consultas = 0
+        self.tiempo_db = 0.0
+
+
+_medicion = contextvars.ContextVar("medicion", default=None)
+
+
+def iniciar_medicion():
+    medicion = Medicion()
+    _medicion.set(medicion)
+    return medicion
+
+
+def registrar_consulta(sql, duracion):
+    SQL_DURACION.observe(duracion)
+    medicion = _medicion.get()
+    if medicion is not None:
+        medicion.consultas += 1
+        medicion.tiempo_db += duracion
+
+    if duracion * 1000 >= SQL_LENTA_MS:
+        SQL_LENTAS.inc()
+        if isinstance(sql, bytes):
+            sql = sql.decode("utf-8", "replace")
+        logger.warning("consulta lenta", extra={
+            "duracion_ms": round(duracion * 1000, 2),
+            "sql": " ".join(str(sql).split())[:500],
+        })
+
+
+def observar_peticion(metodo, ruta, codigo, duracion, medicion):
+    HTTP_DURACION.labels(metodo, ruta, str(codigo)).observe(duracion)
+    HTTP_CONSULTAS.labels(ruta).observe(medicion.consultas)
+    HTTP_TIEMPO_DB.labels(ruta).observe(medicion.tiempo_db)
+
+
+# ========== LOGGING ==========
+
+# Campos estándar de LogRecord; todo lo demás viene de `extra` y se incluye
+# tal cual en la línea JSON
+_CAMPOS_RECORD = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class FormatoJSON(logging.Formatter):
+    def format(self, record):
+        linea = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + f".{int(record.msecs):03d}Z",
+            "nivel": record.levelname,
+            "logger": record.name,
+            "mensaje": record.getMessage(),
+        }
+        for campo, valor in vars(record).items():
+            if campo not in _CAMPOS_RECORD:
+                linea[campo] = valor
+        return json.dumps(linea, ensure_ascii=False, default=str)
+
+
+# Los handlers de la aplicación solo encolan el registro; un hilo aparte lo
+# formatea y lo escribe, así loguear nunca bloquea un endpoint en E/S
+def configurar_logging(nivel=None):
+    raiz = logging.getLogger("inventario")
+    if raiz.handlers:
+        return
+    cola = queue.SimpleQueue()
+    salida = logging.StreamHandler()
+    salida.setFormatter(FormatoJSON())
+    oyente = logging.handlers.QueueListener(cola, salida, respect_handler_level=True)
+    oyente.start()
+    atexit.register(oyente.stop)
+
+    raiz.addHandler(logging.handlers.QueueHandler(cola))
+    raiz.setLevel(nivel or os.getenv("LOG_LEVEL", "INFO"))
+    raiz.propagate = False
@@ -0,0 +1,107 @@
+import base64
+import binascii
+import json
+from datetime import date, datetime
+from itertools import starmap
+
+from fastapi import HTTPException
+
+# Paginación por cursor (keyset). El cursor guarda los valores de las columnas
+# de orden de la última/primera fila devuelta y la dirección de navegación, de
+# modo que cada página se resuelve con una comparación de filas sobre un índice
+# en lugar de un OFFSET que recorre todas las filas anteriores.
+
+SIGUIENTE = "sig"
+ANTERIOR = "ant"
+
+
+def codificar_cursor(valores, direccion):
+    datos = {
+        "v": [v.isoformat() if isinstance(v, date) else v for v in valores],
+        "d": direccion,
+    }
+    texto = json.dumps(datos, separators=(",", ":"))
+    return base64.urlsafe_b64encode(texto.encode()).decode().rstrip("=")
+
+
+def decodificar_cursor(cursor, orden):
+    try:
+        relleno = "=" * (-len(cursor) % 4)
+        datos = json.loads(base64.urlsafe_b64decode(cursor + relleno))
+        valores = datos["v"]
+        direccion = datos["d"]
+        if direccion not in (SIGUIENTE, ANTERIOR) or len(valores) != len(orden):
+            raise ValueError("cursor incompleto")
+        valores = [tipo(v) for v, (_, _, tipo) in zip(valores, orden)]
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido")
+    return valores, direccion
+
+
+def fecha(valor):
+    return datetime.fromisoformat(valor)
+
+
+def dia(valor):
+    return date.fromisoformat(valor)
+
+
+# Ejecuta `consulta` (SELECT ... FROM ... sin WHERE ni ORDER BY) aplicando las
+# condiciones de filtro y el cursor, y devuelve una página:
+#   {"items": [...], "siguiente": cursor | None, "anterior": cursor | None}
+# `orden` es una lista de (expresion_sql, clave_en_fila, conversor) y debe
+# terminar en una columna única (normalmente el id) para que el orden sea total.
+# Con `clase`, `cur` devuelve tuplas y cada fila se envuelve en `clase(*fila)`.
+def consultar_pagina(cur, consulta, condiciones, params, orden, limite,
+                     cursor=None, descendente=True, clase=None):
+    condiciones = list(condiciones)
+    params = list(params)
+    direccion = SIGUIENTE
+
+    if cursor:
+        valores, direccion = decodificar_cursor(cursor, orden)
+        hacia_adelante = direccion == SIGUIENTE
+        operador = "<" if descendente == hacia_adelante else ">"
+        columnas = ", ".join(expr for expr, _, _ in orden)
+        marcadores = ", ".join(["%s"] * len(orden))
+        condiciones.append(f"({columnas}) {operador} ({marcadores})")
+        params.extend(valores)
+
+    # Para ir a la página anterior se recorre el índice en sentido inverso
+    invertir = direccion == ANTERIOR
+    sentido = "DESC" if descendente != invertir else "ASC"
+
+    sql = consulta
+    if condiciones:
+        sql += " WHERE " + " AND ".join(condiciones)
+    sql += " ORDER BY " + ", ".join(f"{expr} {sentido}" for expr, _, _ in orden)
+    sql += " LIMIT %s"
+    params.append(limite + 1)
+
+    cur.execute(sql, params)
+    filas = cur.fetchall()
+    hay_mas = len(filas) > limite
+    filas = filas[:limite]
+    if invertir:
+        filas.reverse()
+    if clase is not None:
+        filas = list(starmap(clase, filas))
+
+    def cursor_de(fila, dir_):
+        if clase is not None:
+            return codificar_cursor([getattr(fila, clave) for _, clave, _ in orden], dir_)
+        return codificar_cursor([fila[clave] for _, clave, _ in orden], dir_)
+
+    # Si se llegó retrocediendo, siempre hay una página siguiente (la de origen);
+    # si se llegó avanzando desde un cursor, siempre hay una anterior.
+    hay_siguiente = hay_mas if not invertir else True
+    hay_anterior = hay_mas if invertir else cursor is not None
+
+    siguiente = anterior = None
+    if filas:
+        if hay_siguiente:
+            siguiente = cursor_de(filas[-1], SIGUIENTE)
+        if hay_anterior:
+            anterior = cursor_de(filas[0], ANTERIOR)
+
+    return {"items": filas, "siguiente": siguiente, "anterior": anterior}
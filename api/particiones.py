@@ -0,0 +1,209 @@
+import gzip
+import logging
+import os
+import re
+import tempfile
+import threading
+from datetime import date
+
+from db import PoolAgotadoError, liberar_conexion, obtener_conexion
+
+# Mantenimiento de las particiones mensuales de historial_equipos.
+#
+# Cada ciclo:
+#   1. crea las particiones de los próximos meses (y las de los meses que
+#      hayan caído en la partición por defecto, moviendo esas filas);
+#   2. archiva las particiones más antiguas que la retención: se separan de
+#      historial_equipos y se adjuntan a archivo.historial_equipos, así las
+#      consultas normales dejan de recorrerlas;
+#   3. exporta cada partición archivada a <directorio>/<particion>.csv.gz y,
+#      terminada la exportación, deja la marca <particion>.csv.gz.ok;
+#   4. si hay límite para el archivo, elimina de la base de datos las
+#      particiones archivadas más antiguas que ya tienen su marca.
+# Cada paso se hace bajo un advisory lock, así varios workers de la API
+# pueden ejecutar el planificador a la vez.
+
+logger = logging.getLogger("inventario.api.particiones")
+
+# Clave del advisory lock del mantenimiento
+BLOQUEO = 7318001
+
+PATRON_PARTICION = re.compile(r"^historial_equipos_(\d{4})_(\d{2})$")
+
+
+def restar_meses(dia, meses):
+    total = dia.year * 12 + dia.month - 1 - meses
+    return date(total // 12, total % 12 + 1, 1)
+
+
+def particiones(cur, padre):
+    cur.execute("""
+        SELECT c.relname AS nombre
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        ORDER BY c.relname
+    """, (padre,))
+    resultado = []
+    for fila in cur.fetchall():
+        coincidencia = PATRON_PARTICION.match(fila["nombre"])
+        if coincidencia:
+            mes = date(int(coincidencia.group(1)), int(coincidencia.group(2)), 1)
+            resultado.append((fila["nombre"], mes))
+    return resultado
+
+
+def crear_particiones(conn, meses_adelante):
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (BLOQUEO,))
+    # Meses que ya tienen filas en la partición por defecto (salvo las de fechas
+    # más allá del horizonte, que esperan a que este las alcance) y los próximos
+    cur.execute("""
+        SELECT crear_particiones_historial(
+            LEAST(min(fecha_cambio)::date, CURRENT_DATE),
+            (CURRENT_DATE + %s * interval '1 month')::date
+        ) AS creadas
+        FROM historial_equipos_default
+    """, (meses_adelante,))
+    return cur.fetchone()["creadas"]
+
+
+def archivar_particiones(conn, retencion_meses):
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (BLOQUEO,))
+    # Separar una partición bloquea historial_equipos por completo: mejor
+    # desistir y reintentar en el siguiente ciclo que encolar a los endpoints
+    # detrás de una consulta larga
+    cur.execute("SET LOCAL lock_timeout = '5s'")
+    limite = restar_meses(date.today(), retencion_meses)
+    archivadas = []
+    for nombre, mes in particiones(cur, "public.historial_equipos"):
+        if mes >= limite:
+            continue
+        siguiente = restar_meses(mes, -1)
+        cur.execute(f"ALTER TABLE public.historial_equipos DETACH PARTITION public.{nombre}")
+        cur.execute(f"ALTER TABLE public.{nombre} SET SCHEMA archivo")
+        cur.execute(
+            f"ALTER TABLE archivo.historial_equipos ATTACH PARTITION archivo.{nombre} FOR VALUES FROM (%s) TO (%s)",
+            (mes, siguiente),
+        )
+        archivadas.append(nombre)
+    if archivadas:
+        # Separar particiones no dispara los triggers: invalidar los ETags a mano
+        cur.execute("SELECT registrar_cambio_tabla('historial_equipos')")
+    return archivadas
+
+
+def ruta_exportacion(directorio, nombre):
+    return os.path.join(directorio, f"{nombre}.csv.gz")
+
+
+def ruta_marca(directorio, nombre):
+    return ruta_exportacion(directorio, nombre) + ".ok"
+
+
+# Escribe el archivo a un temporal propio del proceso y lo renombra, así un
+# archivo presente siempre está completo
+def escribir_atomico(directorio, ruta, escribir):
+    with tempfile.NamedTemporaryFile(dir=directorio, prefix=".exportacion-", delete=False) as temporal:
+        try:
+            escribir(temporal)
+            temporal.flush()
+            os.fsync(temporal.fileno())
+        except BaseException:
+            temporal.close()
+            os.unlink(temporal.name)
+            raise
+    os.replace(temporal.name, ruta)
+
+
+# Exporta las particiones archivadas que aún no tienen marca. La marca se
+# escribe después de que la exportación quedó completa en su ruta final: es
+# lo único que eliminar_archivadas acepta como prueba de la exportación.
+def exportar_archivadas(conn, directorio):
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (BLOQUEO,))
+    os.makedirs(directorio, exist_ok=True)
+    exportadas = []
+    for nombre, _ in particiones(cur, "archivo.historial_equipos"):
+        if os.path.exists(ruta_marca(directorio, nombre)):
+            continue
+
+        def copiar(salida):
+            with gzip.open(salida, "wb") as comprimido:
+                cur.copy_expert(
+                    f"COPY (SELECT * FROM archivo.{nombre} ORDER BY fecha_cambio, id) TO STDOUT WITH (FORMAT csv, HEADER)",
+                    comprimido,
+                )
+
+        escribir_atomico(directorio, ruta_exportacion(directorio, nombre), copiar)
+        escribir_atomico(directorio, ruta_marca(directorio, nombre), lambda salida: salida.write(b"ok\n"))
+        exportadas.append(nombre)
+    return exportadas
+
+
+def eliminar_archivadas(conn, directorio, archivo_meses):
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (BLOQUEO,))
+    limite = restar_meses(date.today(), archivo_meses)
+    eliminadas = []
+    for nombre, mes in particiones(cur, "archivo.historial_equipos"):
+        if mes < limite and os.path.exists(ruta_marca(directorio, nombre)):
+            cur.execute(f"DROP TABLE archivo.{nombre}")
+            eliminadas.append(nombre)
+    if eliminadas:
+        cur.execute("SELECT registrar_cambio_tabla('historial_equipos')")
+    return eliminadas
+
+
+class PlanificadorParticiones:
+    # archivo_meses = 0 conserva en la base de datos todo lo archivado
+    def __init__(self, intervalo, meses_adelante, retencion_meses, directorio, archivo_meses=0):
+        self.intervalo = intervalo
+        self.meses_adelante = meses_adelante
+        self.retencion_meses = retencion_meses
+        self.directorio = directorio
+        self.archivo_meses = archivo_meses
+        self._detener = threading.Event()
+        self._hilo = threading.Thread(target=self._ejecutar, name="particiones", daemon=True)
+
+    def iniciar(self):
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self._hilo.join(timeout=30)
+
+    def _ejecutar(self):
+        while not self._detener.is_set():
+            try:
+                self.ejecutar_ciclo()
+            except PoolAgotadoError as e:
+                logger.warning("mantenimiento de particiones omitido", extra={"motivo": str(e)})
+            except Exception:
+                logger.exception("error en el mantenimiento de particiones")
+            self._detener.wait(self.intervalo)
+
+    def _en_transaccion(self, funcion, *args):
+        conn = obtener_conexion()
+        try:
+            resultado = funcion(conn, *args)
+            conn.commit()
+            return resultado
+        finally:
+            liberar_conexion(conn)
+
+    def ejecutar_ciclo(self):
+        creadas = self._en_transaccion(crear_particiones, self.meses_adelante)
+        archivadas = self._en_transaccion(archivar_particiones, self.retencion_meses)
+        exportadas = self._en_transaccion(exportar_archivadas, self.directorio)
+        eliminadas = []
+        if self.archivo_meses > 0:
+            eliminadas = self._en_transaccion(eliminar_archivadas, self.directorio, self.archivo_meses)
+
+        if creadas or archivadas or exportadas or eliminadas:
+            logger.info("mantenimiento de particiones", extra={
+                "creadas": creadas, "archivadas": archivadas,
+                "exportadas": exportadas, "eliminadas": eliminadas,
+            })
+        return creadas, archivadas, exportadas, eliminadas
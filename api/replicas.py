@@ -0,0 +1,156 @@
+import logging
+import threading
+import time
+from collections import deque
+
+import psycopg2
+
+from db import PoolAgotadoError, PoolConexiones, liberar_conexion, obtener_conexion
+from observabilidad import REPLICA_RETRASO
+
+# Lecturas en una réplica de solo lectura.
+#
+# Los endpoints de consulta pesados (préstamos, historial, exportaciones,
+# estadísticas) pueden leer de una réplica en streaming de la primaria. Cada
+# worker mide cada `intervalo` segundos hasta dónde llegó la réplica: anota la
+# posición del WAL de la primaria con la hora a la que la pidió y, cuando la
+# réplica ya reprodujo esa posición, sabe que tiene todo lo confirmado antes
+# de esa hora (`al_dia_hasta`). Con eso:
+#   - si la réplica no responde o va más de `retraso_maximo` segundos por
+#     detrás, las lecturas vuelven a la primaria;
+#   - lectura de lo propio: tras una escritura de un usuario (hora guardada en
+#     `escrituras`), sus lecturas van a la primaria hasta que la réplica la
+#     alcanza.
+# Un servidor que no es standby (p. ej. la misma primaria o una copia local en
+# pruebas) se considera siempre al día.
+
+logger = logging.getLogger("inventario.api.replicas")
+
+
+def posicion_wal(lsn):
+    # "16/B374D848" -> entero comparable
+    alto, _, bajo = lsn.partition("/")
+    return (int(alto, 16) << 32) | int(bajo, 16)
+
+
+class EnrutadorLecturas:
+    def __init__(self, parametros_replica, retraso_maximo, intervalo, escrituras, pool_maximo, pool_timeout):
+        self.retraso_maximo = retraso_maximo
+        self.intervalo = intervalo
+        self.escrituras = escrituras
+        # Conexiones abiertas a demanda (una réplica caída no impide arrancar)
+        # y de solo lectura: si la "réplica" resultara ser una primaria, una
+        # escritura enrutada por error falla en lugar de divergir
+        self._pool = PoolConexiones(
+            0, pool_maximo, pool_timeout,
+            options="-c default_transaction_read_only=on", **parametros_replica,
+        )
+        self._muestras = deque(maxlen=1000)
+        self._al_dia_hasta = 0.0
+        self._disponible = False
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = threading.Thread(target=self._ejecutar, name="replicas", daemon=True)
+
+    def iniciar(self):
+        # Primera medición antes de atender peticiones
+        self.medir()
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self._hilo.join(timeout=10)
+        self._pool.cerrar()
+
+    def _ejecutar(self):
+        while not self._detener.wait(self.intervalo):
+            self.medir()
+
+    def medir(self):
+        # Posición de la primaria, con la hora anterior a pedirla: todo lo
+        # confirmado antes de esa hora está en o antes de esa posición
+        try:
+            hora = time.time()
+            conn = obtener_conexion()
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT pg_current_wal_lsn()::text AS lsn")
+                self._muestras.append((hora, posicion_wal(cur.fetchone()["lsn"])))
+            finally:
+                liberar_conexion(conn)
+        except Exception as e:
+            logger.warning("no se pudo leer la posición de la primaria", extra={"motivo": str(e)})
+            return
+
+        try:
+            conn = self._pool.adquirir()
+            try:
+                cur = conn.cursor()
+                cur.execute("""
+                    SELECT pg_is_in_recovery() AS standby, pg_last_wal_replay_lsn()::text AS lsn
+                """)
+                fila = cur.fetchone()
+            finally:
+                self._pool.liberar(conn)
+        except Exception as e:
+            with self._lock:
+                disponible, self._disponible = self._disponible, False
+            if disponible:
+                logger.warning("réplica no disponible, lecturas en la primaria", extra={"motivo": str(e)})
+            return
+
+        reproducida = posicion_wal(fila["lsn"]) if fila["standby"] and fila["lsn"] else None
+        with self._lock:
+            while self._muestras and (reproducida is None or self._muestras[0][1] <= reproducida):
+                self._al_dia_hasta = self._muestras.popleft()[0]
+            disponible, self._disponible = self._disponible, True
+        REPLICA_RETRASO.set(self.retraso())
+        if not disponible:
+            logger.info("réplica disponible", extra={"retraso_s": round(self.retraso(), 3)})
+
+    def retraso(self):
+        return max(0.0, time.time() - self._al_dia_hasta)
+
+    # Hora de la última escritura confirmada del usuario (la registra la API
+    # al responder); dura lo suficiente para que la réplica la alcance o deje
+    # de usarse por retraso
+    def registrar_escritura(self, usuario_id):
+        try:
+            self.escrituras.guardar(f"escritura:{usuario_id}", time.time())
+        except Exception:
+            logger.exception("no se pudo registrar la escritura", extra={"usuario_id": usuario_id})
+
+    def usar_replica(self, usuario_id=None):
+        with self._lock:
+            al_dia_hasta = self._al_dia_hasta
+            usar = self._disponible and time.time() - al_dia_hasta <= self.retraso_maximo
+        if usar and usuario_id is not None:
+            try:
+                escrita = self.escrituras.obtener(f"escritura:{usuario_id}")
+            except Exception:
+                escrita = time.time()
+            usar = escrita is None or escrita <= al_dia_hasta
+        return usar
+
+    # Conexión de la réplica, o None si no se pudo obtener (quien llama usa
+    # la primaria). Un fallo de conexión la marca como no disponible hasta la
+    # próxima medición.
+    def obtener_conexion(self):
+        try:
+            return self._pool.adquirir()
+        except PoolAgotadoError:
+            return None
+        except psycopg2.Error as e:
+            with self._lock:
+                self._disponible = False
+            logger.warning("réplica no disponible, lecturas en la primaria", extra={"motivo": str(e)})
+            return None
+
+    def metricas(self):
+        with self._lock:
+            return {
+                "disponible": self._disponible,
+                "retraso_s": round(self.retraso(), 3) if self._al_dia_hasta else None,
+                "retraso_maximo_s": self.retraso_maximo,
+                "pool": self._pool.metricas(),
+            }
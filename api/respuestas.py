@@ -0,0 +1,128 @@
+import dataclasses
+import json
+from dataclasses import dataclass
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Generic, List, Optional, TypeVar
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # Sin orjson se usa el json de la biblioteca estándar (más lento)
+    orjson = None
+
+# Serialización de las respuestas.
+#
+# RespuestaJSON es la clase de respuesta por defecto de la API: serializa con
+# orjson, que escribe directamente los dicts, listas, fechas y dataclasses.
+#
+# Los listados grandes (equipos, préstamos, historial) leen las filas como
+# tuplas (cursor_tuplas) y las envuelven en las clases de este módulo, con
+# __slots__: ocupan mucho menos que un RealDictRow por fila y orjson las
+# serializa sin pasar por jsonable_encoder. Esos endpoints devuelven la
+# respuesta ya armada con responder(); su response_model solo documenta el
+# esquema en OpenAPI y no se valida en cada petición.
+#
+# Los campos de cada clase van en el mismo orden que las columnas del SELECT
+# que la llena.
+
+
+def _por_defecto(valor):
+    # Igual que jsonable_encoder: Decimal entero -> int, con decimales -> float
+    if isinstance(valor, Decimal):
+        return int(valor) if valor.as_tuple().exponent >= 0 else float(valor)
+    if dataclasses.is_dataclass(valor):
+        return {campo.name: getattr(valor, campo.name) for campo in dataclasses.fields(valor)}
+    if isinstance(valor, (date, datetime)):
+        return valor.isoformat()
+    raise TypeError(f"Tipo no serializable: {type(valor).__name__}")
+
+
+class RespuestaJSON(JSONResponse):
+    def render(self, content):
+        if orjson is not None:
+            return orjson.dumps(content, default=_por_defecto, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(content, default=_por_defecto, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+# Respuesta ya serializada, conservando las cabeceras que pusieron las
+# dependencias en `response` (el ETag de con_etag), igual que hace FastAPI
+def responder(contenido, response):
+    respuesta = RespuestaJSON(contenido)
+    respuesta.headers.raw.extend(response.headers.raw)
+    return respuesta
+
+
+T = TypeVar("T")
+
+
+class Pagina(BaseModel, Generic[T]):
+    items: List[T]
+    siguiente: Optional[str] = None
+    anterior: Optional[str] = None
+
+
+@dataclass
+class EquipoDisponible:
+    __slots__ = ("id", "nombre", "descripcion", "estado")
+    id: int
+    nombre: str
+    descripcion: Optional[str]
+    estado: str
+
+
+@dataclass
+class Equipo:
+    __slots__ = ("id", "nombre", "descripcion", "estado", "created_at")
+    id: int
+    nombre: str
+    descripcion: Optional[str]
+    estado: str
+    created_at: datetime
+
+
+@dataclass
+class EquipoEncontrado:
+    __slots__ = ("id", "nombre", "descripcion", "estado", "created_at", "relevancia")
+    id: int
+    nombre: str
+    descripcion: Optional[str]
+    estado: str
+    created_at: datetime
+    relevancia: float
+
+
+@dataclass
+class Prestamo:
+    __slots__ = (
+        "id", "equipo_id", "usuario_id", "motivo", "fecha_prestamo", "fecha_devolucion",
+        "estado", "equipo_nombre", "usuario_nombre",
+    )
+    id: int
+    equipo_id: int
+    usuario_id: int
+    motivo: Optional[str]
+    fecha_prestamo: datetime
+    fecha_devolucion: Optional[datetime]
+    estado: str
+    equipo_nombre: str
+    usuario_nombre: str
+
+
+@dataclass
+class CambioHistorial:
+    __slots__ = (
+        "id", "equipo_id", "estado_anterior", "estado_nuevo", "usuario_responsable",
+        "motivo", "fecha_cambio", "equipo_nombre", "usuario_nombre",
+    )
+    id: int
+    equipo_id: int
+    estado_anterior: Optional[str]
+    estado_nuevo: str
+    usuario_responsable: Optional[int]
+    motivo: Optional[str]
+    fecha_cambio: datetime
+    equipo_nombre: str
+    usuario_nombre: Optional[str]
@@ -0,0 +1,128 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Contraseñas con hash scrypt y sal aleatoria, almacenadas como
+#   scrypt$<n>$<r>$<p>$<sal>$<hash>      (sal y hash en base64 sin relleno)
+# Las filas antiguas en texto plano se siguen aceptando y se reemplazan por
+# su hash en el siguiente login correcto (igual que las de parámetros viejos).
+# hashlib.scrypt libera el GIL, así que varios hashes corren en paralelo en
+# un pool de hilos sin frenar al resto del proceso.
+
+PREFIJO = "scrypt"
+LARGO_SAL = 16
+LARGO_HASH = 32
+
+
+def _b64(datos):
+    return base64.b64encode(datos).decode().rstrip("=")
+
+
+def _desde_b64(texto):
+    return base64.b64decode(texto + "=" * (-len(texto) % 4))
+
+
+def _scrypt(password, sal, n, r, p):
+    return hashlib.scrypt(
+        password.encode(), salt=sal, n=n, r=r, p=p,
+        maxmem=256 * n * r + 1024 * 1024, dklen=LARGO_HASH,
+    )
+
+
+def generar_hash(password, n, r, p):
+    sal = os.urandom(LARGO_SAL)
+    return f"{PREFIJO}${n}${r}${p}${_b64(sal)}${_b64(_scrypt(password, sal, n, r, p))}"
+
+
+def _parametros(almacenado):
+    partes = almacenado.split("$")
+    if len(partes) != 6 or partes[0] != PREFIJO:
+        return None
+    try:
+        return int(partes[1]), int(partes[2]), int(partes[3]), _desde_b64(partes[4]), _desde_b64(partes[5])
+    except ValueError:
+        return None
+
+
+def verificar_password(password, almacenado):
+    parametros = _parametros(almacenado)
+    if parametros is None:
+        # Fila sin migrar: contraseña en texto plano
+        return hmac.compare_digest(password.encode(), almacenado.encode())
+    n, r, p, sal, esperado = parametros
+    return hmac.compare_digest(_scrypt(password, sal, n, r, p), esperado)
+
+
+def necesita_rehash(almacenado, n, r, p):
+    parametros = _parametros(almacenado)
+    return parametros is None or parametros[:3] != (n, r, p)
+
+
+class CacheVerificaciones:
+    # Logins correctos recientes, para no repetir el hash en cada login del
+    # mismo usuario. Se guarda un HMAC (con una clave aleatoria del proceso)
+    # de usuario, contraseña y hash almacenado: nunca la contraseña, y un
+    # cambio de contraseña invalida la entrada. Los fallos no se cachean.
+    def __init__(self, maximo, ttl):
+        self.maximo = maximo
+        self.ttl = ttl
+        self._clave = os.urandom(32)
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _huella(self, username, password, almacenado):
+        mensaje = "\0".join((username, password, almacenado)).encode()
+        return hmac.new(self._clave, mensaje, hashlib.sha256).digest()
+
+    def contiene(self, username, password, almacenado):
+        huella = self._huella(username, password, almacenado)
+        with self._lock:
+            entrada = self._datos.get(username)
+            if entrada is None:
+                return False
+            expira, guardada = entrada
+            if expira < time.monotonic():
+                del self._datos[username]
+                return False
+            self._datos.move_to_end(username)
+        return hmac.compare_digest(huella, guardada)
+
+    def guardar(self, username, password, almacenado):
+        huella = self._huella(username, password, almacenado)
+        with self._lock:
+            self._datos[username] = (time.monotonic() + self.ttl, huella)
+            self._datos.move_to_end(username)
+            while len(self._datos) > self.maximo:
+                self._datos.popitem(last=False)
+
+
+class LimitadorTasa:
+    # Token bucket por clave (IP o usuario): `capacidad` intentos seguidos y
+    # luego `por_minuto` intentos por minuto. Las claves menos usadas salen
+    # por LRU para que una ráfaga de claves distintas no agote la memoria.
+    def __init__(self, capacidad, por_minuto, maximo_claves=10000):
+        self.capacidad = capacidad
+        self.por_segundo = por_minuto / 60
+        self.maximo_claves = maximo_claves
+        self._cubetas = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Devuelve (permitido, segundos hasta el próximo intento permitido)
+    def consumir(self, clave):
+        ahora = time.monotonic()
+        with self._lock:
+            tokens, ultimo = self._cubetas.get(clave, (self.capacidad, ahora))
+            tokens = min(self.capacidad, tokens + (ahora - ultimo) * self.por_segundo)
+            permitido = tokens >= 1
+            if permitido:
+                tokens -= 1
+            self._cubetas[clave] = (tokens, ahora)
+            self._cubetas.move_to_end(clave)
+            while len(self._cubetas) > self.maximo_claves:
+                self._cubetas.popitem(last=False)
+        espera = 0.0 if permitido else (1 - tokens) / self.por_segundo
+        return permitido, espera
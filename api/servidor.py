@@ -0,0 +1,13 @@
+import os
+
+from uvicorn.workers import UvicornWorker
+
+# Worker de gunicorn para la API (ver gunicorn.conf.py). Los streams de
+# eventos no terminan solos: al apagarse o recargarse, el worker los corta a
+# los API_APAGADO_STREAMS segundos para cerrar su pool y sus planificadores
+# antes de que gunicorn lo mate por graceful_timeout.
+API_APAGADO_STREAMS = int(os.getenv("API_APAGADO_STREAMS", "5"))
+
+
+class WorkerInventario(UvicornWorker):
+    CONFIG_KWARGS = {**UvicornWorker.CONFIG_KWARGS, "timeout_graceful_shutdown": API_APAGADO_STREAMS}
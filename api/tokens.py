@@ -0,0 +1,65 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+# Tokens firmados con HMAC-SHA256 en formato JWT (HS256). Llevan el id y el
+# rol del usuario, así la API autoriza cada petición verificando la firma con
+# una clave en memoria, sin consultar la tabla usuarios. El token de acceso
+# dura poco; el de refresco sirve para pedir uno nuevo sin volver a enviar la
+# contraseña. El de eventos solo abre el stream /eventos/equipos: el navegador
+# lo envía en la URL (EventSource no admite cabeceras), así que dura menos aún.
+
+ACCESO = "acceso"
+REFRESCO = "refresco"
+EVENTOS = "eventos"
+
+
+class TokenInvalido(Exception):
+    pass
+
+
+def _b64(datos):
+    return base64.urlsafe_b64encode(datos).rstrip(b"=").decode()
+
+
+def _desde_b64(texto):
+    return base64.urlsafe_b64decode(texto + "=" * (-len(texto) % 4))
+
+
+_CABECERA = _b64(json.dumps({"alg": "HS256", "typ": "JWT"}, separators=(",", ":")).encode())
+
+
+class FirmadorTokens:
+    def __init__(self, clave, ttl_acceso, ttl_refresco, ttl_eventos):
+        self._clave = clave
+        self.ttls = {ACCESO: ttl_acceso, REFRESCO: ttl_refresco, EVENTOS: ttl_eventos}
+
+    def _firma(self, contenido):
+        return hmac.new(self._clave, contenido.encode(), hashlib.sha256).digest()
+
+    def emitir(self, usuario_id, rol, tipo):
+        ahora = int(time.time())
+        datos = {"sub": str(usuario_id), "rol": rol, "tipo": tipo, "iat": ahora, "exp": ahora + self.ttls[tipo]}
+        contenido = _CABECERA + "." + _b64(json.dumps(datos, separators=(",", ":")).encode())
+        return contenido + "." + _b64(self._firma(contenido))
+
+    def verificar(self, token, tipo):
+        try:
+            cabecera, carga, firma = token.split(".")
+            firma_valida = hmac.compare_digest(self._firma(cabecera + "." + carga), _desde_b64(firma))
+        except (ValueError, TypeError):
+            raise TokenInvalido("Token mal formado")
+        if cabecera != _CABECERA or not firma_valida:
+            raise TokenInvalido("Firma del token inválida")
+
+        try:
+            datos = json.loads(_desde_b64(carga))
+        except ValueError:
+            raise TokenInvalido("Token mal formado")
+        if datos.get("tipo") != tipo:
+            raise TokenInvalido("Tipo de token incorrecto")
+        if datos.get("exp", 0) <= time.time():
+            raise TokenInvalido("Token expirado")
+        return datos
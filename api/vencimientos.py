@@ -0,0 +1,178 @@
+import logging
+import threading
+
+from db import PoolAgotadoError, liberar_conexion, obtener_conexion
+
+# Detección de préstamos vencidos en segundo plano.
+#
+# Cada ciclo procesa en lotes de `lote` filas, cada lote en transacciones
+# cortas:
+#   1. marcar: préstamos activos con la fecha de devolución ya pasada y sin
+#      aviso (índice parcial idx_prestamos_aviso_pendiente) -> se marcan, se
+#      registra el vencimiento en el historial y se encola un recordatorio;
+#   2. enviar: los recordatorios pendientes se reclaman por RECLAMO_SEGUNDOS
+#      y se confirma; se entregan al destino configurado sin transacción ni
+#      conexión abiertas (un servidor de correo lento no retiene bloqueos ni
+#      conexiones del pool) y el resultado se registra en otra transacción.
+#      Si el worker muere a mitad del envío, el reclamo vence y el lote se
+#      vuelve a enviar.
+# Los lotes se toman con FOR UPDATE SKIP LOCKED, así varios workers de la API
+# pueden ejecutar el planificador a la vez sin procesar dos veces la misma fila.
+
+logger = logging.getLogger("inventario.api.vencimientos")
+
+# Más de lo que puede tardar en entregarse un lote
+RECLAMO_SEGUNDOS = 600
+
+
+def marcar_vencidos(conn, lote):
+    cur = conn.cursor()
+    cur.execute("""
+        WITH vencidos AS (
+            SELECT id
+            FROM prestamos
+            WHERE estado = 'activo' AND fecha_aviso_vencimiento IS NULL
+              AND fecha_devolucion_esperada < CURRENT_DATE
+            ORDER BY fecha_devolucion_esperada, id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        ), marcados AS (
+            UPDATE prestamos p SET fecha_aviso_vencimiento = CURRENT_TIMESTAMP
+            FROM vencidos v
+            WHERE p.id = v.id
+            RETURNING p.id, p.equipo_id, p.usuario_id, p.fecha_devolucion_esperada
+        ), historial AS (
+            -- Un evento, no un cambio de estado: el equipo sigue prestado
+            INSERT INTO historial_equipos (equipo_id, estado_anterior, estado_nuevo, usuario_responsable, motivo)
+            SELECT m.equipo_id, e.estado, e.estado, m.usuario_id,
+                   'Préstamo vencido: debía devolverse el ' || to_char(m.fecha_devolucion_esperada, 'YYYY-MM-DD')
+            FROM marcados m
+            JOIN equipos e ON e.id = m.equipo_id
+        ), encolados AS (
+            INSERT INTO recordatorios (prestamo_id, usuario_id)
+            SELECT id, usuario_id FROM marcados
+        )
+        SELECT count(*) AS total FROM marcados
+    """, (lote,))
+    return cur.fetchone()["total"]
+
+
+# Reclama un lote de recordatorios pendientes para enviarlo fuera de la
+# transacción
+def reclamar_recordatorios(conn, lote, max_intentos):
+    cur = conn.cursor()
+    # Los préstamos devueltos antes del envío ya no necesitan recordatorio
+    cur.execute("""
+        DELETE FROM recordatorios r
+        USING prestamos p
+        WHERE r.enviado_at IS NULL AND p.id = r.prestamo_id AND p.estado <> 'activo'
+    """)
+    cur.execute("""
+        WITH reclamados AS (
+            SELECT r.id
+            FROM recordatorios r
+            WHERE r.enviado_at IS NULL AND r.intentos < %s
+              AND (r.reclamado_hasta IS NULL OR r.reclamado_hasta < CURRENT_TIMESTAMP)
+            ORDER BY r.id
+            LIMIT %s
+            FOR UPDATE OF r SKIP LOCKED
+        ), actualizados AS (
+            UPDATE recordatorios r SET reclamado_hasta = CURRENT_TIMESTAMP + %s * interval '1 second'
+            FROM reclamados c
+            WHERE r.id = c.id
+            RETURNING r.id, r.prestamo_id, r.usuario_id
+        )
+        SELECT a.id, a.prestamo_id, u.email, u.nombre_completo AS usuario_nombre,
+               e.nombre AS equipo_nombre, p.fecha_devolucion_esperada
+        FROM actualizados a
+        JOIN prestamos p ON p.id = a.prestamo_id
+        JOIN usuarios u ON u.id = a.usuario_id
+        JOIN equipos e ON e.id = p.equipo_id
+        ORDER BY a.id
+    """, (max_intentos, lote, RECLAMO_SEGUNDOS))
+    return cur.fetchall()
+
+
+# Registra el resultado del envío (un error por recordatorio, None si se
+# entregó) y libera el reclamo; devuelve cuántos se entregaron
+def registrar_envios(conn, pendientes, errores):
+    cur = conn.cursor()
+    enviados = [r["id"] for r, error in zip(pendientes, errores) if error is None]
+    fallidos = [(r["id"], error) for r, error in zip(pendientes, errores) if error is not None]
+
+    if enviados:
+        cur.execute("""
+            UPDATE recordatorios SET enviado_at = CURRENT_TIMESTAMP, intentos = intentos + 1,
+                                     reclamado_hasta = NULL
+            WHERE id = ANY(%s)
+        """, (enviados,))
+    if fallidos:
+        cur.execute("""
+            UPDATE recordatorios r SET intentos = r.intentos + 1, ultimo_error = f.error, reclamado_hasta = NULL
+            FROM unnest(%s::int[], %s::text[]) AS f(id, error)
+            WHERE r.id = f.id
+        """, ([i for i, _ in fallidos], [e for _, e in fallidos]))
+        logger.warning("recordatorios no enviados", extra={
+            "fallidos": len(fallidos), "primer_error": fallidos[0][1],
+        })
+    return len(enviados)
+
+
+class PlanificadorVencimientos:
+    def __init__(self, intervalo, lote, destino, max_intentos=5):
+        self.intervalo = intervalo
+        self.lote = lote
+        self.destino = destino
+        self.max_intentos = max_intentos
+        self._detener = threading.Event()
+        self._hilo = threading.Thread(target=self._ejecutar, name="vencimientos", daemon=True)
+
+    def iniciar(self):
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self._hilo.join(timeout=30)
+
+    def _ejecutar(self):
+        while not self._detener.is_set():
+            try:
+                self.ejecutar_ciclo()
+            except PoolAgotadoError as e:
+                logger.warning("ciclo de vencimientos omitido", extra={"motivo": str(e)})
+            except Exception:
+                logger.exception("error en el ciclo de vencimientos")
+            self._detener.wait(self.intervalo)
+
+    def _en_transaccion(self, funcion, *args):
+        conn = obtener_conexion()
+        try:
+            resultado = funcion(conn, *args)
+            conn.commit()
+            return resultado
+        finally:
+            liberar_conexion(conn)
+
+    def ejecutar_ciclo(self):
+        marcados = 0
+        while not self._detener.is_set():
+            n = self._en_transaccion(marcar_vencidos, self.lote)
+            marcados += n
+            if n < self.lote:
+                break
+
+        # Si algún envío falla se deja el resto para el siguiente ciclo
+        enviados = 0
+        while not self._detener.is_set():
+            pendientes = self._en_transaccion(reclamar_recordatorios, self.lote, self.max_intentos)
+            if not pendientes:
+                break
+            errores = self.destino.enviar(pendientes)
+            ok = self._en_transaccion(registrar_envios, pendientes, errores)
+            enviados += ok
+            if len(pendientes) < self.lote or ok < len(pendientes):
+                break
+
+        if marcados or enviados:
+            logger.info("ciclo de vencimientos", extra={"marcados": marcados, "recordatorios_enviados": enviados})
+        return marcados, enviados
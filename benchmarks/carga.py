@@ -0,0 +1,256 @@
+"""Prueba de carga de la API (y opcionalmente de la webapp) con una mezcla de tráfico.
+
+Cada hilo elige un escenario según los pesos de --mezcla y ejecuta sus
+peticiones; se mide cada petición por separado y al final se reporta, por
+endpoint, el throughput y las latencias p50/p95/p99. Con --salida los
+resultados se guardan en JSON para compararlos entre versiones con
+benchmarks/comparar.py.
+
+Escenarios:
+    catalogo   GET /equipos, /equipos/disponibles, /equipos/{id}, /equipos/disponibles/count
+    historial  GET /historial, /historial/usuario/{id}, /historial/equipo/{id}
+    prestamos  GET /prestamos (con y sin filtro de usuario)
+    ciclo      POST /prestamos seguido de PUT /prestamos/{id}/devolver
+    web        páginas de la webapp (requiere --webapp-url)
+
+Uso:
+    python benchmarks/carga.py --api-url http://localhost:8000 --duracion 60 --concurrencia 32 \\
+        --mezcla catalogo=60,historial=15,prestamos=10,ciclo=15 --salida resultados.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import requests
+
+
+class Registro:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias = defaultdict(list)
+        self.codigos = defaultdict(lambda: defaultdict(int))
+        self.errores = defaultdict(int)
+
+    def medir(self, nombre, funcion):
+        inicio = time.perf_counter()
+        try:
+            respuesta = funcion()
+        except requests.RequestException:
+            with self._lock:
+                self.errores[nombre] += 1
+            return None
+        duracion = time.perf_counter() - inicio
+        with self._lock:
+            self.latencias[nombre].append(duracion)
+            self.codigos[nombre][respuesta.status_code] += 1
+            if respuesta.status_code >= 500:
+                self.errores[nombre] += 1
+        return respuesta
+
+
+def percentil(valores_ordenados, p):
+    if not valores_ordenados:
+        return 0.0
+    indice = max(0, min(len(valores_ordenados) - 1, int(round(p / 100 * len(valores_ordenados) + 0.5)) - 1))
+    return valores_ordenados[indice]
+
+
+class Escenarios:
+    def __init__(self, api_url, webapp_url, registro, datos):
+        self.api_url = api_url
+        self.webapp_url = webapp_url
+        self.registro = registro
+        self.datos = datos
+
+    def _equipo(self):
+        return random.choice(self.datos["equipos"])
+
+    def _usuario(self):
+        return random.choice(self.datos["usuarios"])
+
+    def catalogo(self, sesion):
+        m = self.registro.medir
+        m("GET /equipos", lambda: sesion.get(f"{self.api_url}/equipos"))
+        m("GET /equipos/disponibles", lambda: sesion.get(f"{self.api_url}/equipos/disponibles"))
+        m("GET /equipos/{id}", lambda: sesion.get(f"{self.api_url}/equipos/{self._equipo()}"))
+        m("GET /equipos/disponibles/count", lambda: sesion.get(f"{self.api_url}/equipos/disponibles/count"))
+
+    def historial(self, sesion):
+        m = self.registro.medir
+        m("GET /historial", lambda: sesion.get(f"{self.api_url}/historial"))
+        m("GET /historial/usuario/{id}", lambda: sesion.get(f"{self.api_url}/historial/usuario/{self._usuario()}"))
+        m("GET /historial/equipo/{id}", lambda: sesion.get(f"{self.api_url}/historial/equipo/{self._equipo()}"))
+
+    def prestamos(self, sesion):
+        m = self.registro.medir
+        m("GET /prestamos", lambda: sesion.get(f"{self.api_url}/prestamos"))
+        m("GET /prestamos?usuario_id", lambda: sesion.get(
+            f"{self.api_url}/prestamos", params={"usuario_id": self._usuario(), "estado": "activo"}))
+
+    def ciclo(self, sesion):
+        m = self.registro.medir
+        r = m("POST /prestamos", lambda: sesion.post(f"{self.api_url}/prestamos", json={
+            "equipo_id": self._equipo(), "usuario_id": self._usuario(), "motivo": "benchmark"}))
+        if r is not None and r.status_code == 200:
+            prestamo_id = r.json()["id"]
+            m("PUT /prestamos/{id}/devolver", lambda: sesion.put(f"{self.api_url}/prestamos/{prestamo_id}/devolver"))
+
+    def web(self, sesion):
+        m = self.registro.medir
+        if not sesion.cookies:
+            m("WEB POST /login", lambda: sesion.post(f"{self.webapp_url}/login", data={
+                "username": self.datos["login"][0], "password": self.datos["login"][1]}))
+        m("WEB GET /equipos", lambda: sesion.get(f"{self.webapp_url}/equipos"))
+        m("WEB GET /prestamos", lambda: sesion.get(f"{self.webapp_url}/prestamos"))
+        m("WEB GET /historial", lambda: sesion.get(f"{self.webapp_url}/historial"))
+
+
+def preparar_datos(api_url, usuarios, login):
+    # Un solo login (admin) para toda la prueba: los trabajadores comparten el
+    # token de acceso y así el hash de la contraseña no entra en lo medido
+    r = requests.post(f"{api_url}/login", json={"username": login[0], "password": login[1]})
+    r.raise_for_status()
+    token = r.json()["token_acceso"]
+
+    # Ids de equipos reales para que las lecturas por id y los préstamos acierten
+    r = requests.get(f"{api_url}/equipos", params={"limit": 500}, headers={"Authorization": f"Bearer {token}"})
+    r.raise_for_status()
+    equipos = [e["id"] for e in r.json()["items"]]
+    if not equipos:
+        sys.exit("No hay equipos; ejecuta primero benchmarks/sembrar.py")
+    return {"equipos": equipos, "usuarios": usuarios, "login": login, "token": token}
+
+
+# "1,2,5-8" -> [1, 2, 5, 6, 7, 8]
+def leer_ids(texto):
+    ids = []
+    for parte in texto.split(","):
+        if "-" in parte:
+            inicio, fin = parte.split("-")
+            ids.extend(range(int(inicio), int(fin) + 1))
+        else:
+            ids.append(int(parte))
+    return ids
+
+
+def version_codigo():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def resumir(registro, duracion):
+    endpoints = {}
+    for nombre in sorted(set(registro.latencias) | set(registro.errores)):
+        valores = sorted(registro.latencias.get(nombre, []))
+        endpoints[nombre] = {
+            "peticiones": len(valores),
+            "errores": registro.errores.get(nombre, 0),
+            "throughput_rps": round(len(valores) / duracion, 2),
+            "p50_ms": round(percentil(valores, 50) * 1000, 2),
+            "p95_ms": round(percentil(valores, 95) * 1000, 2),
+            "p99_ms": round(percentil(valores, 99) * 1000, 2),
+            "max_ms": round(valores[-1] * 1000, 2) if valores else 0.0,
+            "codigos": {str(c): n for c, n in sorted(registro.codigos.get(nombre, {}).items())},
+        }
+    total = sum(e["peticiones"] for e in endpoints.values())
+    return {"total_peticiones": total, "throughput_rps": round(total / duracion, 2), "endpoints": endpoints}
+
+
+def imprimir(resumen):
+    print(f"{'endpoint':40} {'n':>8} {'rps':>9} {'p50':>8} {'p95':>8} {'p99':>8} {'err':>5}")
+    for nombre, e in resumen["endpoints"].items():
+        print(f"{nombre:40} {e['peticiones']:>8} {e['throughput_rps']:>9} {e['p50_ms']:>8} "
+              f"{e['p95_ms']:>8} {e['p99_ms']:>8} {e['errores']:>5}")
+    print(f"total: {resumen['total_peticiones']} peticiones, {resumen['throughput_rps']} rps")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--api-url", default="http://localhost:8000")
+    parser.add_argument("--webapp-url", default=None)
+    parser.add_argument("--duracion", type=float, default=30, help="segundos de carga")
+    parser.add_argument("--calentamiento", type=float, default=3, help="segundos descartados al inicio")
+    parser.add_argument("--concurrencia", type=int, default=16)
+    parser.add_argument("--mezcla", default="catalogo=60,historial=15,prestamos=10,ciclo=15")
+    parser.add_argument("--usuarios", default="1,2,3",
+                        help="ids de usuarios activos para préstamos e historial (p. ej. 1,2,3 o 4-1003)")
+    parser.add_argument("--login", default="admin:admin123", help="usuario:contraseña (administrador) para la API y la webapp")
+    parser.add_argument("--semilla", type=int, default=None)
+    parser.add_argument("--salida", default=None, help="archivo JSON de resultados")
+    args = parser.parse_args()
+
+    if args.semilla is not None:
+        random.seed(args.semilla)
+
+    mezcla = {}
+    for parte in args.mezcla.split(","):
+        nombre, peso = parte.split("=")
+        mezcla[nombre.strip()] = float(peso)
+    if "web" in mezcla and not args.webapp_url:
+        sys.exit("El escenario 'web' requiere --webapp-url")
+
+    datos = preparar_datos(args.api_url, leer_ids(args.usuarios), tuple(args.login.split(":", 1)))
+    nombres = list(mezcla)
+    pesos = [mezcla[n] for n in nombres]
+    for nombre in nombres:
+        if not hasattr(Escenarios, nombre):
+            sys.exit(f"Escenario desconocido: {nombre}")
+
+    # Lo medido durante el calentamiento va a un registro aparte que se descarta
+    registro = Registro()
+    registro_calentamiento = Registro()
+    fin_calentamiento = time.monotonic() + args.calentamiento
+    fin = fin_calentamiento + args.duracion
+
+    def trabajador():
+        escenarios = Escenarios(args.api_url, args.webapp_url, registro_calentamiento, datos)
+        sesion = requests.Session()
+        sesion.headers["Authorization"] = f"Bearer {datos['token']}"
+        while True:
+            ahora = time.monotonic()
+            if ahora >= fin:
+                break
+            if ahora >= fin_calentamiento:
+                escenarios.registro = registro
+            getattr(escenarios, random.choices(nombres, pesos)[0])(sesion)
+
+    hilos = [threading.Thread(target=trabajador, daemon=True) for _ in range(args.concurrencia)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    resumen = resumir(registro, args.duracion)
+    imprimir(resumen)
+
+    if args.salida:
+        resultado = {
+            "fecha": datetime.now(timezone.utc).isoformat(),
+            "version": version_codigo(),
+            "python": platform.python_version(),
+            "configuracion": {
+                "api_url": args.api_url, "webapp_url": args.webapp_url, "duracion": args.duracion,
+                "concurrencia": args.concurrencia, "mezcla": mezcla,
+            },
+            **resumen,
+        }
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"Resultados guardados en {args.salida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Compara dos resultados de benchmarks/carga.py y marca las regresiones.
+
+Para cada endpoint presente en ambos archivos compara p50/p95/p99 y el
+throughput; termina con código 1 si alguna métrica empeora más que el umbral.
+
+Uso:
+    python benchmarks/comparar.py base.json nuevo.json --umbral 10
+"""
+import argparse
+import json
+import sys
+
+LATENCIAS = ("p50_ms", "p95_ms", "p99_ms")
+
+
+def variacion(antes, despues):
+    if not antes:
+        return 0.0
+    return (despues - antes) / antes * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base")
+    parser.add_argument("nuevo")
+    parser.add_argument("--umbral", type=float, default=10, help="porcentaje de empeoramiento tolerado")
+    args = parser.parse_args()
+
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.nuevo, encoding="utf-8") as f:
+        nuevo = json.load(f)
+
+    print(f"base: {base.get('version')} ({base.get('fecha')})  nuevo: {nuevo.get('version')} ({nuevo.get('fecha')})")
+    print(f"{'endpoint':40} {'métrica':>14} {'base':>10} {'nuevo':>10} {'cambio':>9}")
+
+    regresiones = []
+    for nombre, e_nuevo in nuevo["endpoints"].items():
+        e_base = base["endpoints"].get(nombre)
+        if e_base is None:
+            continue
+        for metrica in LATENCIAS + ("throughput_rps",):
+            cambio = variacion(e_base[metrica], e_nuevo[metrica])
+            # En throughput lo malo es bajar; en latencias, subir
+            empeora = -cambio if metrica == "throughput_rps" else cambio
+            marca = ""
+            if empeora > args.umbral:
+                marca = "  REGRESIÓN"
+                regresiones.append((nombre, metrica, cambio))
+            print(f"{nombre:40} {metrica:>14} {e_base[metrica]:>10} {e_nuevo[metrica]:>10} {cambio:>+8.1f}%{marca}")
+
+    if regresiones:
+        print(f"\n{len(regresiones)} regresiones por encima del {args.umbral}%")
+        sys.exit(1)
+    print("\nSin regresiones")
+
+
+if __name__ == "__main__":
+    main()
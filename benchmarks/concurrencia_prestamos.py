@@ -0,0 +1,115 @@
+"""Prueba de concurrencia de préstamos y devoluciones.
+
+Lanza muchos clientes a la vez contra un mismo equipo y comprueba que
+exactamente un préstamo gana (y que exactamente una devolución lo cierra).
+Termina con código 1 si alguna ronda viola la regla.
+
+Uso:
+    python benchmarks/concurrencia_prestamos.py --api-url http://localhost:8000 \\
+        --equipo-id 1 --clientes 50 --rondas 20
+"""
+import argparse
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def disparar_a_la_vez(clientes, funcion):
+    # Todos los hilos esperan en la barrera y salen juntos
+    barrera = threading.Barrier(clientes)
+
+    def tarea(i):
+        barrera.wait()
+        return funcion(i)
+
+    with ThreadPoolExecutor(max_workers=clientes) as executor:
+        return list(executor.map(tarea, range(clientes)))
+
+
+def iniciar_sesion(api_url, login):
+    username, password = login.split(":", 1)
+    r = requests.post(f"{api_url}/login", json={"username": username, "password": password})
+    r.raise_for_status()
+    return {"Authorization": f"Bearer {r.json()['token_acceso']}"}
+
+
+def prestamos_activos(sesion, api_url, equipo_id):
+    r = sesion.get(f"{api_url}/prestamos", params={"equipo_id": equipo_id, "estado": "activo", "limit": 500})
+    r.raise_for_status()
+    return r.json()["items"]
+
+
+def ronda(api_url, equipo_id, usuarios, clientes, cabeceras):
+    sesiones = [requests.Session() for _ in range(clientes)]
+    for sesion in sesiones:
+        sesion.headers.update(cabeceras)
+
+    def prestar(i):
+        r = sesiones[i].post(f"{api_url}/prestamos", json={
+            "equipo_id": equipo_id,
+            "usuario_id": usuarios[i % len(usuarios)],
+            "motivo": f"prueba de concurrencia {i}",
+        })
+        return r.status_code, r.json().get("id") if r.status_code == 200 else None
+
+    resultados = disparar_a_la_vez(clientes, prestar)
+    codigos = Counter(codigo for codigo, _ in resultados)
+    ganadores = [prestamo_id for codigo, prestamo_id in resultados if codigo == 200]
+    activos = prestamos_activos(sesiones[0], api_url, equipo_id)
+    errores = []
+
+    if len(ganadores) != 1:
+        errores.append(f"préstamo: {len(ganadores)} ganadores (esperado 1), códigos {dict(codigos)}")
+    if len(activos) != 1:
+        errores.append(f"préstamo: {len(activos)} préstamos activos en la base de datos (esperado 1)")
+    if not ganadores:
+        return codigos, Counter(), errores
+
+    def devolver(i):
+        return sesiones[i].put(f"{api_url}/prestamos/{ganadores[0]}/devolver").status_code
+
+    codigos_devolucion = Counter(disparar_a_la_vez(clientes, devolver))
+    if codigos_devolucion.get(200, 0) != 1:
+        errores.append(f"devolución: códigos {dict(codigos_devolucion)} (esperado un solo 200)")
+    if prestamos_activos(sesiones[0], api_url, equipo_id):
+        errores.append("devolución: el préstamo sigue activo")
+
+    return codigos, codigos_devolucion, errores
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--api-url", default="http://localhost:8000")
+    parser.add_argument("--equipo-id", type=int, default=1)
+    parser.add_argument("--usuarios", default="1,2,3", help="ids de usuarios activos, separados por comas")
+    parser.add_argument("--clientes", type=int, default=50)
+    parser.add_argument("--rondas", type=int, default=10)
+    parser.add_argument("--login", default="admin:admin123",
+                        help="usuario:contraseña de un administrador (presta a nombre de otros usuarios)")
+    args = parser.parse_args()
+
+    usuarios = [int(u) for u in args.usuarios.split(",")]
+    cabeceras = iniciar_sesion(args.api_url, args.login)
+    equipo = requests.get(f"{args.api_url}/equipos/{args.equipo_id}", headers=cabeceras)
+    equipo.raise_for_status()
+    if equipo.json()["estado"] != "disponible":
+        sys.exit(f"El equipo {args.equipo_id} debe estar disponible antes de la prueba")
+
+    fallos = 0
+    for numero in range(1, args.rondas + 1):
+        codigos, codigos_devolucion, errores = ronda(args.api_url, args.equipo_id, usuarios, args.clientes, cabeceras)
+        estado = "OK" if not errores else "FALLO"
+        print(f"ronda {numero}: {estado} préstamo={dict(codigos)} devolución={dict(codigos_devolucion)}")
+        for error in errores:
+            print(f"  - {error}")
+        fallos += bool(errores)
+
+    print(f"{args.rondas - fallos}/{args.rondas} rondas correctas")
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,7 @@
 CREATE TABLE IF NOT EXISTS usuarios (
     id SERIAL PRIMARY KEY,
     username VARCHAR(50) UNIQUE NOT NULL,
-    password VARCHAR(100) NOT NULL,
+    password VARCHAR(255) NOT NULL, -- hash scrypt; las filas en texto plano se migran en el siguiente login
     nombre_completo VARCHAR(100) NOT NULL,
     email VARCHAR(100),
     tipo_usuario VARCHAR(20) DEFAULT 'estudiante', -- estudiante, profesor, admin
@@ -19,7 +19,9 @@ CREATE TABLE IF NOT EXISTS equipos (
     nombre VARCHAR(100) NOT NULL,
     estado VARCHAR(20) DEFAULT 'disponible', -- disponible, prestado
     descripcion TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    busqueda TSVECTOR, -- nombre y descripción para la búsqueda de texto (la mantiene un trigger)
+    deleted_at TIMESTAMP NULL -- baja lógica: el equipo sale del catálogo pero préstamos e historial lo siguen referenciando
 );
  
 -- Tabla de préstamos
@@ -34,19 +36,95 @@ CREATE TABLE IF NOT EXISTS prestamos (
     estado VARCHAR(20) DEFAULT 'activo', -- activo, devuelto
     observaciones_prestamo TEXT,
     observaciones_devolucion TEXT,
+    fecha_aviso_vencimiento TIMESTAMP NULL, -- cuándo se detectó vencido y se encoló el recordatorio
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
+
+-- Reservas de equipos: período (tstzrange) en que un equipo queda apartado
+-- para un usuario. Un préstamo también ocupa aquí su período, desde la
+-- entrega hasta la devolución esperada (estado 'en_prestamo'), así la
+-- restricción de exclusión impide en la propia base de datos que dos
+-- reservas, o una reserva y un préstamo, se solapen para el mismo equipo.
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+
+CREATE TABLE IF NOT EXISTS reservas (
+    id SERIAL PRIMARY KEY,
+    equipo_id INTEGER NOT NULL REFERENCES equipos(id),
+    usuario_id INTEGER NOT NULL REFERENCES usuarios(id),
+    periodo TSTZRANGE NOT NULL CHECK (NOT isempty(periodo) AND NOT lower_inf(periodo) AND NOT upper_inf(periodo)),
+    motivo TEXT,
+    estado VARCHAR(20) NOT NULL DEFAULT 'activa', -- activa, en_prestamo, finalizada, cancelada
+    prestamo_id INTEGER REFERENCES prestamos(id),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT reservas_sin_solapamiento EXCLUDE USING gist (equipo_id WITH =, periodo WITH &&)
+        WHERE (estado IN ('activa', 'en_prestamo'))
+);
  
 -- Tabla de historial de cambios de estado - NUEVA EN V4.0
+-- Particionada por mes de fecha_cambio: las consultas por fecha solo leen las
+-- particiones del rango y las más antiguas se archivan (ver más abajo y
+-- api/particiones.py). La partición por defecto recibe las filas de meses
+-- que aún no tienen partición.
 CREATE TABLE IF NOT EXISTS historial_equipos (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     equipo_id INTEGER REFERENCES equipos(id),
     estado_anterior VARCHAR(20),
     estado_nuevo VARCHAR(20),
     usuario_responsable INTEGER REFERENCES usuarios(id),
     motivo TEXT,
-    fecha_cambio TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+    fecha_cambio TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, fecha_cambio)
+) PARTITION BY RANGE (fecha_cambio);
+
+CREATE TABLE IF NOT EXISTS historial_equipos_default PARTITION OF historial_equipos DEFAULT;
+
+-- Crea las particiones mensuales (historial_equipos_AAAA_MM) que falten para
+-- cubrir [desde, hasta]. Si la partición por defecto ya tiene filas de uno de
+-- esos meses se mueven a la partición nueva antes de adjuntarla. Los meses ya
+-- archivados no se vuelven a crear: sus filas tardías quedan en la partición
+-- por defecto.
+CREATE OR REPLACE FUNCTION crear_particiones_historial(desde DATE, hasta DATE) RETURNS integer AS $$
+DECLARE
+    mes DATE := date_trunc('month', desde);
+    siguiente DATE;
+    nombre TEXT;
+    creadas INTEGER := 0;
+BEGIN
+    WHILE mes <= hasta LOOP
+        siguiente := mes + interval '1 month';
+        nombre := 'historial_equipos_' || to_char(mes, 'YYYY_MM');
+        IF to_regclass('public.' || nombre) IS NULL AND to_regclass('archivo.' || nombre) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I (LIKE historial_equipos INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', nombre);
+            EXECUTE format(
+                'WITH movidas AS (DELETE FROM historial_equipos_default WHERE fecha_cambio >= %L AND fecha_cambio < %L RETURNING *) '
+                'INSERT INTO %I SELECT * FROM movidas', mes, siguiente, nombre);
+            EXECUTE format('ALTER TABLE historial_equipos ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                           nombre, mes, siguiente);
+            creadas := creadas + 1;
+        END IF;
+        mes := siguiente;
+    END LOOP;
+    RETURN creadas;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Último año y los próximos meses; el mantenimiento de la API crea las
+-- siguientes a medida que se acercan
+SELECT crear_particiones_historial((CURRENT_DATE - interval '12 months')::date, (CURRENT_DATE + interval '3 months')::date);
+
+-- Archivo del historial: las particiones que superan la retención se separan
+-- de historial_equipos y se adjuntan aquí, así las consultas normales no las
+-- recorren pero siguen disponibles en historial_completo. Cada una se exporta
+-- además a un CSV comprimido.
+CREATE SCHEMA IF NOT EXISTS archivo;
+
+CREATE TABLE IF NOT EXISTS archivo.historial_equipos (LIKE historial_equipos)
+    PARTITION BY RANGE (fecha_cambio);
+
+CREATE OR REPLACE VIEW historial_completo AS
+    SELECT * FROM historial_equipos
+    UNION ALL
+    SELECT * FROM archivo.historial_equipos;
  
 -- Insertar usuarios de prueba
 INSERT INTO usuarios (username, password, nombre_completo, email, tipo_usuario) VALUES
@@ -68,10 +146,366 @@ INSERT INTO equipos (nombre, descripcion, estado) VALUES
  
 -- Crear índices para mejorar rendimiento
 CREATE INDEX idx_usuarios_username ON usuarios(username);
-CREATE INDEX idx_equipos_estado ON equipos(estado);
+-- Los índices del catálogo son parciales sobre los equipos vigentes: las
+-- consultas que filtran deleted_at IS NULL no recorren los dados de baja
+CREATE INDEX idx_equipos_estado ON equipos(estado) WHERE deleted_at IS NULL;
+CREATE INDEX idx_equipos_vigentes ON equipos(id) WHERE deleted_at IS NULL;
+CREATE INDEX idx_equipos_bajas ON equipos(deleted_at, id) WHERE deleted_at IS NOT NULL;
 CREATE INDEX idx_prestamos_estado ON prestamos(estado);
-CREATE INDEX idx_prestamos_fecha ON prestamos(fecha_prestamo);
-CREATE INDEX idx_historial_equipo ON historial_equipos(equipo_id);
-CREATE INDEX idx_historial_fecha ON historial_equipos(fecha_cambio);
+-- Índices compuestos para la paginación por cursor (fecha, id) con y sin filtro
+CREATE INDEX idx_prestamos_fecha ON prestamos(fecha_prestamo, id);
+CREATE INDEX idx_prestamos_usuario_fecha ON prestamos(usuario_id, fecha_prestamo, id);
+CREATE INDEX idx_prestamos_equipo_fecha ON prestamos(equipo_id, fecha_prestamo, id);
+CREATE INDEX idx_historial_equipo ON historial_equipos(equipo_id, fecha_cambio, id);
+CREATE INDEX idx_historial_fecha ON historial_equipos(fecha_cambio, id);
+CREATE INDEX idx_historial_usuario_fecha ON historial_equipos(usuario_responsable, fecha_cambio, id);
+-- Los mismos índices en el archivo, para que las particiones se adjunten sin reconstruirlos
+CREATE INDEX IF NOT EXISTS idx_archivo_historial_equipo ON archivo.historial_equipos(equipo_id, fecha_cambio, id);
+CREATE INDEX IF NOT EXISTS idx_archivo_historial_fecha ON archivo.historial_equipos(fecha_cambio, id);
+CREATE INDEX IF NOT EXISTS idx_archivo_historial_usuario_fecha ON archivo.historial_equipos(usuario_responsable, fecha_cambio, id);
+-- Préstamos activos por vencimiento (listado de vencidos) y, aparte, los
+-- vencidos que aún no tienen recordatorio: el planificador recorre solo estos
+CREATE INDEX idx_prestamos_vencimiento ON prestamos(fecha_devolucion_esperada, id) WHERE estado = 'activo';
+CREATE INDEX idx_prestamos_aviso_pendiente ON prestamos(fecha_devolucion_esperada, id)
+    WHERE estado = 'activo' AND fecha_aviso_vencimiento IS NULL;
+
+-- Disponibilidad en una ventana: todas las ocupaciones que la cruzan en un
+-- solo recorrido del índice, sin importar cuántos equipos haya. Por equipo
+-- sirve el índice de la restricción de exclusión (equipo_id, periodo).
+CREATE INDEX idx_reservas_periodo ON reservas USING gist (periodo) WHERE estado IN ('activa', 'en_prestamo');
+CREATE INDEX idx_reservas_usuario ON reservas(usuario_id, lower(periodo), id);
+CREATE INDEX idx_reservas_prestamo ON reservas(prestamo_id) WHERE prestamo_id IS NOT NULL;
+
+ 
+-- Versión por tabla para ETags / GET condicional: cuántas transacciones
+-- confirmadas modificaron la tabla. Cada transacción que la modifica deja una
+-- fila (tabla, transacción) en cambios_tablas y la versión es la base de
+-- versiones_tablas más esas filas. Así las escrituras no comparten ninguna
+-- fila: un contador actualizado en cada sentencia serializaba a todos los
+-- escritores de la tabla hasta el commit y bloqueaba préstamos (equipos y
+-- luego prestamos) contra devoluciones (al revés). compactar_contadores(),
+-- que la API ejecuta periódicamente, pasa las filas confirmadas a la base.
+CREATE TABLE IF NOT EXISTS versiones_tablas (
+    tabla VARCHAR(50) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO versiones_tablas (tabla) VALUES
+('usuarios'), ('equipos'), ('prestamos'), ('historial_equipos'), ('reservas');
+
+CREATE TABLE IF NOT EXISTS cambios_tablas (
+    tabla VARCHAR(50) NOT NULL,
+    transaccion xid8 NOT NULL,
+    PRIMARY KEY (tabla, transaccion)
+);
+
+CREATE OR REPLACE FUNCTION registrar_cambio_tabla(nombre TEXT) RETURNS void AS $$
+    INSERT INTO cambios_tablas (tabla, transaccion) VALUES (nombre, pg_current_xact_id())
+    ON CONFLICT DO NOTHING;
+$$ LANGUAGE sql;
+
+
+CREATE OR REPLACE FUNCTION incrementar_version_tabla() RETURNS trigger AS $$
+BEGIN
+    PERFORM registrar_cambio_tabla(TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_version_usuarios AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON usuarios
+    FOR EACH STATEMENT EXECUTE FUNCTION incrementar_version_tabla();
+CREATE TRIGGER trg_version_equipos AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON equipos
+    FOR EACH STATEMENT EXECUTE FUNCTION incrementar_version_tabla();
+CREATE TRIGGER trg_version_prestamos AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON prestamos
+    FOR EACH STATEMENT EXECUTE FUNCTION incrementar_version_tabla();
+CREATE TRIGGER trg_version_historial AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON historial_equipos
+    FOR EACH STATEMENT EXECUTE FUNCTION incrementar_version_tabla();
+CREATE TRIGGER trg_version_reservas AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON reservas
+    FOR EACH STATEMENT EXECUTE FUNCTION incrementar_version_tabla();
+
+
+-- Estadísticas para el tablero de utilización. Se mantienen incrementalmente
+-- con triggers por sentencia (tablas de transición), así un lote de miles de
+-- filas es una sola actualización agregada y el tablero solo lee unas pocas
+-- filas en lugar de agregar prestamos completo en cada consulta.
+--
+-- Los totales por estado y por fecha de vencimiento los tocan casi todos los
+-- préstamos y devoluciones, así que no se actualizan en su lugar: cada
+-- sentencia inserta sus diferencias como filas nuevas (el total es la suma
+-- por clave) y compactar_contadores() las agrupa periódicamente. Una fila
+-- compartida actualizada quedaría bloqueada hasta el commit, serializando
+-- esas escrituras y bloqueando préstamos (equipos y luego prestamos) contra
+-- devoluciones (al revés). Las filas por equipo sí se actualizan en su lugar:
+-- las escrituras de un mismo equipo ya esperan por su fila en equipos.
+CREATE TABLE IF NOT EXISTS estadisticas_equipos (
+    estado VARCHAR(20) NOT NULL,
+    total BIGINT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS estadisticas_prestamos_equipo (
+    equipo_id INTEGER PRIMARY KEY,
+    prestamos BIGINT NOT NULL DEFAULT 0,
+    devueltos BIGINT NOT NULL DEFAULT 0,
+    segundos_prestado DOUBLE PRECISION NOT NULL DEFAULT 0
+);
+CREATE INDEX idx_estadisticas_mas_prestados ON estadisticas_prestamos_equipo(prestamos DESC, equipo_id);
+
+-- Préstamos activos por fecha de devolución esperada: los activos son la suma
+-- y los vencidos la suma de las fechas ya pasadas (los sin fecha van a 'infinity')
+CREATE TABLE IF NOT EXISTS estadisticas_vencimientos (
+    fecha_devolucion_esperada DATE NOT NULL,
+    activos BIGINT NOT NULL
+);
+
+-- Aplica la diferencia entre las filas nuevas y las viejas de una sentencia.
+-- Las filas por equipo se actualizan en orden de clave para que dos lotes
+-- concurrentes no se bloqueen mutuamente. Los equipos dados de baja no
+-- cuentan: la baja resta del estado que tenían y la purga posterior no
+-- cambia nada.
+CREATE OR REPLACE FUNCTION sumar_estadisticas_equipos(nuevas equipos[], viejas equipos[]) RETURNS void AS $$
+    INSERT INTO estadisticas_equipos (estado, total)
+    SELECT COALESCE(estado, 'sin_estado'), sum(signo)
+    FROM (
+        SELECT estado, 1 AS signo FROM unnest(nuevas) WHERE deleted_at IS NULL
+        UNION ALL
+        SELECT estado, -1 FROM unnest(viejas) WHERE deleted_at IS NULL
+    ) cambios
+    GROUP BY 1
+    HAVING sum(signo) <> 0;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION sumar_estadisticas_prestamos(nuevas prestamos[], viejas prestamos[]) RETURNS void AS $$
+    WITH cambios AS (
+        SELECT p.*, 1 AS signo FROM unnest(nuevas) p
+        UNION ALL
+        SELECT p.*, -1 FROM unnest(viejas) p
+    ), devoluciones AS (
+        SELECT equipo_id, signo, extract(epoch FROM fecha_devolucion_real - fecha_prestamo) AS segundos
+        FROM cambios
+        WHERE estado = 'devuelto' AND fecha_devolucion_real IS NOT NULL
+    ), por_equipo AS (
+        INSERT INTO estadisticas_prestamos_equipo AS e (equipo_id, prestamos, devueltos, segundos_prestado)
+        SELECT c.equipo_id, c.prestamos, COALESCE(d.devueltos, 0), COALESCE(d.segundos, 0)
+        FROM (SELECT equipo_id, sum(signo) AS prestamos FROM cambios GROUP BY equipo_id) c
+        LEFT JOIN (
+            SELECT equipo_id, sum(signo) AS devueltos, sum(signo * segundos) AS segundos
+            FROM devoluciones GROUP BY equipo_id
+        ) d USING (equipo_id)
+        WHERE c.equipo_id IS NOT NULL
+          AND (c.prestamos <> 0 OR COALESCE(d.devueltos, 0) <> 0 OR COALESCE(d.segundos, 0) <> 0)
+        ORDER BY c.equipo_id
+        ON CONFLICT (equipo_id) DO UPDATE SET
+            prestamos = e.prestamos + EXCLUDED.prestamos,
+            devueltos = e.devueltos + EXCLUDED.devueltos,
+            segundos_prestado = e.segundos_prestado + EXCLUDED.segundos_prestado
+    )
+    INSERT INTO estadisticas_vencimientos (fecha_devolucion_esperada, activos)
+    SELECT COALESCE(fecha_devolucion_esperada, 'infinity'), sum(signo)
+    FROM cambios
+    WHERE estado = 'activo'
+    GROUP BY 1
+    HAVING sum(signo) <> 0;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION actualizar_estadisticas_equipos() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM sumar_estadisticas_equipos(ARRAY(SELECT n::equipos FROM nuevas n), '{}');
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM sumar_estadisticas_equipos(ARRAY(SELECT n::equipos FROM nuevas n), ARRAY(SELECT v::equipos FROM viejas v));
+    ELSE
+        PERFORM sumar_estadisticas_equipos('{}', ARRAY(SELECT v::equipos FROM viejas v));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION actualizar_estadisticas_prestamos() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM sumar_estadisticas_prestamos(ARRAY(SELECT n::prestamos FROM nuevas n), '{}');
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM sumar_estadisticas_prestamos(ARRAY(SELECT n::prestamos FROM nuevas n), ARRAY(SELECT v::prestamos FROM viejas v));
+    ELSE
+        PERFORM sumar_estadisticas_prestamos('{}', ARRAY(SELECT v::prestamos FROM viejas v));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_estadisticas_equipos_insert AFTER INSERT ON equipos
+    REFERENCING NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION actualizar_estadisticas_equipos();
+CREATE TRIGGER trg_estadisticas_equipos_update AFTER UPDATE ON equipos
+    REFERENCING OLD TABLE AS viejas NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION actualizar_estadisticas_equipos();
+CREATE TRIGGER trg_estadisticas_equipos_delete AFTER DELETE ON equipos
+    REFERENCING OLD TABLE AS viejas
+    FOR EACH STATEMENT EXECUTE FUNCTION actualizar_estadisticas_equipos();
+CREATE TRIGGER trg_estadisticas_prestamos_insert AFTER INSERT ON prestamos
+    REFERENCING NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION actualizar_estadisticas_prestamos();
+CREATE TRIGGER trg_estadisticas_prestamos_update AFTER UPDATE ON prestamos
+    REFERENCING OLD TABLE AS viejas NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION actualizar_estadisticas_prestamos();
+CREATE TRIGGER trg_estadisticas_prestamos_delete AFTER DELETE ON prestamos
+    REFERENCING OLD TABLE AS viejas
+    FOR EACH STATEMENT EXECUTE FUNCTION actualizar_estadisticas_prestamos();
+
+-- Avisos de disponibilidad: cada sentencia que cambia el estado de equipos
+-- publica en el canal 'equipos_estado' los equipos afectados, en mensajes
+-- JSON [{"id", "nombre", "estado"}, ...] (estado null si el equipo se dio de
+-- baja). NOTIFY admite hasta 8000 bytes por mensaje, y un pg_notify que los
+-- pase falla y revierte la escritura: los equipos se reparten por el tamaño
+-- acumulado de su JSON, no por cantidad. Un mensaje empieza antes de los 7000
+-- bytes y suma como mucho un equipo más (un nombre de 100 caracteres ocupa a lo
+-- sumo 600 bytes escapado), así que se mantiene por debajo del límite.
+-- La purga de equipos ya dados de baja no genera avisos.
+-- Los avisos se entregan al confirmar la transacción, así los oyentes nunca
+-- ven un cambio que luego se revierte.
+CREATE OR REPLACE FUNCTION notificar_cambios_equipos(nuevas equipos[], viejas equipos[]) RETURNS void AS $$
+BEGIN
+    PERFORM pg_notify('equipos_estado', jsonb_agg(cambio ORDER BY id)::text)
+    FROM (
+        -- bytes de los cambios anteriores en el orden de id, con su separador ", "
+        SELECT id, cambio,
+               (sum(octet_length(cambio::text) + 2) OVER (ORDER BY id) - octet_length(cambio::text) - 2) / 7000 AS grupo
+        FROM (
+            SELECT COALESCE(n.id, v.id) AS id,
+                   jsonb_build_object('id', COALESCE(n.id, v.id), 'nombre', COALESCE(n.nombre, v.nombre),
+                                      'estado', CASE WHEN n.deleted_at IS NULL THEN n.estado END) AS cambio
+            FROM unnest(nuevas) n
+            FULL JOIN unnest(viejas) v ON v.id = n.id
+            -- entra o sale del catálogo, o cambia de estado estando en él
+            WHERE (n.id IS NOT NULL AND n.deleted_at IS NULL) <> (v.id IS NOT NULL AND v.deleted_at IS NULL)
+               OR (n.deleted_at IS NULL AND v.deleted_at IS NULL AND n.estado IS DISTINCT FROM v.estado)
+        ) cambios
+    ) agrupados
+    GROUP BY grupo;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION avisar_cambios_equipos() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM notificar_cambios_equipos(ARRAY(SELECT n::equipos FROM nuevas n), '{}');
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM notificar_cambios_equipos(ARRAY(SELECT n::equipos FROM nuevas n), ARRAY(SELECT v::equipos FROM viejas v));
+    ELSE
+        PERFORM notificar_cambios_equipos('{}', ARRAY(SELECT v::equipos FROM viejas v));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_avisos_equipos_insert AFTER INSERT ON equipos
+    REFERENCING NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION avisar_cambios_equipos();
+CREATE TRIGGER trg_avisos_equipos_update AFTER UPDATE ON equipos
+    REFERENCING OLD TABLE AS viejas NEW TABLE AS nuevas
+    FOR EACH STATEMENT EXECUTE FUNCTION avisar_cambios_equipos();
+CREATE TRIGGER trg_avisos_equipos_delete AFTER DELETE ON equipos
+    REFERENCING OLD TABLE AS viejas
+    FOR EACH STATEMENT EXECUTE FUNCTION avisar_cambios_equipos();
+
+-- Reconstrucción completa desde equipos y prestamos: carga inicial y
+-- reparación tras cargas que no disparan triggers (TRUNCATE, restauraciones)
+CREATE OR REPLACE FUNCTION recalcular_estadisticas() RETURNS void AS $$
+    LOCK TABLE equipos, prestamos IN SHARE MODE;
+    TRUNCATE estadisticas_equipos, estadisticas_prestamos_equipo, estadisticas_vencimientos;
+
+    INSERT INTO estadisticas_equipos (estado, total)
+    SELECT COALESCE(estado, 'sin_estado'), count(*) FROM equipos WHERE deleted_at IS NULL GROUP BY 1;
+
+    INSERT INTO estadisticas_prestamos_equipo (equipo_id, prestamos, devueltos, segundos_prestado)
+    SELECT equipo_id, count(*),
+           count(*) FILTER (WHERE estado = 'devuelto' AND fecha_devolucion_real IS NOT NULL),
+           COALESCE(sum(extract(epoch FROM fecha_devolucion_real - fecha_prestamo))
+                    FILTER (WHERE estado = 'devuelto' AND fecha_devolucion_real IS NOT NULL), 0)
+    FROM prestamos
+    WHERE equipo_id IS NOT NULL
+    GROUP BY equipo_id;
+
+    INSERT INTO estadisticas_vencimientos (fecha_devolucion_esperada, activos)
+    SELECT COALESCE(fecha_devolucion_esperada, 'infinity'), count(*)
+    FROM prestamos WHERE estado = 'activo' GROUP BY 1;
+$$ LANGUAGE sql;
+
+-- Compactación de los contadores por transacción (versiones de tablas) y por
+-- sentencia (totales de estadísticas). Un solo compactador a la vez: los
+-- demás workers lo omiten. Borrar y volver a insertar en la misma sentencia
+-- hace que un lector vea las filas sueltas o su suma, nunca ambas ni
+-- ninguna; las filas de transacciones sin confirmar no se tocan.
+CREATE OR REPLACE FUNCTION compactar_contadores() RETURNS void AS $$
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('compactar_contadores')) THEN
+        RETURN;
+    END IF;
+
+    WITH compactados AS (
+        DELETE FROM cambios_tablas RETURNING tabla
+    )
+    UPDATE versiones_tablas v SET version = v.version + c.total
+    FROM (SELECT tabla, count(*) AS total FROM compactados GROUP BY tabla) c
+    WHERE v.tabla = c.tabla;
+
+    WITH compactados AS (
+        DELETE FROM estadisticas_equipos RETURNING estado, total
+    )
+    INSERT INTO estadisticas_equipos (estado, total)
+    SELECT estado, sum(total) FROM compactados GROUP BY estado HAVING sum(total) <> 0;
+
+    WITH compactados AS (
+        DELETE FROM estadisticas_vencimientos RETURNING fecha_devolucion_esperada, activos
+    )
+    INSERT INTO estadisticas_vencimientos (fecha_devolucion_esperada, activos)
+    SELECT fecha_devolucion_esperada, sum(activos) FROM compactados
+    GROUP BY fecha_devolucion_esperada HAVING sum(activos) <> 0;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT recalcular_estadisticas();
+
+
+-- Cola de recordatorios de préstamos vencidos (outbox). El planificador la
+-- llena en la misma transacción que marca el préstamo y otro paso la vacía
+-- enviando por el destino configurado, así un recordatorio no se pierde si
+-- el envío falla o el proceso se reinicia.
+CREATE TABLE IF NOT EXISTS recordatorios (
+    id SERIAL PRIMARY KEY,
+    prestamo_id INTEGER REFERENCES prestamos(id) ON DELETE CASCADE,
+    usuario_id INTEGER REFERENCES usuarios(id),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    enviado_at TIMESTAMP NULL,
+    intentos INTEGER NOT NULL DEFAULT 0,
+    ultimo_error TEXT,
+    -- Reclamado por un worker que lo está enviando (ver api/vencimientos.py)
+    reclamado_hasta TIMESTAMP NULL
+);
+CREATE INDEX idx_recordatorios_pendientes ON recordatorios(id) WHERE enviado_at IS NULL;
+
+
+-- Búsqueda en el catálogo: texto completo sobre nombre (peso A) y descripción
+-- (peso B) con el índice GIN de equipos.busqueda, más coincidencia por
+-- trigramas sobre el nombre para tolerar errores de tipeo ("proyecter").
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE OR REPLACE FUNCTION vector_busqueda_equipo(nombre TEXT, descripcion TEXT) RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('spanish', COALESCE(nombre, '')), 'A')
+        || setweight(to_tsvector('spanish', COALESCE(descripcion, '')), 'B');
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION actualizar_busqueda_equipo() RETURNS trigger AS $$
+BEGIN
+    NEW.busqueda := vector_busqueda_equipo(NEW.nombre, NEW.descripcion);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_busqueda_equipos BEFORE INSERT OR UPDATE OF nombre, descripcion ON equipos
+    FOR EACH ROW EXECUTE FUNCTION actualizar_busqueda_equipo();
+
+UPDATE equipos SET busqueda = vector_busqueda_equipo(nombre, descripcion);
 
- 
\ No newline at end of file
+CREATE INDEX idx_equipos_busqueda ON equipos USING GIN (busqueda) WHERE deleted_at IS NULL;
+CREATE INDEX idx_equipos_nombre_trgm ON equipos USING GIN (nombre gin_trgm_ops) WHERE deleted_at IS NULL;
@@ -1,30 +1,273 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import (
+    Flask, render_template, request, redirect, url_for, session, flash, copy_current_request_context,
+    g, has_app_context, has_request_context, before_render_template, template_rendered, Response, jsonify,
+)
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from werkzeug.middleware.proxy_fix import ProxyFix
 import requests
+import gzip
+import hashlib
+import threading
+import time
 import os
 
+from observabilidad import (
+    API_LLAMADAS, WEB_DURACION, WEB_TIEMPO_API, WEB_TIEMPO_PLANTILLA, configurar_logging, logger,
+    registro_metricas,
+)
+
 app = Flask(__name__)
-app.secret_key = 'Proyecto_Maestria_2025'
+
+# Clave de las cookies de sesión. Todos los workers deben compartirla; sin
+# FLASK_SECRET_KEY se usa una aleatoria que solo sirve con un único proceso y
+# cierra las sesiones al reiniciar.
+FLASK_SECRET_KEY = os.getenv('FLASK_SECRET_KEY')
+app.secret_key = FLASK_SECRET_KEY or os.urandom(32)
 
 API_URL = os.getenv('API_URL', 'http://api:8000')
 
-# Función helper para peticiones a la API
-def api_request(method, endpoint, data=None):
+# Detrás del proxy de producción (proxy/nginx.conf) la IP del cliente llega en
+# X-Forwarded-For; sin esto el login enviaría a la API la IP del proxy
+if os.getenv('WEB_CONFIAR_PROXY', 'false').lower() in ('1', 'true', 'si'):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1)
+
+configurar_logging()
+if not FLASK_SECRET_KEY:
+    logger.warning("FLASK_SECRET_KEY no configurada: las sesiones solo son válidas en este proceso")
+
+# ========== MÉTRICAS ==========
+
+# Suma tiempo a un acumulador de la petición en curso. Los hilos de
+# api_requests_concurrentes tienen su propio `g` sin acumuladores: ahí se
+# mide una sola vez la espera total en el hilo de la vista.
+def sumar_tiempo(campo, duracion):
+    if has_app_context() and campo in g:
+        setattr(g, campo, getattr(g, campo) + duracion)
+
+@app.before_request
+def iniciar_medicion():
+    g.inicio_peticion = time.perf_counter()
+    g.tiempo_api = 0.0
+    g.tiempo_plantilla = 0.0
+
+@app.after_request
+def registrar_medicion(response):
+    if 'inicio_peticion' in g:
+        vista = request.endpoint or 'sin_ruta'
+        WEB_DURACION.labels(request.method, vista, str(response.status_code)).observe(
+            time.perf_counter() - g.inicio_peticion)
+        WEB_TIEMPO_API.labels(vista).observe(g.tiempo_api)
+        WEB_TIEMPO_PLANTILLA.labels(vista).observe(g.tiempo_plantilla)
+    return response
+
+@before_render_template.connect_via(app)
+def inicio_plantilla(sender, template, context, **extra):
+    g.inicio_plantilla = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def fin_plantilla(sender, template, context, **extra):
+    if 'inicio_plantilla' in g:
+        sumar_tiempo('tiempo_plantilla', time.perf_counter() - g.pop('inicio_plantilla'))
+
+@app.route('/metrics')
+def metrics():
+    return Response(generate_latest(registro_metricas()), mimetype=CONTENT_TYPE_LATEST)
+
+# ========== ESTÁTICOS Y COMPRESIÓN ==========
+
+# Los archivos estáticos se cachean en el navegador por ESTATICOS_MAX_AGE
+# segundos: url_for('static', ...) agrega ?v=<hash del contenido>, así un
+# cambio en el archivo cambia la URL y nadie se queda con la versión vieja.
+ESTATICOS_MAX_AGE = int(os.getenv('ESTATICOS_MAX_AGE', str(365 * 24 * 3600)))
+
+# Las respuestas de texto de más de COMPRESION_MINIMO bytes se envían con gzip
+# si el navegador lo acepta. Los streams no se comprimen.
+COMPRESION_MINIMO = int(os.getenv('COMPRESION_MINIMO', '500'))
+COMPRESION_NIVEL = int(os.getenv('COMPRESION_NIVEL', '6'))
+TIPOS_COMPRIMIBLES = ('text/', 'application/json', 'application/javascript')
+
+# filename -> (fecha de modificación, versión)
+_versiones_estaticos = {}
+
+def version_estatico(filename):
+    ruta = os.path.join(app.static_folder, filename)
+    try:
+        modificado = os.path.getmtime(ruta)
+    except OSError:
+        return None
+    version = _versiones_estaticos.get(filename)
+    if version is None or version[0] != modificado:
+        with open(ruta, 'rb') as archivo:
+            version = (modificado, hashlib.sha256(archivo.read()).hexdigest()[:12])
+        _versiones_estaticos[filename] = version
+    return version[1]
+
+@app.url_defaults
+def versionar_estaticos(endpoint, values):
+    if endpoint == 'static' and 'v' not in values:
+        version = version_estatico(values.get('filename', ''))
+        if version:
+            values['v'] = version
+
+def comprimir(response):
+    if (response.status_code != 200 or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '')
+            or not response.mimetype.startswith(TIPOS_COMPRIMIBLES)):
+        return response
+    # Los estáticos llegan como archivo (direct_passthrough); el resto de
+    # respuestas sin longitud conocida son streams
+    if response.direct_passthrough:
+        response.direct_passthrough = False
+    elif response.is_streamed:
+        return response
+
+    datos = response.get_data()
+    if len(datos) < COMPRESION_MINIMO:
+        return response
+    response.set_data(gzip.compress(datos, COMPRESION_NIVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    # El cuerpo ya no es byte a byte el del ETag original
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.after_request
+def cachear_y_comprimir(response):
+    if request.endpoint == 'static' and 'v' in request.args and response.status_code in (200, 304):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = ESTATICOS_MAX_AGE
+        response.cache_control.immutable = True
+    return comprimir(response)
+
+# Cliente HTTP compartido: mantiene conexiones keep-alive con la API en lugar de
+# abrir una conexión TCP por petición. Los reintentos con backoff solo se
+# aplican a verbos de lectura; los PUT/DELETE de la API cambian estado y un
+# reintento tras una respuesta perdida devolvería un error engañoso. El 503 no
+# se reintenta: la API lo devuelve cuando su pool de conexiones está agotado, y
+# reintentarlo solo sumaría carga a una API ya saturada.
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', '20'))
+API_REINTENTOS = int(os.getenv('API_REINTENTOS', '2'))
+API_TIMEOUT = (float(os.getenv('API_TIMEOUT_CONEXION', '3')), float(os.getenv('API_TIMEOUT', '10')))
+
+def crear_sesion_http():
+    reintentos = Retry(
+        total=API_REINTENTOS,
+        backoff_factor=0.2,
+        status_forcelist=(502, 504),
+        allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+        raise_on_status=False,
+    )
+    adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE, max_retries=reintentos)
+    sesion = requests.Session()
+    sesion.mount('http://', adaptador)
+    sesion.mount('https://', adaptador)
+    return sesion
+
+http = crear_sesion_http()
+
+# Hilos para lanzar varias peticiones independientes a la API en paralelo
+executor_api = ThreadPoolExecutor(max_workers=API_POOL_SIZE, thread_name_prefix='api')
+
+# Caché local de respuestas GET con ETag: se revalida con If-None-Match y,
+# si la API contesta 304, se reutiliza el cuerpo guardado sin volver a
+# descargarlo ni decodificarlo
+class CacheRespuestas:
+    def __init__(self, maximo):
+        self.maximo = maximo
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, url):
+        with self._lock:
+            entrada = self._datos.get(url)
+            if entrada is not None:
+                self._datos.move_to_end(url)
+            return entrada
+
+    def guardar(self, url, etag, datos):
+        with self._lock:
+            self._datos[url] = (etag, datos)
+            self._datos.move_to_end(url)
+            while len(self._datos) > self.maximo:
+                self._datos.popitem(last=False)
+
+cache_respuestas = CacheRespuestas(int(os.getenv('API_CACHE_ENTRADAS', '256')))
+
+# Envía una petición a la API midiendo su duración
+def enviar_a_api(method, url, data, headers):
+    inicio = time.perf_counter()
+    codigo = 'error'
+    try:
+        response = http.request(method, url, json=data, headers=headers, timeout=API_TIMEOUT)
+        codigo = str(response.status_code)
+        return response
+    finally:
+        duracion = time.perf_counter() - inicio
+        API_LLAMADAS.labels(method, codigo).observe(duracion)
+        sumar_tiempo('tiempo_api', duracion)
+
+# Pide a la API un nuevo par de tokens con el de refresco de la sesión
+def refrescar_tokens():
+    refresco = session.get('token_refresco')
+    if not refresco:
+        return False
+    try:
+        response = http.post(f'{API_URL}/token/refrescar', json={'token_refresco': refresco}, timeout=API_TIMEOUT)
+    except requests.exceptions.RequestException:
+        return False
+    if response.status_code != 200:
+        return False
+    tokens = response.json()
+    session['token_acceso'] = tokens['token_acceso']
+    session['token_refresco'] = tokens['token_refresco']
+    return True
+
+# Función helper para peticiones a la API. Adjunta el token de acceso de la
+# sesión; si la API lo rechaza por vencido se renueva y se reintenta una vez.
+def api_request(method, endpoint, data=None, headers=None):
     try:
         url = f'{API_URL}{endpoint}'
-        headers = {'Content-Type': 'application/json'}
+        if method not in ('GET', 'POST', 'PUT', 'PATCH', 'DELETE'):
+            return {"error": f"Método no soportado: {method}"}, False
 
-        if method == 'GET':
-            response = requests.get(url, timeout=10)
-        elif method == 'POST':
-            response = requests.post(url, json=data, headers=headers, timeout=10)
-        elif method == 'PUT':
-            response = requests.put(url, json=data, headers=headers, timeout=10)
-        elif method == 'DELETE':
-            response = requests.delete(url, timeout=10)
+        headers = dict(headers or {})
+        en_cache = cache_respuestas.obtener(url) if method == 'GET' else None
+        if en_cache:
+            headers['If-None-Match'] = en_cache[0]
+
+        token = session.get('token_acceso') if has_request_context() else None
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+
+        response = enviar_a_api(method, url, data, headers)
+
+        if response.status_code == 401 and token:
+            if not refrescar_tokens():
+                session.clear()
+                mensaje = 'La sesión expiró, vuelve a iniciar sesión'
+                return {"error": mensaje, "detail": mensaje}, False
+            headers['Authorization'] = f'Bearer {session["token_acceso"]}'
+            response = enviar_a_api(method, url, data, headers)
+
+        if response.status_code == 304 and en_cache:
+            return en_cache[1], True
 
         if response.status_code in [200, 201]:
             if response.text.strip():
-                return response.json(), True
+                datos = response.json()
+                etag = response.headers.get('ETag')
+                if method == 'GET' and etag:
+                    cache_respuestas.guardar(url, etag, datos)
+                return datos, True
             else:
                 return {"message": "Success but no content"}, True
         else:
@@ -38,12 +281,58 @@ def api_request(method, endpoint, data=None):
             return error_data, False
 
     except requests.exceptions.ConnectionError:
+        logger.warning("API no disponible", extra={"metodo": method, "endpoint": endpoint})
         return {"error": "No se puede conectar con la API"}, False
     except requests.exceptions.Timeout:
+        logger.warning("timeout llamando a la API", extra={"metodo": method, "endpoint": endpoint})
         return {"error": "Timeout en la conexión con la API"}, False
     except Exception as e:
+        logger.exception("error llamando a la API", extra={"metodo": method, "endpoint": endpoint})
         return {"error": f"Error: {str(e)}"}, False
 
+# Ejecuta varias peticiones independientes en paralelo y devuelve sus
+# resultados en el mismo orden. Cada llamada es una tupla de argumentos para
+# api_request, p. ej. ('GET', '/equipos/disponibles').
+def api_requests_concurrentes(*llamadas):
+    if len(llamadas) <= 1:
+        return [api_request(*llamada) for llamada in llamadas]
+
+    def tarea(llamada):
+        return copy_current_request_context(lambda: api_request(*llamada))
+
+    inicio = time.perf_counter()
+    futuros = [executor_api.submit(tarea(llamada)) for llamada in llamadas]
+    resultados = [futuro.result() for futuro in futuros]
+    sumar_tiempo('tiempo_api', time.perf_counter() - inicio)
+    return resultados
+
+# Construye el endpoint de una consulta paginada a la API, omitiendo parámetros vacíos
+def endpoint_paginado(ruta, **params):
+    params = {k: v for k, v in params.items() if v not in (None, '')}
+    return f'{ruta}?{urlencode(params)}' if params else ruta
+
+# Convierte las fechas de un formulario (AAAA-MM-DD, ambas inclusive) en el
+# rango [desde, hasta) de fecha y hora que esperan los filtros de la API
+def rango_fechas(desde, hasta):
+    try:
+        inicio = f'{date.fromisoformat(desde)}T00:00:00' if desde else None
+        fin = f'{date.fromisoformat(hasta) + timedelta(days=1)}T00:00:00' if hasta else None
+    except ValueError:
+        return None, None
+    return inicio, fin
+
+# Mensaje de error de la API. Las operaciones por lote responden con
+# {"message", "equipos"/"prestamos"}: se muestran también los ids afectados.
+def detalle_error(result):
+    detalle = result.get('detail') or result.get('error') or 'Error desconocido'
+    if isinstance(detalle, dict):
+        ids = detalle.get('equipos') or detalle.get('prestamos')
+        detalle = f'{detalle.get("message")}: {", ".join(map(str, ids))}' if ids else detalle.get('message')
+    return detalle
+
+# Página vacía para cuando la API no responde
+PAGINA_VACIA = {'items': [], 'siguiente': None, 'anterior': None}
+
 # ========== AUTENTICACIÓN ==========
 
 @app.route('/')
@@ -57,7 +346,10 @@ def login():
     username = request.form['username']
     password = request.form['password']
 
-    data, success = api_request('POST', '/login', {'username': username, 'password': password})
+    # La IP del usuario, para que la API limite los intentos por IP real y no
+    # por la de la webapp
+    data, success = api_request('POST', '/login', {'username': username, 'password': password},
+                                headers={'X-Forwarded-For': request.remote_addr})
 
     if success:
         user = data['user']
@@ -65,6 +357,8 @@ def login():
         session['username'] = user['username']
         session['tipo_usuario'] = user['tipo_usuario']
         session['nombre_completo'] = user['nombre_completo']
+        session['token_acceso'] = data['token_acceso']
+        session['token_refresco'] = data['token_refresco']
         flash(f'¡Bienvenido {user["nombre_completo"]}!', 'success')
         return redirect(url_for('equipos'))
     else:
@@ -84,11 +378,19 @@ def equipos():
     if 'user_id' not in session:
         return redirect(url_for('index'))
 
-    equipos_data, success = api_request('GET', '/equipos')
+    # Con texto de búsqueda la lista viene ordenada por relevancia
+    filtros = {'estado': request.args.get('estado', ''), 'q': request.args.get('q', '').strip()}
+    ruta = '/equipos/buscar' if filtros['q'] else '/equipos'
+    equipos_data, success = api_request('GET', endpoint_paginado(
+        ruta, cursor=request.args.get('cursor'), **filtros))
     if not success:
         flash(f'Error cargando equipos: {equipos_data.get("error")}', 'error')
+        equipos_data = PAGINA_VACIA
 
-    return render_template('equipos.html', equipos=equipos_data if success else [])
+    return render_template('equipos.html',
+                         equipos=equipos_data['items'],
+                         pagina=equipos_data,
+                         filtros=filtros)
 
 @app.route('/equipos/agregar', methods=['POST'])
 def agregar_equipo():
@@ -141,13 +443,27 @@ def prestamos():
     if 'user_id' not in session:
         return redirect(url_for('index'))
 
-    # Obtener equipos disponibles
-    equipos_data, success1 = api_request('GET', '/equipos/disponibles')
-    equipos_disponibles = equipos_data if success1 else []
-
-    # Obtener préstamos del usuario
-    prestamos_data, success2 = api_request('GET', f'/prestamos/usuario/{session["user_id"]}')
-    mis_prestamos = prestamos_data if success2 else []
+    # Equipos disponibles (los que coinciden con la búsqueda, si la hay) y
+    # préstamos activos del usuario (una página a la vez), pedidos en paralelo
+    filtros = {'q': request.args.get('q', '').strip()}
+    if filtros['q']:
+        consulta_equipos = endpoint_paginado('/equipos/buscar', q=filtros['q'], estado='disponible', limit=100)
+    else:
+        consulta_equipos = '/equipos/disponibles'
+    (equipos_data, success1), (prestamos_data, success2) = api_requests_concurrentes(
+        ('GET', consulta_equipos),
+        ('GET', endpoint_paginado(
+            '/prestamos', usuario_id=session['user_id'], estado='activo',
+            cursor=request.args.get('cursor'))),
+    )
+    if not success1:
+        equipos_disponibles = []
+    elif filtros['q']:
+        equipos_disponibles = equipos_data['items']
+    else:
+        equipos_disponibles = equipos_data
+    pagina = prestamos_data if success2 else PAGINA_VACIA
+    mis_prestamos = pagina['items']
 
     if not success1:
         flash(f'Error cargando equipos: {equipos_data.get("error")}', 'error')
@@ -156,25 +472,65 @@ def prestamos():
 
     return render_template('prestamos.html',
                          equipos_disponibles=equipos_disponibles,
-                         mis_prestamos=mis_prestamos)
+                         mis_prestamos=mis_prestamos,
+                         pagina=pagina,
+                         filtros=filtros)
+
+@app.route('/prestamos/vencidos')
+def prestamos_vencidos():
+    if 'user_id' not in session or session.get('tipo_usuario') != 'admin':
+        flash('Solo los administradores pueden ver los préstamos vencidos', 'error')
+        return redirect(url_for('prestamos'))
+
+    vencidos_data, success = api_request('GET', endpoint_paginado(
+        '/prestamos/vencidos', cursor=request.args.get('cursor')))
+    if not success:
+        flash(f'Error cargando préstamos vencidos: {vencidos_data.get("error")}', 'error')
+        vencidos_data = PAGINA_VACIA
+
+    return render_template('prestamos_vencidos.html',
+                         vencidos=vencidos_data['items'],
+                         pagina=vencidos_data,
+                         filtros={})
 
 @app.route('/solicitar_prestamo', methods=['POST'])
 def solicitar_prestamo():
     if 'user_id' not in session:
         return redirect(url_for('index'))
 
+    # Un kit de varios equipos va en un solo préstamo por lote: se prestan
+    # todos o ninguno
     data = {
-        'equipo_id': int(request.form['equipo_id']),
+        'equipo_ids': [int(i) for i in request.form.getlist('equipo_ids')],
         'usuario_id': session['user_id'],
         'motivo': request.form['motivo']
     }
 
-    result, success = api_request('POST', '/prestamos', data)
+    result, success = api_request('POST', '/prestamos/lote', data)
 
     if success:
-        flash('Préstamo solicitado correctamente', 'success')
+        flash(f'Préstamo solicitado correctamente ({len(result["prestamos"])} equipos)', 'success')
     else:
-        flash(f'Error: {result.get("detail", "Error desconocido")}', 'error')
+        flash(f'Error: {detalle_error(result)}', 'error')
+
+    return redirect(url_for('prestamos'))
+
+@app.route('/prestamos/devolver', methods=['POST'])
+def devolver_equipos():
+    if 'user_id' not in session:
+        return redirect(url_for('index'))
+
+    prestamo_ids = [int(i) for i in request.form.getlist('prestamo_ids')]
+    if not prestamo_ids:
+        flash('Selecciona al menos un préstamo', 'error')
+        return redirect(url_for('prestamos'))
+
+    result, success = api_request('PUT', '/prestamos/lote/devolver', {'prestamo_ids': prestamo_ids})
+
+    if success:
+        flash(f'Equipos devueltos correctamente ({result["devueltos"]})', 'success')
+    else:
+        flash(f'Error: {detalle_error(result)}', 'error')
 
     return redirect(url_for('prestamos'))
 
@@ -192,6 +548,79 @@ def devolver_equipo(prestamo_id):
 
     return redirect(url_for('prestamos'))
 
+# ========== RESERVAS ==========
+
+@app.route('/reservas')
+def reservas():
+    if 'user_id' not in session:
+        return redirect(url_for('index'))
+
+    # Ventana elegida en el formulario (datetime-local, hora del servidor) y
+    # reservas vigentes del usuario, pedidas en paralelo
+    filtros = {'desde': request.args.get('desde', ''), 'hasta': request.args.get('hasta', '')}
+    llamadas = [('GET', endpoint_paginado(
+        '/reservas', usuario_id=session['user_id'], estado='activa',
+        cursor=request.args.get('cursor')))]
+    if filtros['desde'] and filtros['hasta']:
+        llamadas.append(('GET', endpoint_paginado(
+            '/equipos/disponibles', desde=filtros['desde'], hasta=filtros['hasta'])))
+    resultados = api_requests_concurrentes(*llamadas)
+
+    reservas_data, success = resultados[0]
+    pagina = reservas_data if success else PAGINA_VACIA
+    if not success:
+        flash(f'Error cargando reservas: {reservas_data.get("error")}', 'error')
+
+    equipos_libres = None
+    if len(resultados) > 1:
+        equipos_data, success = resultados[1]
+        if success:
+            equipos_libres = equipos_data
+        else:
+            flash(f'Error: {equipos_data.get("detail") or equipos_data.get("error")}', 'error')
+
+    return render_template('reservas.html',
+                         mis_reservas=pagina['items'],
+                         equipos_libres=equipos_libres,
+                         pagina=pagina,
+                         filtros=filtros)
+
+@app.route('/reservas/crear', methods=['POST'])
+def crear_reserva():
+    if 'user_id' not in session:
+        return redirect(url_for('index'))
+
+    data = {
+        'equipo_ids': [int(i) for i in request.form.getlist('equipo_ids')],
+        'usuario_id': session['user_id'],
+        'desde': request.form['desde'],
+        'hasta': request.form['hasta'],
+        'motivo': request.form.get('motivo', ''),
+    }
+
+    result, success = api_request('POST', '/reservas', data)
+
+    if success:
+        flash('Reserva creada correctamente', 'success')
+    else:
+        flash(f'Error: {detalle_error(result)}', 'error')
+
+    return redirect(url_for('reservas', desde=data['desde'], hasta=data['hasta']))
+
+@app.route('/reservas/cancelar/<int:reserva_id>')
+def cancelar_reserva(reserva_id):
+    if 'user_id' not in session:
+        return redirect(url_for('index'))
+
+    result, success = api_request('DELETE', f'/reservas/{reserva_id}')
+
+    if success:
+        flash('Reserva cancelada', 'success')
+    else:
+        flash(f'Error: {result.get("detail", "Error desconocido")}', 'error')
+
+    return redirect(url_for('reservas'))
+
 # ========== HISTORIAL - NUEVO EN V4.0 ==========
 
 @app.route('/historial')
@@ -199,29 +628,31 @@ def historial():
     if 'user_id' not in session:
         return redirect(url_for('index'))
 
+    pagina = PAGINA_VACIA
+    filtros = {
+        'estado': request.args.get('estado', ''),
+        'desde': request.args.get('desde', ''),
+        'hasta': request.args.get('hasta', ''),
+        # Incluir los meses ya archivados (más lento: recorre también el archivo)
+        'archivo': request.args.get('archivo', ''),
+    }
+    desde, hasta = rango_fechas(filtros['desde'], filtros['hasta'])
+
     # Los admins ven historial completo, usuarios normales solo relacionado con sus préstamos
     if session.get('tipo_usuario') == 'admin':
-        historial_data, success = api_request('GET', '/historial')
+        ruta = '/historial'
         titulo = "Historial Completo del Sistema"
     else:
-        # Para usuarios normales, obtener historial de sus préstamos
-        prestamos_data, success1 = api_request('GET', f'/prestamos/usuario/{session["user_id"]}')
-        historial_data = []
-        success = True
+        ruta = f'/historial/usuario/{session["user_id"]}'
         titulo = "Mi Historial Personal"
 
-        if success1 and prestamos_data:
-            # Obtener historial de cada equipo que ha prestado
-            equipos_prestados = list(set([p['equipo_id'] for p in prestamos_data]))
-            for equipo_id in equipos_prestados:
-                hist_equipo, success_hist = api_request('GET', f'/historial/equipo/{equipo_id}')
-                if success_hist:
-                    # Filtrar solo los cambios relacionados con este usuario
-                    historial_usuario = [h for h in hist_equipo if h.get('usuario_responsable') == session['user_id']]
-                    historial_data.extend(historial_usuario)
-
-            # Ordenar por fecha
-            historial_data = sorted(historial_data, key=lambda x: x['fecha_cambio'], reverse=True)
+    historial_data, success = api_request('GET', endpoint_paginado(
+        ruta, cursor=request.args.get('cursor'),
+        estado=filtros['estado'], desde=desde, hasta=hasta,
+        archivo='true' if filtros['archivo'] else None))
+    if success:
+        pagina = historial_data
+        historial_data = pagina['items']
 
     if not success:
         flash(f'Error cargando historial: {historial_data.get("error") if isinstance(historial_data, dict) else "Error desconocido"}', 'error')
@@ -229,8 +660,49 @@ def historial():
 
     return render_template('historial.html', 
                          historial=historial_data, 
-                         titulo=titulo)
+                         titulo=titulo,
+                         pagina=pagina,
+                         filtros=filtros)
 
+# ========== ESTADÍSTICAS ==========
+
+@app.route('/estadisticas')
+def estadisticas():
+    if 'user_id' not in session or session.get('tipo_usuario') != 'admin':
+        flash('Solo los administradores pueden ver las estadísticas', 'error')
+        return redirect(url_for('equipos'))
+
+    estadisticas_data, success = api_request('GET', '/estadisticas')
+    if not success:
+        flash(f'Error cargando estadísticas: {estadisticas_data.get("error")}', 'error')
+        estadisticas_data = None
+
+    return render_template('estadisticas.html', estadisticas=estadisticas_data)
+
+# ========== EVENTOS EN VIVO ==========
+
+# Los cambios de disponibilidad llegan al navegador por el stream
+# /eventos/equipos de la API (Server-Sent Events), que static/disponibilidad.js
+# aplica sobre la página. La webapp no reenvía el stream: cada página abierta
+# ocuparía uno de sus hilos mientras siga abierta. Solo entrega la URL con un
+# token de eventos de vida corta; el navegador se conecta a la API a través del
+# proxy (docker-compose.prod.yml) o, en desarrollo, al puerto publicado.
+API_EVENTOS_URL = os.getenv('API_EVENTOS_URL', '/eventos/equipos')
+
+@app.route('/eventos/token')
+def eventos_token():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Sesión no iniciada'}), 401
+    datos, success = api_request('POST', '/eventos/token')
+    if not success:
+        return jsonify({'error': detalle_error(datos)}), 503
+    return jsonify({
+        'url': f'{API_EVENTOS_URL}?{urlencode({"token": datos["token_eventos"]})}',
+        'expira_en': datos['expira_en'],
+    })
+
+# Servidor de desarrollo (FLASK_DEBUG=1 activa la recarga y el depurador). En
+# producción la webapp se sirve con gunicorn (ver gunicorn.conf.py).
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000)
  
\ No newline at end of file
@@ -0,0 +1,50 @@
+import multiprocessing
+import os
+import shutil
+
+# Modo producción de la webapp: gunicorn en lugar del servidor de desarrollo
+# de Flask.
+#
+#   gunicorn app:app -c gunicorn.conf.py
+#
+# Las vistas pasan casi todo el tiempo esperando a la API, así que cada worker
+# atiende varias peticiones con hilos (gthread). La webapp no atiende
+# conexiones largas: el navegador recibe los eventos en vivo directamente de
+# la API (ver /eventos/token en app.py).
+#
+# Recarga sin cortar el servicio: `kill -HUP <pid del master>` (en docker,
+# `docker compose kill -s HUP webapp`). Todos los workers deben compartir
+# FLASK_SECRET_KEY o las sesiones de un worker no valen en otro.
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+workers = int(os.getenv("WEB_WORKERS") or multiprocessing.cpu_count() * 2 + 1)
+worker_class = "gthread"
+threads = int(os.getenv("WEB_HILOS", "8"))
+
+# Keep-alive corto con los navegadores: con gthread las conexiones inactivas
+# no ocupan hilo, pero sí un descriptor de archivo en el worker
+keepalive = int(os.getenv("WEB_KEEPALIVE", "5"))
+
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("WEB_WORKER_TIMEOUT", "60"))
+
+accesslog = os.getenv("WEB_ACCESSLOG")  # "-" para registrar los accesos en stdout
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+
+# Métricas de Prometheus de todos los workers: cada proceso escribe las suyas
+# en PROMETHEUS_MULTIPROC_DIR (heredado por los workers, que importan la
+# aplicación después del fork) y /metrics las agrega. El directorio se vacía
+# al arrancar el master y se descartan las de cada worker que termina.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_webapp")
+
+
+def on_starting(server):
+    directorio = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directorio, ignore_errors=True)
+    os.makedirs(directorio)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
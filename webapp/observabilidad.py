@@ -0,0 +1,83 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+from prometheus_client import REGISTRY, CollectorRegistry, Histogram, multiprocess
+
+# Métricas y logging de la webapp, expuestas en /metrics en formato Prometheus.
+# Por cada vista se separa el tiempo esperando a la API del tiempo de render
+# de la plantilla; el resto de la latencia es trabajo propio de la vista.
+# Con varios workers (gunicorn.conf.py define PROMETHEUS_MULTIPROC_DIR)
+# /metrics agrega las de todos.
+
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+WEB_DURACION = Histogram(
+    "web_peticion_duracion_segundos", "Latencia de las vistas de la webapp",
+    ["metodo", "vista", "codigo"], buckets=BUCKETS_LATENCIA,
+)
+WEB_TIEMPO_API = Histogram(
+    "web_peticion_tiempo_api_segundos", "Tiempo esperando a la API por petición",
+    ["vista"], buckets=BUCKETS_LATENCIA,
+)
+WEB_TIEMPO_PLANTILLA = Histogram(
+    "web_peticion_tiempo_plantilla_segundos", "Tiempo de render de plantillas por petición",
+    ["vista"], buckets=BUCKETS_LATENCIA,
+)
+API_LLAMADAS = Histogram(
+    "web_api_llamada_duracion_segundos", "Latencia de cada llamada a la API",
+    ["metodo", "codigo"], buckets=BUCKETS_LATENCIA,
+)
+
+logger = logging.getLogger("inventario.webapp")
+
+
+def registro_metricas():
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        return REGISTRY
+    registro = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registro)
+    return registro
+
+
+# ========== LOGGING ==========
+
+# Campos estándar de LogRecord; todo lo demás viene de `extra` y se incluye
+# tal cual en la línea JSON
+_CAMPOS_RECORD = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class FormatoJSON(logging.Formatter):
+    def format(self, record):
+        linea = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + f".{int(record.msecs):03d}Z",
+            "nivel": record.levelname,
+            "logger": record.name,
+            "mensaje": record.getMessage(),
+        }
+        for campo, valor in vars(record).items():
+            if campo not in _CAMPOS_RECORD:
+                linea[campo] = valor
+        return json.dumps(linea, ensure_ascii=False, default=str)
+
+
+# Las vistas solo encolan el registro; un hilo aparte lo escribe
+def configurar_logging(nivel=None):
+    raiz = logging.getLogger("inventario")
+    if raiz.handlers:
+        return
+    cola = queue.SimpleQueue()
+    salida = logging.StreamHandler()
+    salida.setFormatter(FormatoJSON())
+    oyente = logging.handlers.QueueListener(cola, salida, respect_handler_level=True)
+    oyente.start()
+    atexit.register(oyente.stop)
+
+    raiz.addHandler(logging.handlers.QueueHandler(cola))
+    raiz.setLevel(nivel or os.getenv("LOG_LEVEL", "INFO"))
+    raiz.propagate = False
@@ -0,0 +1,177 @@
+// Disponibilidad en vivo: escucha el stream /eventos/equipos de la API
+// (Server-Sent Events) y actualiza la página sin recargarla. La URL del stream,
+// con un token de vida corta, se pide a la webapp (data-token-url) al conectar
+// y cada vez que el stream se cierra sin poder reconectarse (token vencido,
+// API reiniciada). Marcado que entiende:
+//   data-equipo-id="N"              fila u opción de un equipo
+//   data-estado="..."               estado actual del equipo (en la fila)
+//   data-estado-equipo              celda donde se muestra el estado
+//   data-solo-disponibles           se oculta mientras el equipo no esté disponible
+//   data-lista-disponibles          <table> o <select> al que se agregan los equipos que
+//                                   pasan a estar disponibles (data-agregar="no" lo evita);
+//                                   en tablas, data-columnas indica los campos de cada celda
+//   data-contenedor-disponibles     se oculta si no queda ningún equipo disponible
+//   data-sin-disponibles            se muestra si no queda ningún equipo disponible
+//   data-conteo="estado"            cantidad de filas con ese estado
+//   data-estado-conexion            texto con el estado de la conexión
+(function () {
+    var script = document.currentScript;
+    if (!window.EventSource || !script) {
+        return;
+    }
+
+    var ESTADOS = {
+        disponible: {texto: 'Disponible', estilo: 'color: green; font-weight: bold;'},
+        prestado: {texto: 'Prestado', estilo: 'color: orange; font-style: italic;'}
+    };
+
+    function todos(selector) {
+        return Array.prototype.slice.call(document.querySelectorAll(selector));
+    }
+
+    function mostrarConexion(texto) {
+        todos('[data-estado-conexion]').forEach(function (elemento) {
+            elemento.textContent = texto;
+        });
+    }
+
+    function pintarEstado(celda, estado) {
+        celda.textContent = '';
+        if (estado === null) {
+            celda.textContent = 'Eliminado';
+            return;
+        }
+        var info = ESTADOS[estado];
+        if (!info) {
+            celda.textContent = estado;
+            return;
+        }
+        var span = document.createElement('span');
+        span.setAttribute('style', info.estilo);
+        span.textContent = info.texto;
+        celda.appendChild(span);
+    }
+
+    function agregar(lista, cambio) {
+        var elemento;
+        if (lista.tagName === 'SELECT') {
+            elemento = document.createElement('option');
+            elemento.value = cambio.id;
+            elemento.textContent = cambio.nombre;
+            lista.appendChild(elemento);
+        } else {
+            elemento = lista.insertRow(-1);
+            (lista.getAttribute('data-columnas') || 'id,nombre,estado').split(',').forEach(function (campo) {
+                var celda = elemento.insertCell(-1);
+                if (campo === 'estado') {
+                    celda.setAttribute('data-estado-equipo', '');
+                } else {
+                    celda.textContent = cambio[campo] === undefined ? '-' : cambio[campo];
+                }
+            });
+        }
+        elemento.setAttribute('data-equipo-id', cambio.id);
+        elemento.setAttribute('data-solo-disponibles', '');
+    }
+
+    function aplicar(cambio) {
+        var disponible = cambio.estado === 'disponible';
+        if (disponible) {
+            todos('[data-lista-disponibles]').forEach(function (lista) {
+                if (lista.getAttribute('data-agregar') !== 'no'
+                        && !lista.querySelector('[data-equipo-id="' + cambio.id + '"]')) {
+                    agregar(lista, cambio);
+                }
+            });
+        }
+
+        todos('[data-equipo-id="' + cambio.id + '"]').forEach(function (elemento) {
+            elemento.setAttribute('data-estado', cambio.estado === null ? 'eliminado' : cambio.estado);
+            if (elemento.hasAttribute('data-solo-disponibles')) {
+                elemento.hidden = !disponible;
+                if (elemento.tagName === 'OPTION') {
+                    elemento.disabled = !disponible;
+                    if (!disponible && elemento.selected) {
+                        if (elemento.parentNode.multiple) {
+                            elemento.selected = false;
+                        } else {
+                            elemento.parentNode.value = '';
+                        }
+                    }
+                }
+            }
+            var celda = elemento.querySelector('[data-estado-equipo]');
+            if (celda) {
+                pintarEstado(celda, cambio.estado);
+            }
+        });
+    }
+
+    function actualizarResumen() {
+        var hayDisponibles = todos('[data-lista-disponibles] [data-equipo-id]').some(function (elemento) {
+            return !elemento.hidden;
+        });
+        todos('[data-contenedor-disponibles]').forEach(function (elemento) {
+            elemento.hidden = !hayDisponibles;
+        });
+        todos('[data-sin-disponibles]').forEach(function (elemento) {
+            elemento.hidden = hayDisponibles;
+        });
+        todos('[data-conteo]').forEach(function (elemento) {
+            var estado = elemento.getAttribute('data-conteo');
+            elemento.textContent = todos('tr[data-estado="' + estado + '"]').length;
+        });
+    }
+
+    var REINTENTO_MS = 5000;
+    var reconectado = false;
+
+    function reintentar() {
+        reconectado = true;
+        mostrarConexion('Reconectando...');
+        setTimeout(conectar, REINTENTO_MS);
+    }
+
+    function escuchar(url) {
+        var fuente = new EventSource(url);
+
+        fuente.addEventListener('open', function () {
+            mostrarConexion(reconectado
+                ? 'Conexión recuperada: recarga la página para ver los cambios ocurridos mientras tanto.'
+                : 'Disponibilidad actualizada en vivo.');
+        });
+        fuente.addEventListener('error', function () {
+            reconectado = true;
+            if (fuente.readyState === EventSource.CLOSED) {
+                reintentar();
+            } else {
+                mostrarConexion('Reconectando...');
+            }
+        });
+        fuente.addEventListener('equipos', function (evento) {
+            JSON.parse(evento.data).forEach(aplicar);
+            actualizarResumen();
+        });
+        fuente.addEventListener('resincronizar', function () {
+            mostrarConexion('Puede haber cambios sin mostrar: recarga la página.');
+        });
+    }
+
+    function conectar() {
+        var peticion = new XMLHttpRequest();
+        peticion.open('GET', script.getAttribute('data-token-url'));
+        peticion.onload = function () {
+            if (peticion.status === 401) {
+                mostrarConexion('Actualización en vivo no disponible: recarga la página para ver los cambios.');
+            } else if (peticion.status !== 200) {
+                reintentar();
+            } else {
+                escuchar(JSON.parse(peticion.responseText).url);
+            }
+        };
+        peticion.onerror = reintentar;
+        peticion.send();
+    }
+
+    conectar();
+})();